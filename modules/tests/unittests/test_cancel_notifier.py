@@ -0,0 +1,88 @@
+import datetime
+import json
+import unittest
+
+import wsrc.external_sites # call __init__.py
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+
+from wsrc.site.courts import cancel_notifier
+from wsrc.site.courts.models import BookingSystemEvent, CancellationNotice, DayOfWeek, EventFilter
+from wsrc.site.models import BackgroundJob, EmailContent, OutboxEmail
+from wsrc.site.usermodel.models import Player
+from wsrc.utils.timezones import UK_TZINFO
+
+class Tester(unittest.TestCase):
+
+    def setUp(self):
+        # discard every change made by each test
+        self.atomic = transaction.atomic()
+        self.atomic.__enter__()
+        for model in (CancellationNotice, BackgroundJob, OutboxEmail, EventFilter):
+            model.objects.all().delete()
+        EmailContent.objects.get_or_create(name="CancellationNotifier",
+                                           defaults={"template_type": "django", "markup": "{{ event.name }} cancelled"})
+        self.players = [self.create_player("Foo", "Bar"), self.create_player("Foo", "Baz")]
+        # the first player wants to know about any cancellation
+        evt_filter = EventFilter.objects.create(player=self.players[0], earliest="00:00", latest="23:59",
+                                                notice_period_minutes=0)
+        evt_filter.days.add(*DayOfWeek.objects.all())
+        self.now = timezone.now()
+        self.date = (self.now + datetime.timedelta(days=2)).astimezone(UK_TZINFO).date()
+
+    def tearDown(self):
+        transaction.set_rollback(True)
+        self.atomic.__exit__(None, None, None)
+
+    def create_player(self, first_name, last_name):
+        user = User.objects.create_user(username="test_notifier_{0}{1}".format(first_name, last_name).lower(),
+                                        first_name=first_name, last_name=last_name,
+                                        email="{0}@{1}.com".format(first_name, last_name).lower())
+        return Player.objects.create(user=user)
+
+    def create_booking(self, hour, court, player):
+        start_time = datetime.datetime.combine(self.date, datetime.time(hour, 0)).replace(tzinfo=UK_TZINFO)
+        user = player.user
+        booking = BookingSystemEvent(start_time=start_time, end_time=start_time + datetime.timedelta(minutes=45),
+                                     court=court, name=user.get_full_name(), event_type="I",
+                                     created_by_user=user, last_updated_by=user)
+        booking.save()
+        return booking
+
+    def cancel(self, booking):
+        booking.is_active = False
+        booking.save()
+
+    def get_sent(self):
+        return [(email.subject, json.loads(email.recipients)) for email in OutboxEmail.objects.order_by("id")]
+
+    def test_GIVEN_several_cancellations_WHEN_cancelled_THEN_one_digest_scheduled(self):
+        for hour in (10, 11, 12):
+            self.cancel(self.create_booking(hour, 1, self.players[1]))
+        self.assertEqual(3, CancellationNotice.objects.count())
+        digests = BackgroundJob.objects.filter(handler="wsrc.site.courts.cancel_notifier.send_cancellation_digests")
+        self.assertEqual(1, digests.count())
+        self.assertEqual([], self.get_sent())
+
+    def test_GIVEN_several_cancellations_WHEN_digest_sent_THEN_one_email_per_player(self):
+        self.cancel(self.create_booking(10, 1, self.players[1]))
+        self.cancel(self.create_booking(11, 2, self.players[1]))
+        cancel_notifier.send_cancellation_digests()
+        self.assertEqual([("Court Cancellations", ["foo@bar.com"])], self.get_sent())
+        self.assertEqual(0, CancellationNotice.objects.count())
+        cancel_notifier.send_cancellation_digests()
+        self.assertEqual(1, OutboxEmail.objects.count())
+
+    def test_GIVEN_own_or_reinstated_booking_WHEN_digest_sent_THEN_not_reported(self):
+        self.cancel(self.create_booking(10, 1, self.players[0]))
+        reinstated = self.create_booking(11, 1, self.players[1])
+        self.cancel(reinstated)
+        reinstated.is_active = True
+        reinstated.save()
+        self.cancel(self.create_booking(12, 1, self.players[1]))
+        cancel_notifier.send_cancellation_digests()
+        self.assertEqual([("Court Cancellation", ["foo@bar.com"])], self.get_sent())
+
+if __name__ == '__main__':
+    unittest.main()
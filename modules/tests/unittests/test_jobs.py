@@ -0,0 +1,80 @@
+import datetime
+import unittest
+
+import wsrc.external_sites # call __init__.py
+from django.db import transaction
+from django.utils import timezone
+
+from wsrc.site import jobs
+from wsrc.site.models import BackgroundJob
+
+CALLS = []
+
+def record_call(**kwargs):
+    CALLS.append(kwargs)
+
+def fail(**kwargs):
+    raise Exception("failed on purpose")
+
+class Tester(unittest.TestCase):
+
+    def setUp(self):
+        # run each test against an empty queue, and discard its changes
+        self.atomic = transaction.atomic()
+        self.atomic.__enter__()
+        BackgroundJob.objects.all().delete()
+        del CALLS[:]
+
+    def tearDown(self):
+        transaction.set_rollback(True)
+        self.atomic.__exit__(None, None, None)
+
+    def test_GIVEN_queued_job_WHEN_claimed_THEN_leased_to_one_worker(self):
+        job = jobs.enqueue(record_call, n=1)
+        claimed = jobs.claim_next(60)
+        self.assertEqual(job.pk, claimed.pk)
+        self.assertEqual(BackgroundJob.RUNNING, claimed.status)
+        self.assertEqual(1, claimed.attempts)
+        self.assertTrue(claimed.locked_until > timezone.now())
+        self.assertIsNone(jobs.claim_next(60))
+
+    def test_GIVEN_lease_expired_WHEN_claiming_THEN_job_claimed_again(self):
+        job = jobs.enqueue(record_call)
+        jobs.claim_next(60)
+        BackgroundJob.objects.filter(pk=job.pk).update(locked_until=timezone.now() - datetime.timedelta(seconds=1))
+        claimed = jobs.claim_next(60)
+        self.assertEqual(job.pk, claimed.pk)
+        self.assertEqual(2, claimed.attempts)
+
+    def test_GIVEN_delayed_job_WHEN_running_pending_THEN_only_due_jobs_run(self):
+        jobs.enqueue(record_call, n=1)
+        later = jobs.enqueue(record_call, delay=datetime.timedelta(hours=1), n=2)
+        self.assertEqual(1, jobs.run_pending())
+        self.assertEqual([{"n": 1}], CALLS)
+        self.assertEqual(BackgroundJob.PENDING, BackgroundJob.objects.get(pk=later.pk).status)
+        self.assertEqual(1, BackgroundJob.objects.filter(status=BackgroundJob.DONE).count())
+
+    def test_GIVEN_failing_job_WHEN_run_THEN_retried_with_backoff_until_failed(self):
+        job = jobs.enqueue(fail, max_attempts=2)
+        before = timezone.now()
+        self.assertFalse(jobs.run_job(jobs.claim_next(60)))
+        job = BackgroundJob.objects.get(pk=job.pk)
+        self.assertEqual(BackgroundJob.PENDING, job.status)
+        self.assertTrue(job.run_after >= before + jobs.get_backoff(1))
+        self.assertIn("failed on purpose", job.last_error)
+        self.assertIsNone(jobs.claim_next(60))
+        BackgroundJob.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        self.assertFalse(jobs.run_job(jobs.claim_next(60)))
+        job = BackgroundJob.objects.get(pk=job.pk)
+        self.assertEqual(BackgroundJob.FAILED, job.status)
+        self.assertEqual(2, job.attempts)
+        self.assertIsNone(jobs.claim_next(60))
+
+    def test_GIVEN_pending_job_WHEN_enqueueing_once_THEN_not_queued_again(self):
+        self.assertIsNotNone(jobs.enqueue_once(record_call))
+        self.assertIsNone(jobs.enqueue_once(record_call))
+        self.assertIsNotNone(jobs.enqueue_once(fail))
+        self.assertEqual(2, BackgroundJob.objects.count())
+
+if __name__ == '__main__':
+    unittest.main()
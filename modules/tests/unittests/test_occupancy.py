@@ -0,0 +1,52 @@
+import datetime
+import unittest
+
+import wsrc.external_sites # call __init__.py
+from wsrc.site.courts.occupancy import DayOccupancy, OccupancyGrid, MINUTES_PER_DAY
+
+class Tester(unittest.TestCase):
+
+    def test_GIVEN_empty_day_WHEN_finding_free_runs_THEN_whole_window_returned(self):
+        day = DayOccupancy(15)
+        self.assertEqual([(0, MINUTES_PER_DAY)], list(day.free_runs(1)))
+        self.assertEqual([(420, 1320)], list(day.free_runs(1, 420, 1320)))
+
+    def test_GIVEN_bookings_WHEN_finding_free_runs_THEN_gaps_returned(self):
+        day = DayOccupancy(15)
+        day.add(1, 9*60, 45)
+        day.add(1, 10*60, 60)
+        day.add(2, 9*60, 45)
+        self.assertEqual([(8*60, 9*60), (9*60+45, 10*60), (11*60, 12*60)], list(day.free_runs(1, 8*60, 12*60)))
+        self.assertEqual([(8*60, 9*60), (9*60+45, 12*60)], list(day.free_runs(2, 8*60, 12*60)))
+        self.assertEqual([(8*60, 12*60)], list(day.free_runs(3, 8*60, 12*60)))
+
+    def test_GIVEN_bookings_WHEN_testing_slots_THEN_overlaps_detected(self):
+        day = DayOccupancy(15)
+        day.add(1, 9*60, 45)
+        self.assertFalse(day.is_free(1, 8*60+30, 45))
+        self.assertTrue(day.is_free(1, 8*60+15, 45))
+        self.assertTrue(day.is_free(1, 9*60+45, 45))
+        self.assertTrue(day.is_free(2, 9*60, 45))
+        self.assertEqual(3, day.booked_slot_count(1))
+        self.assertEqual([(36, 39)], list(day.booked_runs(1)))
+
+    def test_GIVEN_unaligned_booking_WHEN_added_THEN_all_touched_slots_booked(self):
+        day = DayOccupancy(15)
+        day.add(1, 9*60+5, 20)
+        self.assertEqual([(36, 38)], list(day.booked_runs(1)))
+
+    def test_GIVEN_several_days_WHEN_totalling_slots_THEN_counts_summed(self):
+        grid = OccupancyGrid(60)
+        d1 = datetime.date(2001, 1, 1)
+        d2 = datetime.date(2001, 1, 2)
+        grid.add(d1, 1, 9*60, 120)
+        grid.add(d2, 1, 10*60, 60)
+        grid.add(d2, 2, 10*60, 60)
+        totals = grid.slot_totals([d1, d2], [1, 2, 3])
+        self.assertEqual(1, totals[9])
+        self.assertEqual(3, totals[10])
+        self.assertEqual(0, totals[11])
+        self.assertEqual(4, sum(totals))
+
+if __name__ == '__main__':
+    unittest.main()
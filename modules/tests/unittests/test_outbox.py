@@ -0,0 +1,100 @@
+import datetime
+import unittest
+
+import wsrc.external_sites # call __init__.py
+from django.core import mail
+from django.core.mail import EmailMessage
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db import transaction
+from django.test.utils import override_settings
+from django.utils import timezone
+
+import wsrc.site.settings.settings as settings
+from wsrc.site import jobs, outbox
+from wsrc.site.models import BackgroundJob, OutboxEmail
+
+class FailingBackend(BaseEmailBackend):
+    def send_messages(self, messages):
+        raise IOError("mail server unavailable")
+
+class FakeClock(object):
+    "Stands in for the time module, so that rate limiting is seen without waiting"
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+    def time(self):
+        return self.now
+    def sleep(self, secs):
+        self.sleeps.append(secs)
+        self.now += secs
+
+class Tester(unittest.TestCase):
+
+    def setUp(self):
+        # run each test against an empty outbox, and discard its changes
+        self.atomic = transaction.atomic()
+        self.atomic.__enter__()
+        OutboxEmail.objects.all().delete()
+        BackgroundJob.objects.all().delete()
+        self.settings = override_settings(EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend")
+        self.settings.enable()
+        mail.outbox = []
+        self.rate = settings.EMAIL_OUTBOX_RATE_PER_MINUTE
+        self.clock = FakeClock()
+        outbox.time = self.clock
+
+    def tearDown(self):
+        import time
+        outbox.time = time
+        settings.EMAIL_OUTBOX_RATE_PER_MINUTE = self.rate
+        self.settings.disable()
+        transaction.set_rollback(True)
+        self.atomic.__exit__(None, None, None)
+
+    def queue(self, n):
+        for i in range(n):
+            outbox.queue_message(EmailMessage("Message {0}".format(i), "Body", "club@example.com",
+                                              ["player{0}@example.com".format(i)]))
+
+    def test_GIVEN_messages_queued_WHEN_queueing_THEN_one_delivery_job_scheduled(self):
+        self.queue(3)
+        self.assertEqual(3, OutboxEmail.objects.filter(status=OutboxEmail.QUEUED).count())
+        self.assertEqual(1, BackgroundJob.objects.filter(handler="wsrc.site.outbox.deliver").count())
+        self.assertEqual([], mail.outbox)
+
+    def test_GIVEN_messages_queued_WHEN_delivered_THEN_sent_no_faster_than_rate(self):
+        settings.EMAIL_OUTBOX_RATE_PER_MINUTE = 30
+        self.queue(3)
+        self.assertEqual(3, outbox.deliver())
+        self.assertEqual(["Message 0", "Message 1", "Message 2"], [msg.subject for msg in mail.outbox])
+        self.assertEqual(["player1@example.com"], mail.outbox[1].recipients())
+        self.assertEqual(3, OutboxEmail.objects.filter(status=OutboxEmail.SENT).count())
+        self.assertEqual([2.0, 2.0, 2.0], self.clock.sleeps)
+
+    def test_GIVEN_more_messages_than_lease_allows_WHEN_delivered_THEN_rest_left_for_next_job(self):
+        settings.EMAIL_OUTBOX_RATE_PER_MINUTE = 1
+        max_messages = outbox.get_max_messages()
+        self.queue(max_messages + 1)
+        BackgroundJob.objects.all().delete()
+        self.assertEqual(max_messages, outbox.deliver())
+        self.assertEqual(1, OutboxEmail.objects.filter(status=OutboxEmail.QUEUED).count())
+        self.assertEqual(1, BackgroundJob.objects.filter(handler="wsrc.site.outbox.deliver").count())
+
+    def test_GIVEN_mail_server_failing_WHEN_delivered_THEN_retried_with_backoff_until_failed(self):
+        self.queue(1)
+        before = timezone.now()
+        with override_settings(EMAIL_BACKEND="test_outbox.FailingBackend"):
+            self.assertEqual(0, outbox.deliver())
+            outbox_email = OutboxEmail.objects.get()
+            self.assertEqual(OutboxEmail.QUEUED, outbox_email.status)
+            self.assertEqual(1, outbox_email.attempts)
+            self.assertTrue(outbox_email.send_after >= before + jobs.get_backoff(1))
+            self.assertIn("mail server unavailable", outbox_email.last_error)
+            self.assertEqual(0, outbox.deliver())
+            OutboxEmail.objects.update(attempts=outbox.MAX_ATTEMPTS - 1, send_after=timezone.now())
+            self.assertEqual(0, outbox.deliver())
+        self.assertEqual(OutboxEmail.FAILED, OutboxEmail.objects.get().status)
+        self.assertEqual([], mail.outbox)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import datetime
+import unittest
+
+import wsrc.external_sites # call __init__.py
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+
+from wsrc.site.courts.models import BookingOffence, PenaltyPoints
+from wsrc.site.usermodel.models import Player
+from wsrc.utils.timezones import UK_TZINFO
+
+class Tester(unittest.TestCase):
+
+    def setUp(self):
+        # discard every change made by each test
+        self.atomic = transaction.atomic()
+        self.atomic.__enter__()
+        user = User.objects.create_user(username="test_penalty_points", first_name="Foo", last_name="Bar")
+        self.player = Player.objects.create(user=user)
+        self.today = timezone.localtime(timezone.now()).date()
+
+    def tearDown(self):
+        transaction.set_rollback(True)
+        self.atomic.__exit__(None, None, None)
+
+    def create_offence(self, days_ago, points, is_active=True):
+        start_time = datetime.datetime.combine(self.today - datetime.timedelta(days=days_ago),
+                                               datetime.time(19, 0)).replace(tzinfo=UK_TZINFO)
+        return BookingOffence.objects.create(player=self.player, offence="lc", entry_id=days_ago, start_time=start_time,
+                                             duration_mins=45, court=1, name="Foo Bar", owner="Foo Bar",
+                                             creation_time=start_time - datetime.timedelta(days=1),
+                                             cancellation_time=start_time - datetime.timedelta(hours=1),
+                                             penalty_points=points, is_active=is_active)
+
+    def get_expected_points(self, date=None):
+        offences = BookingOffence.get_offences_for_player(self.player, date)
+        return sum([offence.penalty_points for offence in offences])
+
+    def assertLedgerMatchesOffences(self):
+        self.assertEqual(self.get_expected_points(), PenaltyPoints.get_points_for_player(self.player))
+        self.assertEqual(self.get_expected_points(), PenaltyPoints.objects.get(player=self.player).points)
+
+    def test_GIVEN_offences_WHEN_saved_THEN_ledger_counts_offences_in_window(self):
+        self.create_offence(0, 6)      # counted from tomorrow
+        self.create_offence(1, 4)
+        self.create_offence(100, 3)
+        self.create_offence(300, 2)    # expired
+        self.create_offence(2, 5, is_active=False)
+        self.assertEqual(7, self.get_expected_points())
+        self.assertLedgerMatchesOffences()
+
+    def test_GIVEN_offences_WHEN_edited_or_deleted_THEN_ledger_follows(self):
+        recent = self.create_offence(1, 4)
+        old = self.create_offence(100, 3)
+        self.create_offence(0, 6)
+        recent.penalty_points = 1
+        recent.save()
+        self.assertLedgerMatchesOffences()
+        old.is_active = False
+        old.save()
+        self.assertLedgerMatchesOffences()
+        old.is_active = True
+        old.start_time -= datetime.timedelta(days=150)
+        old.save()
+        self.assertLedgerMatchesOffences()
+        recent.delete()
+        self.assertLedgerMatchesOffences()
+        self.assertEqual(0, PenaltyPoints.get_points_for_player(self.player))
+
+    def test_GIVEN_points_changing_WHEN_aged_THEN_ledger_matches_offences_on_that_day(self):
+        self.create_offence(0, 6)
+        self.create_offence(1, 4)
+        self.create_offence(BookingOffence.CUTOFF_DAYS, 3)
+        for days in (1, 2, 3):
+            date = self.today + datetime.timedelta(days=days)
+            now = datetime.datetime.combine(date, datetime.time(3, 0)).replace(tzinfo=UK_TZINFO)
+            PenaltyPoints.age(now)
+            expected = self.get_expected_points(date - datetime.timedelta(days=1))
+            self.assertEqual(expected, PenaltyPoints.objects.get(player=self.player).points)
+
+    def test_GIVEN_change_due_WHEN_reading_points_THEN_ledger_recalculated(self):
+        self.create_offence(1, 4)
+        PenaltyPoints.objects.filter(player=self.player).update(
+            points=99, next_expiry=timezone.now() - datetime.timedelta(minutes=1))
+        self.assertEqual(4, PenaltyPoints.get_points_for_player(self.player))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import datetime
+import unittest
+
+import wsrc.external_sites # call __init__.py
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from wsrc.site.competitions.models import BoxLeagueStanding, Competition, CompetitionGroup, CompetitionType, \
+    Entrant, Match
+from wsrc.site.usermodel.models import Player
+
+class Tester(unittest.TestCase):
+
+    def setUp(self):
+        # discard every change made by each test
+        self.atomic = transaction.atomic()
+        self.atomic.__enter__()
+        comp_type, created = CompetitionType.objects.get_or_create(id="squash_boxes",
+                                                                   defaults={"name": "Squash Boxes",
+                                                                             "is_knockout_comp": False})
+        group = CompetitionGroup.objects.create(name="Test Boxes", competition_type=comp_type,
+                                                end_date=datetime.date(2001, 1, 1))
+        self.competition = Competition.objects.create(name="Box 1", end_date=group.end_date, group=group)
+        self.entrants = []
+        for i, name in enumerate(["Able", "Baker", "Charlie", "Dog"]):
+            user = User.objects.create_user(username="test_standings_{0}".format(name.lower()),
+                                            first_name=name, last_name="Test")
+            player = Player.objects.create(user=user)
+            self.entrants.append(Entrant.objects.create(competition=self.competition, player1=player, ordering=i))
+
+    def tearDown(self):
+        transaction.set_rollback(True)
+        self.atomic.__exit__(None, None, None)
+
+    def play(self, team1, team2, *scores):
+        match = Match(competition=self.competition, team1=self.entrants[team1], team2=self.entrants[team2])
+        self.set_scores(match, *scores)
+        return match
+
+    def set_scores(self, match, *scores):
+        for i in range(5):
+            score = scores[i] if i < len(scores) else (None, None)
+            setattr(match, "team1_score{0}".format(i+1), score[0])
+            setattr(match, "team2_score{0}".format(i+1), score[1])
+        match.save()
+
+    def get_standings(self):
+        return BoxLeagueStanding.get_standings([self.competition.id])
+
+    def assertStandingsMatchRebuild(self):
+        standings = self.get_standings()
+        BoxLeagueStanding.rebuild(self.competition.id)
+        self.assertEqual(self.get_standings(), standings)
+
+    def test_GIVEN_matches_WHEN_saved_THEN_standings_match_rebuild(self):
+        self.play(0, 1, (3, 1), (3, 2), (3, 0))
+        self.assertStandingsMatchRebuild()
+        self.play(2, 0, (3, 0), (3, 0), (3, 0))
+        self.play(1, 3, (3, 1), (1, 3), (3, 2))
+        self.assertStandingsMatchRebuild()
+        standings = self.get_standings()
+        self.assertEqual([2, 2, 1, 1], [standings[e.id]["played"] for e in self.entrants])
+        self.assertEqual(0, sum([standings[e.id]["drawn"] for e in self.entrants]))
+
+    def test_GIVEN_match_WHEN_edited_THEN_standings_match_rebuild(self):
+        match = self.play(0, 1, (3, 1), (3, 2), (3, 0))
+        self.play(2, 3, (3, 1), (3, 1), (3, 1))
+        self.set_scores(match, (1, 3), (2, 3), (0, 3))
+        self.assertStandingsMatchRebuild()
+        standings = self.get_standings()
+        self.assertEqual(1, standings[self.entrants[1].id]["won"])
+        self.assertEqual(0, standings[self.entrants[0].id]["won"])
+
+    def test_GIVEN_match_WHEN_deleted_THEN_standings_match_rebuild(self):
+        match = self.play(0, 1, (3, 1), (3, 2), (3, 0))
+        self.play(0, 2, (3, 1), (3, 1), (3, 1))
+        match.delete()
+        self.assertStandingsMatchRebuild()
+        standings = self.get_standings()
+        self.assertEqual(0, standings[self.entrants[1].id]["played"])
+        self.assertEqual(1, standings[self.entrants[0].id]["played"])
+        self.assertEqual(0, standings[self.entrants[0].id]["position"])
+
+if __name__ == '__main__':
+    unittest.main()
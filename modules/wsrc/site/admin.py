@@ -22,7 +22,7 @@ from django.contrib import admin
 from wsrc.site.models import PageContent, EmailContent, MaintenanceIssue,\
     Suggestion, ClubEvent, CommitteeMeetingMinutes, GenericPDFDocument, Image,\
     NavigationLink, NavigationNode, OAuthAccess, LeagueMasterFixtures, SquashLevels,\
-    NewsItem
+    NewsItem, BackgroundJob, OutboxEmail
 
 from django.contrib.admin.models import LogEntry
 admin.site.register(LogEntry)
@@ -132,6 +132,26 @@ class OAuthAdmin(CSVModelAdmin):
     get_login_link.short_description = "Temp. Access Code Link"
     get_login_link.allow_tags = True
 
+class BackgroundJobAdmin(admin.ModelAdmin):
+    list_display = ("handler", "status", "attempts", "run_after", "created", "completed")
+    list_filter = ("status", "handler")
+    actions = ("retry_jobs",)
+    def retry_jobs(self, request, queryset):
+        from django.utils import timezone
+        queryset.update(status=BackgroundJob.PENDING, attempts=0, run_after=timezone.now(), locked_until=None)
+    retry_jobs.short_description = "Retry selected jobs"
+
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = ("subject", "recipients", "status", "attempts", "created", "sent")
+    list_filter = ("status",)
+    actions = ("retry_emails",)
+    def retry_emails(self, request, queryset):
+        from django.utils import timezone
+        from wsrc.site.outbox import schedule_delivery
+        queryset.update(status=OutboxEmail.QUEUED, attempts=0, send_after=timezone.now(), locked_until=None)
+        schedule_delivery()
+    retry_emails.short_description = "Retry selected emails"
+
 admin.site.register(PageContent, PageContentAdmin)
 admin.site.register(NavigationNode, NavigationNodeAdmin)
 admin.site.register(NavigationLink, NavigationLinkAdmin)
@@ -144,6 +164,8 @@ admin.site.register(CommitteeMeetingMinutes, PDFFileAdmin)
 admin.site.register(GenericPDFDocument, PDFFileAdmin)
 admin.site.register(Image, ImageAdmin)
 admin.site.register(OAuthAccess, OAuthAdmin)
+admin.site.register(BackgroundJob, BackgroundJobAdmin)
+admin.site.register(OutboxEmail, OutboxEmailAdmin)
 
 admin.site.register(LeagueMasterFixtures, admin.ModelAdmin) 
 admin.site.register(SquashLevels, admin.ModelAdmin) 
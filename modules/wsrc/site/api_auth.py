@@ -0,0 +1,78 @@
+# This file is part of WSRC.
+#
+# WSRC is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WSRC is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WSRC.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Authentication of devices such as the kiosk, which poll the data
+API without a session.
+
+Devices may present a signed API token (X-Api-Token header) issued
+with make_api_token(), or a username and password (X-Username and
+X-Password headers). Verified credentials are cached briefly under a
+keyed hash, so that the password hasher only runs on the first of a
+series of polls."""
+
+import hashlib
+import hmac
+
+from django.contrib.auth import authenticate, get_user_model
+from django.core import signing
+from django.core.cache import cache
+
+import wsrc.site.settings.settings as settings
+
+API_TOKEN_SALT = "wsrc.site.api_auth.token"
+API_TOKEN_MAX_AGE_DAYS = 366
+CREDENTIALS_CACHE_SECS = 300
+
+
+def make_api_token(user):
+    "Return a signed token identifying USER, valid for API_TOKEN_MAX_AGE_DAYS"
+    return signing.dumps({"u": user.pk}, salt=API_TOKEN_SALT)
+
+
+def authenticate_api_token(token):
+    "Return the active user identified by TOKEN, or None if it is invalid or expired"
+    try:
+        payload = signing.loads(token, salt=API_TOKEN_SALT, max_age=API_TOKEN_MAX_AGE_DAYS * 24 * 60 * 60)
+    except signing.BadSignature:
+        return None
+    return get_user_model().objects.filter(pk=payload.get("u"), is_active=True).first()
+
+
+def _credentials_cache_key(username, password):
+    digest = hmac.new(settings.SECRET_KEY, u"{0}\0{1}".format(username, password).encode("utf-8"),
+                      hashlib.sha256).hexdigest()
+    return "api_auth.credentials." + digest
+
+
+def authenticate_credentials(username, password):
+    "True if USERNAME and PASSWORD are valid, consulting the cache of recently verified credentials first"
+    if not username or not password:
+        return False
+    key = _credentials_cache_key(username, password)
+    if cache.get(key):
+        return True
+    user = authenticate(username=username, password=password)
+    if user is None:
+        return False
+    cache.set(key, True, CREDENTIALS_CACHE_SECS)
+    return True
+
+
+def is_device_authenticated(request):
+    "True if the request carries a valid API token or valid username/password headers"
+    token = request.META.get("HTTP_X_API_TOKEN")
+    if token:
+        return authenticate_api_token(token) is not None
+    return authenticate_credentials(request.META.get("HTTP_X_USERNAME"), request.META.get("HTTP_X_PASSWORD"))
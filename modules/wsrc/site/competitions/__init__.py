@@ -12,3 +12,4 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with WSRC.  If not, see <http://www.gnu.org/licenses/>.
+default_app_config = 'wsrc.site.competitions.apps.CompetitionsAppConfig'
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 11:36
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('competitions', '0006_auto_20180627_1906'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BoxLeagueStanding',
+            fields=[
+                ('entrant', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='standing', serialize=False, to='competitions.Entrant')),
+                ('played', models.IntegerField(default=0)),
+                ('won', models.IntegerField(default=0)),
+                ('drawn', models.IntegerField(default=0)),
+                ('lost', models.IntegerField(default=0)),
+                ('games_for', models.IntegerField(default=0)),
+                ('games_against', models.IntegerField(default=0)),
+                ('points', models.IntegerField(default=0)),
+                ('position', models.IntegerField(default=0, help_text=b'Zero-based position in the league table')),
+                ('competition', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='standings', to='competitions.Competition')),
+            ],
+            options={
+                'ordering': ['competition', 'position'],
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='boxleaguestanding',
+            index_together=set([('competition', 'position')]),
+        ),
+    ]
@@ -13,7 +13,7 @@
 # You should have received a copy of the GNU General Public License
 # along with WSRC.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.db import models
+from django.db import models, transaction
 from django.core.exceptions import ValidationError, NON_FIELD_ERRORS
 import wsrc.utils.bracket
 
@@ -200,6 +200,10 @@ class Match(models.Model):
     walkover = models.IntegerField(blank=True, null=True, choices=WALKOVER_RESULTS)
     last_updated = models.DateTimeField(auto_now=True)
 
+    # the fields determining the match's result
+    RESULT_FIELDS = ["competition_id", "team1_id", "team2_id", "walkover"] +\
+                    ["team{0}_score{1}".format(team, n) for team in (1, 2) for n in range(1, 6)]
+
     def __init__(self, *args, **kwargs):
         super(Match, self).__init__(*args, **kwargs)
         self.cached_scores = None
@@ -208,6 +212,46 @@ class Match(models.Model):
         self.cached_scores = self.get_scores()
         return self
 
+    def remember_saved_state(self):
+        """Record the result held in the database, which the standings
+        count, before it is changed. It is read afresh rather than kept
+        from when this instance was loaded, which may be out of date."""
+        self._saved_state = None
+        if self.pk is not None:
+            self._saved_state = Match.objects.filter(pk=self.pk).values(*self.RESULT_FIELDS).first()
+
+    def get_saved_result(self):
+        "This match as last saved, or None if it has not been"
+        state = getattr(self, "_saved_state", None)
+        if state is None:
+            return None
+        return Match(**state)
+
+    def get_standing_totals(self):
+        "This match's contribution to each entrant's BoxLeagueStanding, by entrant id"
+        if self.team1_id is None or self.team2_id is None:
+            return {}
+        scores = self.get_scores()
+        points = self.get_box_league_points(scores)
+        winner = self.get_winner(scores, key_only=True)
+        totals = dict()
+        for idx, (entrant_id, other_id) in enumerate([(self.team1_id, self.team2_id), (self.team2_id, self.team1_id)]):
+            other_idx = 1 if idx == 0 else 0
+            entrant_totals = dict.fromkeys(BoxLeagueStanding.TOTAL_FIELDS, 0)
+            entrant_totals["played"] = 1
+            if entrant_id == winner:
+                entrant_totals["won"] = 1
+            elif other_id == winner:
+                entrant_totals["lost"] = 1
+            else:
+                entrant_totals["drawn"] = 1
+            for s in scores:
+                entrant_totals["games_for"] += s[idx] or 0
+                entrant_totals["games_against"] += s[other_idx] or 0
+            entrant_totals["points"] = points[idx]
+            totals[entrant_id] = entrant_totals
+        return totals
+
     def clean(self):
         """Validates the model before it is saved to the database - used when
            data is uploaded in forms e.g. by the generic admin pages."""
@@ -396,6 +440,139 @@ class Match(models.Model):
         verbose_name_plural = "matches"
 
 
+class BoxLeagueStanding(models.Model):
+    """An entrant's record in a box league - matches played, won, drawn
+    and lost, games for and against, and points - and position in the
+    league table. Kept up to date as matches are saved and deleted, so
+    that the boxes pages read ordered rows instead of totalling and
+    sorting every match for every visitor."""
+    entrant = models.OneToOneField(Entrant, on_delete=models.CASCADE, primary_key=True, related_name="standing")
+    competition = models.ForeignKey(Competition, on_delete=models.CASCADE, related_name="standings")
+    played = models.IntegerField(default=0)
+    won = models.IntegerField(default=0)
+    drawn = models.IntegerField(default=0)
+    lost = models.IntegerField(default=0)
+    games_for = models.IntegerField(default=0)
+    games_against = models.IntegerField(default=0)
+    points = models.IntegerField(default=0)
+    position = models.IntegerField(default=0, help_text="Zero-based position in the league table")
+
+    TOTAL_FIELDS = ("played", "won", "drawn", "lost", "games_for", "games_against", "points")
+
+    @staticmethod
+    def is_box_league(competition):
+        return competition.group is not None and not competition.group.competition_type.is_knockout_comp
+
+    @staticmethod
+    def get_head_to_head_index(matches):
+        "Map each pair of entrant ids, lowest first, to the id of the winner of their match"
+        index = dict()
+        for match in matches:
+            pair = tuple(sorted([match.team1_id, match.team2_id]))
+            index.setdefault(pair, match.get_winner(key_only=True))
+        return index
+
+    @classmethod
+    def get_standings(clazz, competition_ids):
+        "The standings of the given competitions, as dicts by entrant id"
+        rows = clazz.objects.filter(competition_id__in=competition_ids)\
+                            .values("entrant_id", "competition_id", "position", *clazz.TOTAL_FIELDS)
+        return dict([(row["entrant_id"], row) for row in rows])
+
+    @classmethod
+    def update_for_match(clazz, match, deleted=False):
+        "Apply the change in MATCH's result since it was last saved - or its deletion - to the standings"
+        deltas = dict()
+        def add(result, sign):
+            for entrant_id, totals in result.get_standing_totals().iteritems():
+                entrant_deltas = deltas.setdefault((result.competition_id, entrant_id),
+                                                   dict.fromkeys(clazz.TOTAL_FIELDS, 0))
+                for field, n in totals.iteritems():
+                    entrant_deltas[field] += sign * n
+        previous = match.get_saved_result()
+        if previous is not None:
+            add(previous, -1)
+        elif deleted:
+            # not known what was counted for it
+            clazz.rebuild(match.competition_id)
+            return
+        if not deleted:
+            add(match, 1)
+        competition_ids = set([competition_id for competition_id, entrant_id in deltas.iterkeys()])
+        stale = set()
+        with transaction.atomic():
+            for (competition_id, entrant_id), entrant_deltas in deltas.iteritems():
+                changes = dict([(field, models.F(field) + n) for field, n in entrant_deltas.iteritems() if n != 0])
+                if changes and not clazz.objects.filter(entrant_id=entrant_id).update(**changes):
+                    # no standing yet - the match is already saved, so it is included
+                    stale.add(competition_id)
+            for competition_id in competition_ids:
+                if competition_id in stale:
+                    clazz.rebuild(competition_id)
+                else:
+                    clazz.rank(competition_id)
+
+    @classmethod
+    def rebuild(clazz, competition_id):
+        "Recalculate the standings of a competition from all of its matches"
+        totals = dict([(entrant_id, dict.fromkeys(clazz.TOTAL_FIELDS, 0)) for entrant_id in
+                       Entrant.objects.filter(competition_id=competition_id).values_list("id", flat=True)])
+        for match in Match.objects.filter(competition_id=competition_id):
+            for entrant_id, match_totals in match.get_standing_totals().iteritems():
+                if entrant_id in totals:
+                    for field, n in match_totals.iteritems():
+                        totals[entrant_id][field] += n
+        with transaction.atomic():
+            clazz.objects.filter(competition_id=competition_id).exclude(entrant_id__in=totals.keys()).delete()
+            for entrant_id, entrant_totals in totals.iteritems():
+                defaults = dict(entrant_totals, competition_id=competition_id)
+                clazz.objects.update_or_create(entrant_id=entrant_id, defaults=defaults)
+            clazz.rank(competition_id)
+
+    @classmethod
+    def rank(clazz, competition_id):
+        """Re-order the league table of a competition by points, then the
+        result of the match between the tied entrants, then matches
+        played, game difference and finally name"""
+        standings = list(clazz.objects.filter(competition_id=competition_id).select_related("entrant__player1__user"))
+        head_to_head = clazz.get_head_to_head_index(Match.objects.filter(competition_id=competition_id))
+
+        def cmp_head_to_head(lhs, rhs):
+            winner_id = head_to_head.get(tuple(sorted([lhs.entrant_id, rhs.entrant_id])))
+            if winner_id == lhs.entrant_id:
+                return 1
+            if winner_id == rhs.entrant_id:
+                return -1
+            return 0
+
+        def fair_compare(lhs, rhs):
+            diff = lhs.points - rhs.points
+            if diff == 0:
+                diff = cmp_head_to_head(lhs, rhs)
+            if diff == 0:
+                diff = lhs.played - rhs.played
+            if diff == 0:
+                diff = (lhs.games_for - lhs.games_against) - (rhs.games_for - rhs.games_against)
+            if diff == 0:
+                diff = -1 * cmp(lhs.entrant.player1.user.last_name, rhs.entrant.player1.user.last_name)
+            if diff == 0:
+                diff = -1 * cmp(lhs.entrant.player1.user.first_name, rhs.entrant.player1.user.first_name)
+            return int(diff)
+
+        standings.sort(cmp=fair_compare, reverse=True)
+        with transaction.atomic():
+            for position, standing in enumerate(standings):
+                if standing.position != position:
+                    clazz.objects.filter(pk=standing.pk).update(position=position)
+
+    def __unicode__(self):
+        return u"{0} {1}".format(self.position + 1, self.entrant)
+
+    class Meta:
+        ordering = ["competition", "position"]
+        index_together = [("competition", "position")]
+
+
 class CompetitionRound(models.Model):
     """A "round" in a competition. This is used only for tournaments"""
     competition = models.ForeignKey(Competition, related_name="rounds", on_delete=models.CASCADE)
@@ -0,0 +1,49 @@
+# This file is part of WSRC.
+#
+# WSRC is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WSRC is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WSRC.  If not, see <http://www.gnu.org/licenses/>.
+
+"Keep the box league standings in step with the matches and entrants"
+
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from .models import BoxLeagueStanding, Competition, Entrant, Match
+
+@receiver(pre_save, sender=Match, dispatch_uid="7c4e1a2b3d5f11f1a9e00242ac120001")
+@receiver(pre_delete, sender=Match, dispatch_uid="7c4e1a2b3d5f11f1a9e00242ac120006")
+def remember_match_result(sender, instance, raw=False, *args, **kwargs):
+    if not raw:
+        instance.remember_saved_state()
+
+@receiver(post_save, sender=Match, dispatch_uid="7c4e1a2b3d5f11f1a9e00242ac120002")
+def update_standings(sender, instance, raw=False, *args, **kwargs):
+    if not raw and BoxLeagueStanding.is_box_league(instance.competition):
+        BoxLeagueStanding.update_for_match(instance)
+
+@receiver(post_delete, sender=Match, dispatch_uid="7c4e1a2b3d5f11f1a9e00242ac120003")
+def remove_from_standings(sender, instance, *args, **kwargs):
+    competition = Competition.objects.filter(pk=instance.competition_id).select_related("group__competition_type").first()
+    # nothing to do when the whole competition is being deleted
+    if competition is not None and BoxLeagueStanding.is_box_league(competition):
+        BoxLeagueStanding.update_for_match(instance, deleted=True)
+
+@receiver(post_save, sender=Entrant, dispatch_uid="7c4e1a2b3d5f11f1a9e00242ac120004")
+def add_to_standings(sender, instance, raw=False, *args, **kwargs):
+    # the entrant may be new, or a different player who sorts differently
+    if not raw and BoxLeagueStanding.is_box_league(instance.competition):
+        BoxLeagueStanding.rebuild(instance.competition_id)
+
+@receiver(post_delete, sender=Entrant, dispatch_uid="7c4e1a2b3d5f11f1a9e00242ac120005")
+def rerank_standings(sender, instance, *args, **kwargs):
+    BoxLeagueStanding.rank(instance.competition_id)
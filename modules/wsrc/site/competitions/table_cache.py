@@ -0,0 +1,75 @@
+# This file is part of WSRC.
+#
+# WSRC is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WSRC is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WSRC.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Cache of the rendered box, league and results tables.
+
+The tables of a competition are cached under a key made from what they
+show: the latest update to and number of its matches, its entrants and
+their standings as given to the viewer (with names obfuscated or not),
+and the variant of the tables - the view, whether entrants link to the
+member list, and the size of the boxes. Entering a score, or changing
+the entrants, therefore makes a new key. Stale entries are never
+deleted, they simply stop being looked up and expire.
+
+The tables are cached without the current user's highlight, which is
+added to the cached HTML by highlight_player().
+"""
+
+import hashlib
+import re
+
+from django.core.cache import cache
+from django.db.models import Count, Max
+
+from .models import Match
+
+# changed when the cached value changes form
+KEY_PREFIX = "competitions.tables.2"
+TIMEOUT_SECS = 24 * 3600
+CURRENT_USER_CLASS = "wsrc-currentuser"
+
+
+def get_match_summaries(competition_ids):
+    "The time of the latest update to, and number of, the matches of each competition, by id"
+    rows = Match.objects.filter(competition_id__in=competition_ids).order_by().values("competition_id")\
+                        .annotate(latest=Max("last_updated"), n=Count("id"))
+    return dict([(row["competition_id"], (row["latest"], row["n"])) for row in rows])
+
+
+def get_or_set(competition, match_summary, entrants, variant, factory):
+    """Return the cached tables of COMPETITION for the given matches,
+    ENTRANTS and VARIANT, calling FACTORY() to render and store them
+    when absent. VARIANT is a tuple distinguishing the different
+    renderings of the same data."""
+    content = (competition.name, competition.state, match_summary,
+               sorted([sorted(entrant.iteritems()) for entrant in entrants]))
+    key = "{prefix}.{id}.{variant}.{digest}".format(
+        prefix=KEY_PREFIX,
+        id=competition.id,
+        variant=".".join([str(v) for v in variant]),
+        digest=hashlib.sha1(repr(content)).hexdigest()
+    )
+    value = cache.get(key)
+    if value is None:
+        value = factory()
+        cache.set(key, value, TIMEOUT_SECS)
+    return value
+
+
+def highlight_player(html, player_id):
+    "Mark the entrant cells of the player PLAYER_ID in the table HTML as the current user's"
+    def mark(match):
+        return re.sub(r'class="([^"]*)"', r'class="\1 ' + CURRENT_USER_CLASS + '"', match.group(0), count=1)
+    return re.sub(r'<th [^>]*\bdata-player_id="{0}"[^>]*>'.format(player_id), mark, html)
@@ -21,7 +21,8 @@ from django.db.models import Q
 from .forms import MatchScoresForm
 from wsrc.site.models import EmailContent
 from wsrc.site.usermodel.models import Player
-from wsrc.site.competitions.models import Competition, CompetitionGroup, Match, Entrant
+from wsrc.site.competitions.models import BoxLeagueStanding, Competition, CompetitionGroup, Match, Entrant
+from wsrc.site.competitions import table_cache
 from wsrc.site.competitions.serializers import CompetitionSerializer, CompetitionGroupSerializer, MatchSerializer, EntrantSerializer
 from wsrc.utils.html_table import Table, Cell, SpanningCell, merge_classes
 from wsrc.utils.markdown_utils import RedactedLinkExtension
@@ -29,6 +30,7 @@ from wsrc.utils.text import obfuscate
 from wsrc.utils.timezones import parse_iso_date_to_naive
 from wsrc.utils.sync_utils import dotted_lookup
 from wsrc.utils import email_utils
+from wsrc.utils.xlsx_export import write_temporary_workbook
 
 
 from django.contrib.auth.decorators import login_required
@@ -37,9 +39,10 @@ from django.urls import reverse
 from django.shortcuts import get_object_or_404
 from django.shortcuts import render
 from django.template import Template, Context
+from django.template.loader import render_to_string
 from django.template.response import TemplateResponse
 from django.forms import ModelForm, ModelChoiceField
-from django.http import HttpResponse, HttpResponseBadRequest
+from django.http import FileResponse, HttpResponse, HttpResponseBadRequest
 from django.views.decorators.http import require_GET
 from django.views.generic import TemplateView, View
 from django.views.generic.edit import UpdateView, CreateView
@@ -258,14 +261,11 @@ class BoxesViewBase(object):
 class BoxesExcelView(BoxesViewBase, View):
 
     @staticmethod
-    def create_spreadsheet(comp_group, boxes_config):
-        import xlsxwriter
+    def write_spreadsheet(workbook, comp_group, boxes_config):
         from django.contrib.staticfiles import finders
         cell_width = 5
         title_row_height = 20
         row_height = 18
-        output = StringIO.StringIO()
-        workbook = xlsxwriter.Workbook(output, {'in_memory': True})
         title_format        = workbook.add_format({'align': 'right',  'valign': 'top',     'bold': True,  'border': 0})
         header_format       = workbook.add_format({'align': 'center', 'valign': 'vcenter', 'bold': True,  'border': 2})
         entrant_format      = workbook.add_format({'align': 'left',   'valign': 'vcenter', 'bold': False, 'indent': 0, 'left': 1, 'right': 1})
@@ -280,6 +280,10 @@ class BoxesExcelView(BoxesViewBase, View):
             absolute_path = os.path.join("/usr/local/www", image_path)
         worksheet.insert_image(0, 0, absolute_path, {'positioning': 3, 'x_scale': 0.4, 'y_scale': 0.4})
         row += 3
+        # boxes side by side share rows, but the worksheet is streamed in
+        # row order, so lay out all the cells before writing them
+        cells = []
+        row_heights = dict()
         for box in boxes_config:
             row_reset = None
             if box['colspec'] == "single":
@@ -289,21 +293,24 @@ class BoxesExcelView(BoxesViewBase, View):
             else:
                 row_reset = row
                 col = 0
-            worksheet.set_row(row, title_row_height)
-            worksheet.merge_range(row, col, row, col + cell_width-1, box['name'], header_format)
+            row_heights[row] = title_row_height
+            cells.append((row, col, box['name'], header_format))
             row += 1
             entrants = box['entrants']
             for (i,e) in enumerate(entrants):
-                worksheet.set_row(row, row_height)
+                row_heights[row] = row_height
                 fmt = (i+1) < len(entrants) and entrant_format or last_entrant_format
-                worksheet.merge_range(row, col, row, col + cell_width-1, "{full_name}".format(**e), fmt)
+                cells.append((row, col, "{full_name}".format(**e), fmt))
                 row += 1
             if row_reset is not None:
                 row = row_reset
             else:
                 row += 1
-        workbook.close()
-        return output.getvalue()
+        cells.sort(key=lambda cell: (cell[0], cell[1]))
+        for (row, col, text, fmt) in cells:
+            if row in row_heights:
+                worksheet.set_row(row, row_heights.pop(row))
+            worksheet.merge_range(row, col, row, col + cell_width-1, text, fmt)
 
     def get(self, request, *args, **kwargs):
         (group, possible_groups) = self.get_competition_group(*args)
@@ -320,9 +327,9 @@ class BoxesExcelView(BoxesViewBase, View):
             cfg["entrants"] = entrants
             boxes.append(cfg)
             previous_cfg = cfg
-        payload = self.create_spreadsheet(group, boxes)
+        payload = write_temporary_workbook(lambda workbook: self.write_spreadsheet(workbook, group, boxes))
         content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        response = HttpResponse(payload, content_type=content_type)
+        response = FileResponse(payload, content_type=content_type)
         response['Content-Disposition'] = 'attachment; filename="boxes_{date:%Y-%m-%d}.xlsx"'.format(date=group.end_date)
         return response
 
@@ -331,76 +338,24 @@ class BoxesTemplateViewBase(BoxesViewBase, TemplateView):
     box_table_attrs = {}
     league_table_attrs= {}
     table_body_attrs = None
+    highlight_current_user = True
+    # template listing each box's results, if the view shows them
+    results_template = None
 
-    @staticmethod
-    def enrich_entrants(entrants, matches):
-        entrants = dict([(e["id"], e) for e in entrants])
-        for e in entrants.values():
-            e["Pts"] = e["P"] = e["F"] = e["A"] = 0
-        def append(entrant, field, n):
-            points = entrant.get(field) or 0
-            points += n
-            entrant[field] = points
-        for match in matches:
-            e1 = entrants[match.team1_id]
-            e2 = entrants[match.team2_id]
-            scores = match.get_scores()
-            points = match.get_box_league_points(scores)
-            winner = match.get_winner(scores, True)
-            def totalize(entrant, other_entrant, idx):
-                other_idx = 1 if idx == 0 else 0
-                append(entrant, "P", 1)
-                if entrant["id"] == winner:
-                    append(entrant, "W", 1)
-                elif other_entrant["id"] == winner:
-                    append(entrant, "L", 1)
-                else:
-                    append(entrant, "D", 1)
-                for s in scores:
-                    append(entrant, "F", s[idx])
-                    append(entrant, "A", s[other_idx])
-                append(entrant, "Pts", points[idx])
-            totalize(e1, e2, 0)
-            totalize(e2, e1, 1)
-        return entrants
+    STANDING_COLUMNS = (("P", "played"), ("W", "won"), ("D", "drawn"), ("L", "lost"),
+                        ("F", "games_for"), ("A", "games_against"), ("Pts", "points"))
 
-    @staticmethod
-    def sort_entrants(entrants, matches):
-        def cmp_head_to_head_match(lhs, rhs):
-            matched_match = None
-            for match in matches:
-                if match.team1_id == lhs["id"] and match.team2_id == rhs["id"] or\
-                   match.team2_id == lhs["id"] and match.team1_id == rhs["id"]:
-                    matched_match = match
-                    break
-            if matched_match is None:
-                return 0
-            winner_id = matched_match.get_winner(key_only=True)            
-            if winner_id == lhs["id"]:
-                return 1
-            if winner_id == rhs["id"]:
-                return -1
-            return 0
-                
-        entrants = list(entrants)
-        def fair_compare(lhs, rhs):
-            diff = lhs["Pts"] - rhs["Pts"]
-            if diff == 0:
-                diff = cmp_head_to_head_match(lhs, rhs)
-            if diff == 0:
-                diff = lhs["P"] - rhs["P"]
-            if diff == 0:
-                diff = (lhs["F"] - lhs["A"]) - (rhs["F"] - rhs["A"])
-            if diff == 0:
-                diff = -1 * cmp(lhs["player1__user__last_name"],  rhs["player1__user__last_name"])
-            if diff == 0:
-                diff = -1 * cmp(lhs["player1__user__first_name"],  rhs["player1__user__first_name"])
-            return int(diff)
-                
-        entrants.sort(cmp=fair_compare, reverse=True)
-        return entrants
-    
-    def create_entrant_cell(self, entrant, auth_user_id):
+    @classmethod
+    def add_standings(cls, entrants, standings):
+        "Copy each entrant's standing into the league table columns, returning them in league order"
+        for e in entrants:
+            standing = standings[e["id"]]
+            for column, field in cls.STANDING_COLUMNS:
+                e[column] = standing[field]
+            e["position"] = standing["position"]
+        return sorted(entrants, key=itemgetter("position"))
+
+    def create_entrant_cell(self, entrant, show_links):
         cls = "" if entrant["player1__user__is_active"] else "inactive"
         content=u"<span class='{cls}'>{full_name}</span>".format(full_name=entrant["full_name"], cls=cls)
         attrs={
@@ -408,13 +363,11 @@ class BoxesTemplateViewBase(BoxesViewBase, TemplateView):
             "data-player_id":  str(entrant["player1__id"]),
             "data-entrant_id": str(entrant["id"]),
         }
-        if auth_user_id is not None:
+        if show_links:
             content = u"<a href='{url}?filter-ids={id}'>{content}</a>".format(url=reverse("member_list"), id=entrant["player1__id"], content=content)
-            if auth_user_id == entrant["player1__user__id"]:
-                merge_classes(attrs, "wsrc-currentuser")
         return Cell(content, attrs, isHeader=True, isHTML=True)
 
-    def create_box_table(self, competition, n, entrants, matches, auth_user_id):
+    def create_box_table(self, competition, n, entrants, matches, show_links):
         entrants = list(entrants)
         entrants.sort(key=itemgetter("ordering"))
         entrant_id_to_index_map = dict([(e["id"], i) for i,e in enumerate(entrants)])
@@ -433,7 +386,7 @@ class BoxesTemplateViewBase(BoxesViewBase, TemplateView):
             table.addCell(Cell(content="", attrs={"class": "inverse"}, isHeader=True),  i+2, i+1)
         table.addCell(Cell("<span>&Sigma;</span>", attrs={"class": "inverse"}, isHTML=True) , n+2, 0)
         for i, entrant in enumerate(entrants):
-            cell = self.create_entrant_cell(entrant, auth_user_id)
+            cell = self.create_entrant_cell(entrant, show_links)
             table.addCell(cell, 0, i+1)
         for i in range(len(entrants), n):
             table.addCell(Cell("", {"class": "player"}, isHeader=True), 0, i+1)
@@ -448,7 +401,7 @@ class BoxesTemplateViewBase(BoxesViewBase, TemplateView):
             table.addCell(Cell(entrant.get("Pts") or 0, {"class": "points"}), n+2, i+1)
         return table.toHtmlString(self.get_table_head(competition), self.table_body_attrs)
 
-    def create_league_table(self, competition, entrants, auth_user_id):
+    def create_league_table(self, competition, entrants, show_links):
         attrs = {
             "data-id": str(competition.id),
             "data-name": competition.name,
@@ -463,7 +416,7 @@ class BoxesTemplateViewBase(BoxesViewBase, TemplateView):
             table.addCell(Cell(field, attrs={"class": "inverse"}, isHeader=True) , i+1, 0)
         attrs = {}
         for i, entrant in enumerate(entrants):
-            cell = self.create_entrant_cell(entrant, auth_user_id)
+            cell = self.create_entrant_cell(entrant, show_links)
             table.addCell(cell, 0, i+1)
             for j,field in enumerate(fields):
                 cls = "number points" if field == "Pts" else "number"
@@ -503,36 +456,61 @@ class BoxesTemplateViewBase(BoxesViewBase, TemplateView):
         context["boxes"] = boxes = []
         max_players = 0
         previous_cfg = None
-        all_matches = Match.objects.filter(competition__group=most_recent_group).select_related("team1__player1__user", "team2__player1__user")
-        all_matches = [m.cache_scores() for m in all_matches]
         all_entrants = self.get_all_entrants(most_recent_group, self.request.user.is_authenticated())
         all_leagues = []
         if most_recent_group is not None:
             all_leagues = [c for c in most_recent_group.competition_set.all()] 
+        standings = BoxLeagueStanding.get_standings([comp.id for comp in all_leagues])
         for comp in all_leagues:
-            matches = [m for m in all_matches if m.competition_id==comp.id]
             entrants = [e for e in all_entrants if e['competition_id']==comp.id]
-            self.enrich_entrants(entrants, matches)
-            sorted_entrants = self.sort_entrants(entrants, matches)
+            if any([e["id"] not in standings for e in entrants]):
+                # standings not yet built - existing leagues after migrating, or
+                # entrants added without signals being sent, e.g. by a fixture
+                BoxLeagueStanding.rebuild(comp.id)
+                standings.update(BoxLeagueStanding.get_standings([comp.id]))
+            sorted_entrants = self.add_standings(entrants, standings)
             max_players = max(max_players, len(entrants))
             cfg = self.create_box_config(previous_cfg, comp, entrants, auth_user_id, is_editor)
             cfg["competition"] = comp
             cfg["entrants"] = entrants
             cfg["sorted_entrants"] = sorted_entrants
-            cfg["matches"] = matches
             boxes.append(cfg)
             previous_cfg = cfg
+        show_links = auth_user_id is not None and "no_navigation" not in self.request.GET # remove player links from this table
+        variant = (self.__class__.__name__, self.request.user.is_authenticated(), show_links, max_players)
+        # the tables are cached without the current user's highlight, which is added afterwards
+        current_player_ids = set()
+        if show_links and self.highlight_current_user:
+            current_player_ids = set([e["player1__id"] for e in all_entrants if e["player1__user__id"] == auth_user_id])
+        match_summaries = table_cache.get_match_summaries([comp.id for comp in all_leagues])
         for box in boxes:
-            if "no_navigation" in self.request.GET: # remove player links from this table
-                auth_user_id = None
-            box["box_table"]    = self.create_box_table(box["competition"], max_players, box["entrants"], box["matches"], auth_user_id)
-            box["league_table"] = self.create_league_table(box["competition"], box["sorted_entrants"], auth_user_id)
+            comp = box["competition"]
+            def render_tables(box=box, comp=comp):
+                # the matches are only needed when the tables are not cached
+                matches = Match.objects.filter(competition=comp).select_related("team1__player1__user", "team2__player1__user")
+                matches = [m.cache_scores() for m in matches]
+                results_table = None
+                if self.results_template is not None:
+                    results_table = render_to_string(self.results_template, {
+                        "matches": matches, "is_authenticated": self.request.user.is_authenticated()})
+                return (self.create_box_table(comp, max_players, box["entrants"], matches, show_links),
+                        self.create_league_table(comp, box["sorted_entrants"], show_links),
+                        results_table)
+            box_table, league_table, results_table = table_cache.get_or_set(comp, match_summaries.get(comp.id),
+                                                                            box["entrants"], variant, render_tables)
+            for player_id in current_player_ids:
+                box_table = table_cache.highlight_player(box_table, player_id)
+                league_table = table_cache.highlight_player(league_table, player_id)
+            box["box_table"]    = box_table
+            box["league_table"] = league_table
+            box["results_table"] = results_table
 
         self.add_selector(context, possible_groups, most_recent_group)
         return context
 
 class BoxesUserView(BoxesTemplateViewBase):
     template_name = "boxes.html"
+    results_template = "boxes_results.html"
     league_table_attrs = {}
     reverse_url_name = "boxes"
 
@@ -555,6 +533,7 @@ class BoxesAdminView(BoxesTemplateViewBase):
     box_table_attrs = {"class": " ui-helper-hidden"}
     table_body_attrs = {"class": "ui-widget-content"}
     reverse_url_name = "boxes_admin"
+    highlight_current_user = False
 
     def get(self, request, *args, **kwargs):
         if (request.user.groups.filter(name="Competition Editor").count() == 0 and not request.user.is_superuser):
@@ -565,8 +544,8 @@ class BoxesAdminView(BoxesTemplateViewBase):
     def get_table_head(self, comp):
         return "<caption class='ui-widget-header'>{comp.name}<button class='small auto'>Auto-Populate</button></caption>".format(**locals())
 
-    def create_entrant_cell(self, entrant, auth_user_id):
-        cell = super(BoxesAdminView, self).create_entrant_cell(entrant, None)
+    def create_entrant_cell(self, entrant, show_links):
+        cell = super(BoxesAdminView, self).create_entrant_cell(entrant, False)
         cell.content += " [{id}]".format(id=entrant["player1__id"])
         return cell
 
@@ -912,7 +891,7 @@ class SendCompetitionEmail(CompetitionEditorPermissionedAPIView):
         context["content_type"] = "text/plain"
         text_body = email_template.render(context)
 
-        email_utils.send_email(subject, text_body, html_body, from_address, to_list, bcc_list=bcc_list)
+        email_utils.queue_email(subject, text_body, html_body, from_address, to_list, bcc_list=bcc_list)
         return HttpResponse(status=204)
 
 class UpdateTournament(CompetitionEditorPermissionedAPIView):
@@ -24,7 +24,7 @@ from django.shortcuts import redirect
 from django.utils import timezone
 
 from wsrc.site.courts.models import BookingOffence, EventFilter, BookingSystemEvent, ClimateMeasurement, \
-    CondensationLocation, CondensationReport, BookingSystemEventAuditEntry
+    CondensationLocation, CondensationReport, BookingSystemEventAuditEntry, PenaltyPoints
 from wsrc.site.usermodel.models import Player
 from wsrc.utils import timezones
 from wsrc.utils.admin_utils import CSVModelAdmin
@@ -53,10 +53,25 @@ class OffendersListFilter(admin.SimpleListFilter):
 
 def set_inactive(modeladmin, request, queryset):
     queryset.update(is_active=False)
+    PenaltyPoints.recalculate(queryset.values_list("player_id", flat=True).distinct())
 
 
 def set_active(modeladmin, request, queryset):
     queryset.update(is_active=True)
+    PenaltyPoints.recalculate(queryset.values_list("player_id", flat=True).distinct())
+
+
+def cancel_bookings(modeladmin, request, queryset):
+    "Cancel the selected bookings, notifying interested players of them all at once"
+    from wsrc.site import jobs
+    from wsrc.site.courts.cancel_notifier import send_cancellation_digests
+    with transaction.atomic():
+        for booking in queryset.filter(is_active=True):
+            booking.is_active = False
+            booking.last_updated_by = request.user
+            booking.save()
+        jobs.enqueue_once(send_cancellation_digests)
+cancel_bookings.short_description = "Cancel selected bookings"
 
 
 class BookingOffenceAdmin(CSVModelAdmin):
@@ -77,6 +92,35 @@ class BookingOffenceAdmin(CSVModelAdmin):
         return queryset
 
 
+class NearPointLimitListFilter(admin.SimpleListFilter):
+    title = "point limit"
+    parameter_name = "near_limit"
+
+    def lookups(self, request, model_admin):
+        return [("1", "At or near limit")]
+
+    def queryset(self, request, queryset):
+        if self.value() == "1":
+            queryset = queryset.filter(pk__in=PenaltyPoints.get_players_near_limit().values("pk"))
+        return queryset
+
+
+def recalculate_points(modeladmin, request, queryset):
+    PenaltyPoints.recalculate(queryset.values_list("player_id", flat=True))
+recalculate_points.short_description = "Recalculate selected totals"
+
+
+class PenaltyPointsAdmin(admin.ModelAdmin):
+    list_display = ("player", "points", "next_expiry")
+    list_filter = (NearPointLimitListFilter,)
+    list_select_related = ("player__user",)
+    readonly_fields = ("player", "points", "next_expiry")
+    actions = (recalculate_points,)
+
+    def has_add_permission(self, request):
+        return False
+
+
 class UserModelChoiceField(forms.ModelChoiceField):
     def label_from_instance(self, obj):
         return Player.make_ordered_name(obj.last_name, obj.first_name)
@@ -121,6 +165,7 @@ class BookingAdmin(CSVModelAdmin):
     list_select_related = ("created_by__user",)
     save_as = True
     inlines = (BookingAuditInline,)
+    actions = (cancel_bookings,)
 
     def get_queryset(self, request):
         qs = super(BookingAdmin, self).get_queryset(request)
@@ -242,6 +287,7 @@ class CondensationReportAdmin(CSVModelAdmin):
 
 admin.site.register(BookingSystemEvent, BookingAdmin)
 admin.site.register(BookingOffence, BookingOffenceAdmin)
+admin.site.register(PenaltyPoints, PenaltyPointsAdmin)
 admin.site.register(EventFilter, NotifierEventAdmin)
 admin.site.register(ClimateMeasurement, ClimateMeasurementAdmin)
 admin.site.register(CondensationLocation, CondensationLocationAdmin)
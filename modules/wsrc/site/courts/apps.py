@@ -22,5 +22,5 @@ class CourtsModelAppConfig(AppConfig):
     def ready(self):
         import wsrc.site.settings.settings as settings
         if hasattr(settings, "BOOKING_SYSTEM_STARTS_ENDS"):
-            import signal
+            from . import signals
         
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+# This file is part of WSRC.
+#
+# WSRC is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WSRC is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WSRC.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark of the court booking views when bookings open.
+
+Creates a separate database, as the test runner does, and seeds it
+with a synthetic club - players, a season of past bookings with their
+audit entries - and then has a
+number of threads, each logged in as a different player, book, cancel
+and view courts on the newly bookable day at the same time, through
+the Django test client. Reports latency percentiles and queries per
+request for each kind of request, and the booking conflict rate. The
+database is destroyed afterwards unless asked to keep it, so the
+configured database is never written to.
+"""
+
+import collections
+import datetime
+import logging
+import os.path
+import random
+import tempfile
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, setup_test_environment
+from django.urls import reverse
+from django.utils import timezone
+
+import wsrc.site.settings.settings as settings
+from wsrc.site.courts.models import BookingSystemEvent, BookingSystemEventAuditEntry
+from wsrc.site.courts.usage_categories import classify_booking
+from wsrc.site.courts.views import get_bookings
+from wsrc.site.models import EmailContent
+from wsrc.site.usermodel.models import Player
+from wsrc.utils import timezones
+
+LOGGER = logging.getLogger(__name__)
+
+USERNAME_PREFIX = "benchmark_"
+EMAIL_TEMPLATES = ("BookingUpdate", "CancellationNotifier")
+PLACEHOLDER_MARKUP = "Benchmark placeholder {{ event_type }}"
+PEAK_HOURS = (17, 21)
+
+Sample = collections.namedtuple("Sample", ["operation", "elapsed", "queries", "status"])
+
+
+def create_benchmark_database():
+    """Create and switch to a new database for the benchmark, named as
+    the test runner's is, returning the name of the configured one. An
+    SQLite database is created as a file, as the worker threads cannot
+    share one in memory."""
+    settings_dict = connection.settings_dict
+    if "sqlite" in settings_dict["ENGINE"] and not settings_dict["TEST"].get("NAME"):
+        settings_dict["TEST"]["NAME"] = os.path.join(tempfile.gettempdir(), "wsrc_benchmark.sqlite3")
+    old_name = settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    return old_name
+
+
+def seed_club(nplayers, ndays, bookings_per_day=30):
+    """Create NPLAYERS users with players, and random bookings (with audit
+    entries) for each of the NDAYS days before today. Returns the users."""
+    users = []
+    with transaction.atomic():
+        for template in EMAIL_TEMPLATES:
+            if not EmailContent.objects.filter(name=template).exists():
+                EmailContent.objects.create(name=template, template_type="django", markup=PLACEHOLDER_MARKUP)
+        for i in range(nplayers):
+            user = User.objects.create_user(username="{0}{1:04d}".format(USERNAME_PREFIX, i),
+                                            email="{0}{1:04d}@example.com".format(USERNAME_PREFIX, i),
+                                            first_name="Player", last_name="{0:04d}".format(i))
+            Player.objects.create(user=user)
+            users.append(user)
+
+    today = datetime.date.today()
+    duration = datetime.timedelta(minutes=45)
+    for day in range(1, ndays+1):
+        date = today - datetime.timedelta(days=day)
+        midnight = timezone.make_aware(datetime.datetime.combine(date, datetime.time()))
+        bookings = []
+        for court in (1, 2, 3):
+            start = midnight + datetime.timedelta(hours=8, minutes=15 * court)
+            while start.hour < 22 and len(bookings) < bookings_per_day:
+                if random.random() < 0.7:
+                    user = random.choice(users)
+                    bookings.append(BookingSystemEvent(start_time=start, end_time=start + duration, court=court,
+                                                       name=user.get_full_name(), opponent="Solo", event_type="I",
+                                                       created_by_user=user, last_updated_by=user))
+                    # bulk_create does not send pre_save
+                    classify_booking(bookings[-1])
+                start += duration
+        with transaction.atomic():
+            BookingSystemEvent.objects.bulk_create(bookings)
+            # bulk_create does not return ids on MySQL, so re-read them for the audit table
+            saved = BookingSystemEvent.objects.filter(start_time__gte=midnight,
+                                                      start_time__lt=midnight + datetime.timedelta(days=1),
+                                                      created_by_user__in=users)
+            BookingSystemEventAuditEntry.objects.bulk_create(
+                [BookingSystemEventAuditEntry.create_from_current(b, is_new=True) for b in saved])
+    return users
+
+
+def get_release_date():
+    "The last day which can currently be booked"
+    return datetime.date.today() + datetime.timedelta(days=settings.BOOKING_SYSTEM_CUTOFF_DAYS - 1)
+
+
+def get_peak_slots(date):
+    "Bookable free slots on DATE during peak hours, as (court, slot) pairs"
+    server_time, court_slots = get_bookings(date)
+    return [(court, slot) for court, slots in court_slots.iteritems() for slot in slots.itervalues()
+            if "token" in slot and PEAK_HOURS[0] * 60 <= slot["start_mins"] < PEAK_HOURS[1] * 60]
+
+
+class ThreadClient(Client):
+    """Test client for use alongside others in different threads.
+    Exceptions are signalled to every client, so ignore those raised by
+    requests in other threads."""
+    def __init__(self, *args, **kwargs):
+        super(ThreadClient, self).__init__(*args, **kwargs)
+        self.thread = threading.current_thread()
+
+    def store_exc_info(self, **kwargs):
+        if threading.current_thread() is self.thread:
+            super(ThreadClient, self).store_exc_info(**kwargs)
+
+
+class Worker(threading.Thread):
+    "Issues a random mix of requests as a single user"
+    OPERATIONS = (("day_view", 4), ("data_bookings", 3), ("create", 2), ("cancel", 1))
+
+    def __init__(self, user, date, slots, nrequests, samples):
+        super(Worker, self).__init__()
+        self.date = date
+        self.slots = slots
+        self.nrequests = nrequests
+        self.samples = samples
+        self.user = user
+        self.choices = [op for op, weight in self.OPERATIONS for i in range(weight)]
+
+    def timed(self, operation, func):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.time()
+            try:
+                status = func().status_code
+            except Exception:
+                LOGGER.exception("error in %s", operation)
+                status = 500
+            elapsed = time.time() - start
+        self.samples.append(Sample(operation, elapsed, len(queries), status))
+
+    def day_view(self):
+        return self.client.get(reverse("courts") + "/" + timezones.as_iso_date(self.date), {"table_only": 1})
+
+    def data_bookings(self):
+        return self.client.get("/data/bookings", {"date": timezones.as_iso_date(self.date)})
+
+    def create(self):
+        court, slot = random.choice(self.slots)
+        data = {
+            "name": self.user.get_full_name(),
+            "opponent": "Solo",
+            "description": "",
+            "date": timezones.as_iso_date(self.date),
+            "start_time": slot["start_time"],
+            "duration": timezones.duration_str(datetime.timedelta(minutes=slot["duration_mins"])),
+            "court": court,
+            "booking_type": "I",
+            "token": slot["token"],
+        }
+        return self.client.post(reverse("booking"), data)
+
+    def cancel(self):
+        booking = BookingSystemEvent.objects.filter(created_by_user=self.user, is_active=True,
+                                                    start_time__gte=timezone.now()).first()
+        if booking is None:
+            return self.create()
+        url = "{0}/{1}".format(reverse("booking"), booking.pk)
+        return self.client.post(url, {"action": "delete", "next": reverse("courts")})
+
+    def run(self):
+        self.client = ThreadClient()
+        self.client.force_login(self.user)
+        try:
+            for i in range(self.nrequests):
+                operation = random.choice(self.choices)
+                self.timed(operation, getattr(self, operation))
+        finally:
+            connection.close()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def summarize(samples):
+    "Returns rows of (operation, count, p50 ms, p99 ms, mean queries, errors) and the conflict rate"
+    by_op = collections.OrderedDict()
+    for sample in samples:
+        by_op.setdefault(sample.operation, []).append(sample)
+    rows = []
+    for operation, op_samples in by_op.iteritems():
+        elapsed = [s.elapsed * 1000 for s in op_samples]
+        queries = [s.queries for s in op_samples]
+        errors = len([s for s in op_samples if s.status >= 500])
+        rows.append((operation, len(op_samples), percentile(elapsed, 0.5), percentile(elapsed, 0.99),
+                     float(sum(queries)) / len(queries), errors))
+    creates = by_op.get("create", [])
+    conflicts = len([s for s in creates if s.status == 409])
+    conflict_rate = float(conflicts) / len(creates) if creates else 0.0
+    return rows, conflict_rate
+
+
+def run_benchmark(nplayers=200, ndays=180, nworkers=20, nrequests=25, keep=False):
+    """Seed a new database, run NWORKERS concurrent users for NREQUESTS
+    requests each and return a text report. The database is destroyed
+    afterwards unless KEEP is set."""
+    setup_test_environment()
+    old_name = create_benchmark_database()
+    try:
+        users = seed_club(nplayers, ndays)
+        date = get_release_date()
+        slots = get_peak_slots(date)
+        if not slots:
+            raise Exception("no bookable peak-time slots on " + timezones.as_iso_date(date))
+        samples = []
+        workers = [Worker(user, date, slots, nrequests, samples) for user in random.sample(users, nworkers)]
+        start = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        total_secs = time.time() - start
+    finally:
+        if keep:
+            LOGGER.info("benchmark database kept: %s", connection.settings_dict["NAME"])
+        else:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    rows, conflict_rate = summarize(samples)
+    lines = ["{0} requests from {1} users in {2:.1f}s, booking {3}".format(len(samples), nworkers, total_secs,
+                                                                       timezones.as_iso_date(date)),
+             "{0:<14} {1:>6} {2:>9} {3:>9} {4:>8} {5:>6}".format("request", "count", "p50 ms", "p99 ms",
+                                                                  "queries", "errors")]
+    for row in rows:
+        lines.append("{0:<14} {1:>6} {2:>9.1f} {3:>9.1f} {4:>8.1f} {5:>6}".format(*row))
+    lines.append("booking conflict rate: {0:.1%}".format(conflict_rate))
+    return "\n".join(lines)
@@ -13,13 +13,16 @@
 # You should have received a copy of the GNU General Public License
 # along with WSRC.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
 import datetime
 import logging
+import multiprocessing
 import operator
 import sys
 import unittest
 
 from django.core.mail import SafeMIMEMultipart, SafeMIMEText
+from django.db import connection, transaction
 
 from email.mime.application import MIMEApplication
 
@@ -29,62 +32,83 @@ import wsrc.site.settings.settings as settings
 from wsrc.utils import email_utils
 from wsrc.utils.timezones import UK_TZINFO, as_iso_date
 
-def get_audit_table_and_noshows(date):
-    from .models import BookingSystemEvent, BookingSystemEventAuditEntry
-    audit_table = BookingSystemEventAuditEntry.objects.filter(updated=date).order_by("updated")
-    noshows = BookingSystemEvent.objects.filter(start_time__date=date, no_show=True)
-    return audit_table, noshows
+class AuditIndex(object):
+    """Audit entries indexed for the tests applied to each cancellation,
+    built in a single pass so that each test is a dictionary lookup.
+    Entries are processed in the order given, as the outcome depends on
+    which entry is the last for a given court or booking."""
+
+    def __init__(self, audit_data, admin_users=None):
+        self.items = list(audit_data)
+        # last entry for each court slot, keyed by (date, start_minutes, court)
+        self.last_for_slot = dict()
+        # booking ids created and not since deleted, keyed by (creator id, date)
+        self.live_bookings = dict()
+        booking_keys = dict()
+        for item in self.items:
+            booking = item.booking
+            self.last_for_slot[(booking.date, booking.start_minutes, booking.court)] = item
+            if item.update_type == "C":
+                key = (booking.created_by_user_id, booking.start_time.date())
+                self.live_bookings.setdefault(key, set()).add(booking.pk)
+                booking_keys.setdefault(booking.pk, set()).add(key)
+            elif item.update_type == "D":
+                for key in booking_keys.pop(booking.pk, ()):
+                    self.live_bookings[key].discard(booking.pk)
+        # user id -> has admin permission, filled on demand if not supplied
+        self.admin_users = dict() if admin_users is None else admin_users
+
+    @classmethod
+    def of(cls, audit_data):
+        if isinstance(audit_data, cls):
+            return audit_data
+        return cls(audit_data)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def is_admin(self, user):
+        result = self.admin_users.get(user.pk)
+        if result is None:
+            from wsrc.site.courts.views import has_admin_permission
+            result = self.admin_users[user.pk] = has_admin_permission(user, raise_exception=False)
+        return result
 
 def booked_another_court(audit_data, cancelled_item):
-    booked_courts = {}
-    for item in audit_data:
-        if item.booking == cancelled_item.booking:
-            continue
-        if item.update_type == "C" \
-           and item.booking.created_by_user == cancelled_item.booking.created_by_user \
-           and item.booking.start_time.date() == cancelled_item.booking.start_time.date():
-            booked_courts[item.booking.pk] = item.booking
-        elif item.update_type == "D":
-            id = item.booking.pk
-            if id in booked_courts:
-                del booked_courts[id]
-    rebooked = len(booked_courts) > 0
+    index = AuditIndex.of(audit_data)
+    booking = cancelled_item.booking
+    live = index.live_bookings.get((booking.created_by_user_id, booking.start_time.date()), ())
+    rebooked = len(live) > (1 if booking.pk in live else 0)
     if rebooked:
         LOGGER.info("entry filtered as another court booked: %s", cancelled_item.booking)
     return rebooked
 
 def court_rebooked(audit_data, cancelled_item):
-    last_item = None
-    for item in audit_data:
-        match = True
-        for field in ["date", "start_minutes", "court"]:
-            if getattr(item.booking, field) != getattr(cancelled_item.booking, field):
-                match = False
-                break
-        if match:
-            last_item = item
+    index = AuditIndex.of(audit_data)
+    booking = cancelled_item.booking
+    last_item = index.last_for_slot.get((booking.date, booking.start_minutes, booking.court))
     assert(last_item is not None)
     if "D" == last_item.update_type:
         return False
     return True
 
 def audit_filter(audit_data, item):
-    from wsrc.site.courts.views import has_admin_permission
     if item.update_type != "D":
         return True
     if booked_another_court(audit_data, item):
         return True
     if item.updated_by.is_superuser:
         return True
-    if has_admin_permission(item.updated_by, raise_exception=False):
+    if AuditIndex.of(audit_data).is_admin(item.updated_by):
         return True
     return False
 
-def process_audit_table(audit_data, player_offence_map, error_list, filter=None):
-    import wsrc.site.courts.models as court_models
-    import wsrc.site.usermodel.models as user_models
-    players = user_models.Player.objects.filter(user__is_active=True)
-    user_id_map = dict([(p.user.pk, p) for p in players])
+def find_offences(audit_data, user_id_map, error_list, filter=None):
+    """Return unsaved offences for the cancellations in AUDIT_DATA, by
+    the players in USER_ID_MAP (keyed by user id)"""
+    from wsrc.site.courts.models import BookingOffence
+    audit_data = AuditIndex.of(audit_data)
+    offences = []
     for item in audit_data:
         if filter is not None and filter(item):
             continue
@@ -102,10 +126,10 @@ def process_audit_table(audit_data, player_offence_map, error_list, filter=None)
             LOGGER.warning(msg)
             continue
         rebooked = court_rebooked(audit_data, item)
-        points = court_models.BookingOffence.get_points(delta_t_hours, prebook_hours)
+        points = BookingOffence.get_points(delta_t_hours, prebook_hours)
         if points == 0:
             continue
-        offence = court_models.BookingOffence(
+        offences.append(BookingOffence(
           player  = player,
           offence = "lc",
           entry_id = item.booking.pk,
@@ -119,9 +143,20 @@ def process_audit_table(audit_data, player_offence_map, error_list, filter=None)
           cancellation_time = cancellation_time,
           rebooked = rebooked,
           penalty_points = points
-        )
+        ))
+    return offences
+
+def get_player_map(user_ids):
+    import wsrc.site.usermodel.models as user_models
+    players = user_models.Player.objects.filter(user__is_active=True, user_id__in=user_ids).select_related("user")
+    return dict([(p.user.pk, p) for p in players])
+
+def process_audit_table(audit_data, player_offence_map, error_list, filter=None):
+    audit_data = AuditIndex.of(audit_data)
+    user_id_map = get_player_map(set([item.booking.created_by_user_id for item in audit_data]))
+    for offence in find_offences(audit_data, user_id_map, error_list, filter):
         offence.save()
-        player_offence_map.setdefault(player, []).append(offence)
+        player_offence_map.setdefault(offence.player, []).append(offence)
 
 def report_errors(date, errors):
     subject = "Booking Monitor Error"
@@ -137,50 +172,139 @@ def report_errors(date, errors):
         msg.add_header('Content-Disposition', 'attachment', filename='{id}.json'.format(id=error["data"]["entry_id"]))
         attachments.append(msg)
 
-    email_utils.send_email(subject, None, None, from_address, [to_address], extra_attachments=attachments)
+    email_utils.queue_email(subject, None, None, from_address, [to_address], extra_attachments=attachments)
 
-def report_offences(date, player, offences, total_offences):
+def report_offences(date, player, offences, total_offences, total_points=None, first_date=None):
     from wsrc.site.courts.models import BookingOffence
-    subject = "Cancelled/Unused Courts - {name} - {date:%Y-%m-%d}".format(name=player.user.get_full_name(), date=date)
+    name = player.user.get_full_name()
+    if first_date is None or first_date == date:
+        subject = "Cancelled/Unused Courts - {name} - {date:%Y-%m-%d}".format(name=name, date=date)
+    else:
+        subject = "Cancelled/Unused Courts - {name} - {first_date:%Y-%m-%d} to {date:%Y-%m-%d}".format(
+            name=name, first_date=first_date, date=date)
     from_address = "booking.monitor@wokingsquashclub.org"
     daily_total = reduce(lambda x,y: x + y.penalty_points, offences, 0)
     to_list = [player.user.email or None]
     cc_address = "booking.monitor@wokingsquashclub.org"
+    if total_points is None:
+        total_points = BookingOffence.get_total_points_for_player(player, date, total_offences)
     context = {
       "date": date,
+      "first_date": first_date or date,
       "player": player,
       "offences": offences,
       "total_offences": total_offences,
-      "total_points": BookingOffence.get_total_points_for_player(player, date, total_offences),
+      "total_points": total_points,
       "point_limit": BookingOffence.POINT_LIMIT
     }
     text_body, html_body = email_utils.get_email_bodies("BookingOffenceNotification", context)
-    email_utils.send_email(subject, text_body, html_body, from_address, to_list, cc_list=[cc_address])
+    email_utils.queue_email(subject, text_body, html_body, from_address, to_list, cc_list=[cc_address])
 
-def process_date(date):
-    from wsrc.site.courts.models import BookingOffence
-    LOGGER.info("processing date %s", as_iso_date(date))
+def get_midnight(date):
+    return datetime.datetime.combine(date, datetime.time(0, 0, tzinfo=UK_TZINFO))
+
+def get_audit_entries_by_date(first_date, last_date):
+    """The audit entries for the dates from FIRST_DATE to LAST_DATE
+    inclusive, in one query, as lists in update order keyed by date.
+    Each date's entries are selected as process_date() always has, by
+    an update time of exactly midnight at the start of the date."""
+    from .models import BookingSystemEventAuditEntry
+    midnights = dict()
+    date = first_date
+    while date <= last_date:
+        midnights[get_midnight(date)] = date
+        date += datetime.timedelta(days=1)
+    entries = BookingSystemEventAuditEntry.objects.filter(updated__in=midnights.keys())\
+        .order_by("updated", "pk").select_related("booking__created_by_user", "updated_by")
+    entries_by_date = collections.OrderedDict()
+    for item in entries:
+        entries_by_date.setdefault(midnights[item.updated], []).append(item)
+    return entries_by_date
 
-    (noshows, audit_table) = get_audit_table_and_noshows(date)
+def get_admin_users(entries):
+    "Map of user id to admin permission for the users who updated ENTRIES"
+    from wsrc.site.courts.views import has_admin_permission
+    users = dict([(item.updated_by.pk, item.updated_by) for item in entries if item.update_type == "D"])
+    return dict([(pk, has_admin_permission(user, raise_exception=False)) for pk, user in users.iteritems()])
 
+def evaluate_date(args):
+    """Offences and errors for one day's audit entries. Uses no database
+    queries, so that days can be evaluated in other processes."""
+    date, entries, admin_users, user_id_map = args
+    audit_table = AuditIndex(entries, admin_users)
     filter = lambda(i): audit_filter(audit_table, i)
+    errors = list()
+    offences = find_offences(audit_table, user_id_map, errors, filter)
+    return date, offences, errors
+
+def evaluate_dates(work, nprocs=None):
+    "Apply evaluate_date() to each item of WORK, in a pool of NPROCS processes for more than one day"
+    if nprocs is None:
+        nprocs = multiprocessing.cpu_count()
+    nprocs = min(nprocs, len(work))
+    if nprocs <= 1:
+        return [evaluate_date(args) for args in work]
+    # forked processes must not share the database connection
+    connection.close()
+    pool = multiprocessing.Pool(nprocs)
+    try:
+        return pool.map(evaluate_date, work)
+    finally:
+        pool.close()
+        pool.join()
 
-    midnight_today = datetime.datetime.combine(date, datetime.time(0, 0, tzinfo=UK_TZINFO))
-    midnight_tomorrow = midnight_today + datetime.timedelta(days=1)
-    existing_offences = BookingOffence.objects.filter(start_time__gte=midnight_today, start_time__lt=midnight_tomorrow)
-    if existing_offences.count() > 0:
-        LOGGER.warning("found %s offence(s) already present for %s, deleting", existing_offences.count(), as_iso_date(date))
-        existing_offences.delete()
+def process_dates(first_date, ndays=1, nprocs=None):
+    """Register offences for the cancelled bookings on NDAYS days from
+    FIRST_DATE, replacing any already registered, and send each player
+    one email listing their new offences"""
+    from wsrc.site.courts.models import BookingOffence, PenaltyPoints
+    last_date = first_date + datetime.timedelta(days=ndays-1)
+    LOGGER.info("processing dates %s to %s", as_iso_date(first_date), as_iso_date(last_date))
 
-    player_offence_map = dict()
+    entries_by_date = get_audit_entries_by_date(first_date, last_date)
+    all_entries = [item for entries in entries_by_date.itervalues() for item in entries]
+    admin_users = get_admin_users(all_entries)
+    user_id_map = get_player_map(set([item.booking.created_by_user_id for item in all_entries]))
+
+    work = [(date, entries, admin_users, user_id_map) for date, entries in entries_by_date.iteritems()]
+    player_offence_map = collections.OrderedDict()
     errors = list()
+    new_offences = list()
+    for date, offences, date_errors in evaluate_dates(work, nprocs):
+        new_offences.extend(offences)
+        errors.extend(date_errors)
+    # players were pickled for the pool, so map back to this process's instances
+    for offence in new_offences:
+        offence.player = user_id_map[offence.player.user_id]
+        player_offence_map.setdefault(offence.player, []).append(offence)
+
+    with transaction.atomic():
+        existing_offences = BookingOffence.objects.filter(start_time__gte=get_midnight(first_date),
+                                                          start_time__lt=get_midnight(last_date + datetime.timedelta(days=1)))
+        nexisting = existing_offences.count()
+        if nexisting > 0:
+            LOGGER.warning("found %s offence(s) already present for %s to %s, deleting", nexisting,
+                           as_iso_date(first_date), as_iso_date(last_date))
+            existing_offences.delete()
+        BookingOffence.objects.bulk_create(new_offences)
+        # bulk_create sends no signals, so bring the ledger up to date here
+        PenaltyPoints.recalculate([player.pk for player in player_offence_map.keys()])
 
-    process_audit_table(audit_table, player_offence_map, errors, filter)
-#    process_noshows(noshows, player_offence_map, errors)
-    if len(errors) > 0:
-        report_errors(date, errors)
-    for player, offences in player_offence_map.items():
-        total_offences = BookingOffence.get_offences_for_player(player, date)
-        report_offences(date, player, offences, total_offences)
+        if len(errors) > 0:
+            report_errors(last_date, errors)
 
+        # the points totals for every player, in one query
+        cutoff = get_midnight(last_date) - datetime.timedelta(days=BookingOffence.CUTOFF_DAYS)
+        total_offences_map = dict()
+        for offence in BookingOffence.objects.filter(player__in=player_offence_map.keys(), is_active=True,
+                                                     start_time__gte=cutoff,
+                                                     start_time__lt=get_midnight(last_date + datetime.timedelta(days=1))):
+            total_offences_map.setdefault(offence.player_id, []).append(offence)
+        for player, offences in player_offence_map.items():
+            total_offences = total_offences_map.get(player.pk, [])
+            total_points = sum([o.penalty_points for o in total_offences])
+            report_offences(last_date, player, offences, total_offences, total_points, first_date)
+    return player_offence_map
 
+def process_date(date):
+    return process_dates(date, 1, nprocs=1)
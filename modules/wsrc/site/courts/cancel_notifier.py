@@ -1,20 +1,125 @@
 #!/usr/bin/python
 
+import collections
 import datetime
 import logging
+import threading
+import time
 
+from django.db import transaction
+from django.db.models import Count, Max
 from django.template import Template, Context
-from threading import Thread
+from django.utils import timezone
 import markdown
 
+import wsrc.site.settings.settings as settings
 from wsrc.utils import timezones, email_utils, text as text_utils
 import wsrc.site.courts.evt_filters as evt_filters
 
 FUTURE_CUTTOFF = datetime.timedelta(days=7)
+BUCKET_MINS = 15
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(logging.INFO)
 
+def to_bucket(time_of_day):
+  return (time_of_day.hour * 60 + time_of_day.minute) // BUCKET_MINS
+
+def local_start_time(event):
+  # filters are expressed in club time, whereas bookings read back from
+  # the database are in UTC
+  if timezone.is_aware(event.start_time):
+    return timezone.localtime(event.start_time)
+  return event.start_time
+
+class Subscription(collections.namedtuple("Subscription", ["player_id", "name", "earliest", "latest", "days", "notice_period"])):
+  "A single EventFilter, flattened"
+
+  def matches(self, event, time_of_day, now):
+    return self.earliest <= time_of_day <= self.latest and \
+      event.start_time > now + self.notice_period and \
+      event.name != self.name
+
+class SubscriptionIndex:
+  """All active players' EventFilters, bucketed by ISO weekday and
+     BUCKET_MINS period of the day, so that finding the players
+     interested in a cancellation only needs to look at the filters
+     covering its start time.
+  """
+
+  def __init__(self, subscriptions):
+    self.subscriptions = subscriptions
+    self.buckets = dict()
+    self.email_template = None
+    for sub in subscriptions:
+      for day in sub.days:
+        for bucket in xrange(to_bucket(sub.earliest), to_bucket(sub.latest) + 1):
+          self.buckets.setdefault((day, bucket), []).append(sub)
+
+  def match(self, event, now):
+    "Return the ids of players whose filters match EVENT at time NOW"
+    if event.start_time > now + FUTURE_CUTTOFF:
+      return []
+    start_time = local_start_time(event)
+    time_of_day = start_time.time()
+    id_list = []
+    for sub in self.buckets.get((start_time.isoweekday(), to_bucket(time_of_day)), []):
+      if sub.player_id not in id_list and sub.matches(event, time_of_day, now):
+        id_list.append(sub.player_id)
+    return id_list
+
+  def get_email_template(self):
+    from wsrc.site.models import EmailContent
+    if self.email_template is None:
+      template_obj = EmailContent.objects.get(name="CancellationNotifier")
+      self.email_template = Template(template_obj.markup)
+    return self.email_template
+
+  @staticmethod
+  def from_db():
+    from wsrc.site.courts.models import EventFilter
+    filters = EventFilter.objects.filter(player__user__is_active=True)\
+                                 .select_related("player__user")\
+                                 .prefetch_related("days")\
+                                 .order_by("id")
+    subscriptions = [Subscription(player_id=f.player_id,
+                                  name=f.player.user.get_full_name(),
+                                  earliest=f.earliest,
+                                  latest=f.latest,
+                                  days=[d.ordinal for d in f.days.all()],
+                                  notice_period=datetime.timedelta(minutes=f.notice_period_minutes))
+                     for f in filters]
+    return SubscriptionIndex(subscriptions)
+
+# The index is shared by every Notifier in the process, and rebuilt when
+# the subscriptions change. Changes are detected from the database - the
+# number of filters, their latest update and that of the email template
+# - rather than a cache, which may not be shared between processes.
+_index_lock = threading.Lock()
+_index = (None, None)
+
+def get_index_version():
+  from wsrc.site.courts.models import EventFilter
+  from wsrc.site.models import EmailContent
+  filters = EventFilter.objects.aggregate(n=Count("id"), last_updated=Max("last_updated"))
+  template = EmailContent.objects.filter(name="CancellationNotifier").aggregate(last_updated=Max("last_updated"))
+  return (filters["n"], filters["last_updated"], template["last_updated"])
+
+def get_subscription_index():
+  global _index
+  version = get_index_version()
+  with _index_lock:
+    index_version, index = _index
+    if index is None or index_version != version:
+      index = SubscriptionIndex.from_db()
+      _index = (version, index)
+    return index
+
+def invalidate_subscription_index(filters):
+  """Mark the EventFilters in the queryset FILTERS as changed, for a
+     change which does not save them, so every process rebuilds its index"""
+  filters.update(last_updated=timezone.now())
+
 class Notifier:
   """Emails players when a booking has been cancelled, to allow them to
      book the court. Cancellation events are filtered according to
@@ -22,35 +127,43 @@ class Notifier:
      interested in, etc.
   """
 
-  def __init__(self, current_time=None):
-    from wsrc.site.models import EmailContent
-    self.userfilters = self.get_configs_from_db(current_time)
-    template_obj = EmailContent.objects.get(name="CancellationNotifier")
-    self.email_template = Template(template_obj.markup)
-    self.send_email = email_utils.send_email
+  def __init__(self, current_time=None, swallow_exceptions=True):
+    self.current_time = current_time
+    self.swallow_exceptions = swallow_exceptions
+    self.index = get_subscription_index()
+    self.send_email = email_utils.queue_email
+
+  @property
+  def email_template(self):
+    return self.index.get_email_template()
+
+  @property
+  def userfilters(self):
+    return self.get_configs_from_db(self.current_time)
 
   def async_process_removed_events(self, *removedEvents):
-    thread = Thread(target=self.process_removed_events, args=(removedEvents,))
-    thread.start()
-    return thread
+    "Note each of the (saved) events for the next cancellation digest"
+    for event in removedEvents:
+      queue_cancellation(event, self.current_time)
     
   def process_removed_events(self, removedEvents):
-
+    now = self.current_time
+    if now is None:
+      now = datetime.datetime.now(evt_filters.UK_TZINFO)
     for event in removedEvents:
       LOGGER.debug("processing {0}".format(event))
-      id_list = []  
-      # process removed events through the cancelled event notifier:
-      for id, userfilter in self.userfilters.iteritems():
-        LOGGER.debug("testing filters for player {0}".format(id))
-        if userfilter(event):
-          LOGGER.debug("matched".format(id))
-          id_list.append(id)
+      id_list = self.index.match(event, now)
       if len(id_list) > 0:
+        LOGGER.debug("matched players {0}".format(id_list))
         self.notify(event, id_list)
 
-  def notify(self, event, id_list, swallow_exceptions=True):
+  def get_players(self, id_list):
     from wsrc.site.usermodel.models import Player
-    players = [Player.objects.get(pk=id) for id in id_list]
+    player_map = Player.objects.select_related("user").in_bulk(id_list)
+    return [player_map[id] for id in id_list if id in player_map]
+
+  def render_event(self, event, players):
+    "Return text and html descriptions of EVENT, for the notified PLAYERS"
     contact_details = [["Name", "E-Mail", "Mobile Phone", "Other Phone"]]
     for player in players:
       contact_details.append([player.user.get_full_name(), player.user.email, player.cell_phone, player.other_phone])
@@ -60,17 +173,46 @@ class Notifier:
       "notified_members": players,
       "contact_details_table": text_utils.formatTable(contact_details, True)
     })
-    subject = "Court Cancellation"
-    from_address = "court-cancellations@wokingsquashclub.org"
     html_body = markdown.markdown(self.email_template.render(context))
     context["content_type"] = "text/plain"
     text_body = self.email_template.render(context)
+    return text_body, html_body
+
+  def notify(self, event, id_list, swallow_exceptions=None):
+    players = self.get_players(id_list)
+    text_body, html_body = self.render_event(event, players)
     to_list = [p.user.email for p in players if '@' in p.user.email]
+    self.send("Court Cancellation", text_body, html_body, to_list, swallow_exceptions)
+
+  def notify_digest(self, matches, swallow_exceptions=None):
+    """Send each player one email describing all of the events they
+       matched. MATCHES is a list of (event, id_list) pairs."""
+    players = self.get_players(list(set([id for event, id_list in matches for id in id_list])))
+    player_map = dict([(p.id, p) for p in players])
+    sections = dict()
+    for event, id_list in matches:
+      event_players = [player_map[id] for id in id_list if id in player_map]
+      bodies = self.render_event(event, event_players)
+      for player in event_players:
+        sections.setdefault(player.id, []).append(bodies)
+    for player in players:
+      if '@' not in player.user.email:
+        continue
+      player_sections = sections[player.id]
+      subject = "Court Cancellation" if len(player_sections) == 1 else "Court Cancellations"
+      text_body = "\n\n* * *\n\n".join([text for text, html in player_sections])
+      html_body = "\n<hr>\n".join([html for text, html in player_sections])
+      self.send(subject, text_body, html_body, [player.user.email], swallow_exceptions)
+
+  def send(self, subject, text_body, html_body, to_list, swallow_exceptions=None):
+    from_address = "court-cancellations@wokingsquashclub.org"
     reply_to = "noreply@wokingsquashclub.org"
     LOGGER.debug("sending email to {0}".format(to_list))
     try:
       self.send_email(subject, text_body, html_body, from_address, to_list, reply_to_address=reply_to)
     except Exception, e:
+      if swallow_exceptions is None:
+        swallow_exceptions = self.swallow_exceptions
       if swallow_exceptions:
         import traceback
         traceback.print_exc()
@@ -78,31 +220,57 @@ class Notifier:
         raise e
 
   def get_configs_from_db(self, current_time):
-    from wsrc.site.usermodel.models import Player
-    from wsrc.site.courts.models import EventFilter
-    userfilters = dict()
+    """Return the subscriptions as a map of player id to evt_filters
+       tree. No longer used for matching, but useful for inspection."""
+    userfilters = collections.OrderedDict()
     cuttoff_filter = evt_filters.Not(evt_filters.IsFutureEvent(delay=FUTURE_CUTTOFF, now=current_time))
-    def get_or_create(id):
-      ulist = userfilters.get(id)
-      if ulist is None:
-        userfilters[id] = ulist = []
-      return ulist
-    filters = EventFilter.objects.filter(player__user__is_active=True)
-    # populate map with lists of event filters keyed by player id
-    for filter in filters:
-      timefilt = evt_filters.TimeOfDay(filter.earliest, filter.latest)
-      days = [o.ordinal for o in filter.days.all()]
-      dayfilt = evt_filters.DaysOfWeek(days)
-      futurefilt = evt_filters.IsFutureEvent(delay=datetime.timedelta(minutes=filter.notice_period_minutes), now=current_time)
-      combined_filter = evt_filters.And([timefilt, dayfilt, futurefilt])
-      get_or_create(filter.player.id).append(combined_filter)
+    names = dict()
+    for sub in self.index.subscriptions:
+      timefilt = evt_filters.TimeOfDay(sub.earliest, sub.latest)
+      dayfilt = evt_filters.DaysOfWeek(sub.days)
+      futurefilt = evt_filters.IsFutureEvent(delay=sub.notice_period, now=current_time)
+      userfilters.setdefault(sub.player_id, []).append(evt_filters.And([timefilt, dayfilt, futurefilt]))
+      names[sub.player_id] = sub.name
     # for each id, convert event filter list into combined filter:
     for id, filters in userfilters.iteritems():
-      player = Player.objects.get(pk=id)
-      not_userfilt = evt_filters.Not(evt_filters.IsPerson(player.user.get_full_name()))
-      playerfilt = evt_filters.And([not_userfilt, cuttoff_filter, evt_filters.Or(filters)])
-      userfilters[id] = playerfilt
+      not_userfilt = evt_filters.Not(evt_filters.IsPerson(names[id]))
+      userfilters[id] = evt_filters.And([not_userfilt, cuttoff_filter, evt_filters.Or(filters)])
     return userfilters
+
+def queue_cancellation(event, now=None):
+  """Note the cancelled EVENT for the next digest, and schedule one if
+     none is due within the digest period"""
+  from wsrc.site import jobs
+  from wsrc.site.courts.models import CancellationNotice
+  if now is None:
+    now = timezone.now()
+  CancellationNotice.objects.create(booking=event, cancelled_at=now)
+  jobs.enqueue_once(send_cancellation_digests,
+                    delay=datetime.timedelta(seconds=settings.BOOKING_SYSTEM_CANCELLATION_DIGEST_SECS))
+
+def send_cancellation_digests():
+  "Background job emailing each player about all the cancellations noted since the last run"
+  from wsrc.site.courts.models import CancellationNotice
+  with transaction.atomic():
+    notices = list(CancellationNotice.objects.select_for_update().select_related("booking")\
+                   .order_by("booking__start_time", "booking__court"))
+    if not notices:
+      return
+    CancellationNotice.objects.filter(pk__in=[n.pk for n in notices]).delete()
+    # let the job be retried if the emails can not be queued
+    notifier = Notifier(swallow_exceptions=False)
+    matches = []
+    seen = set()
+    for notice in notices:
+      event = notice.booking
+      # skip bookings which have been reinstated since
+      if event.is_active or event.pk in seen:
+        continue
+      seen.add(event.pk)
+      id_list = notifier.index.match(event, notice.cancelled_at)
+      if len(id_list) > 0:
+        matches.append((event, id_list))
+    notifier.notify_digest(matches)
   
 if __name__ == "__main__":
 
@@ -20,10 +20,23 @@ import operator
 from django.utils import timezone
 
 from .models import BookingSystemEvent
+from .occupancy import DayOccupancy, MINUTES_PER_DAY
 from wsrc.site.settings import settings
 
 def add_free_slots(court, booked_slots, booking_date_midnight, now, ignore_cutoff=False):
-    
+    booked_slots.sort(key=operator.itemgetter("start_mins"))
+    occupancy = DayOccupancy(settings.BOOKING_SYSTEM_RESOLUTION_MINS)
+    for booked_slot in booked_slots:
+        occupancy.add(court, booked_slot.start_minutes, booked_slot.duration_minutes)
+    booked_slots.extend(get_free_slots(court, occupancy, booking_date_midnight, now, ignore_cutoff))
+    return booked_slots
+
+
+def get_free_slots(court, occupancy, booking_date_midnight, now, ignore_cutoff=False):
+    """Return the free slots for COURT on the day given by OCCUPANCY, as
+    dicts with start time and duration, and a booking token if the slot
+    can currently be booked"""
+
     RESOLUTION_MINS = settings.BOOKING_SYSTEM_RESOLUTION_MINS
 
     COVID_LOCKDOWN_DAY = timezone.make_aware(datetime.datetime(2020, 3, 21))
@@ -37,33 +50,19 @@ def add_free_slots(court, booked_slots, booking_date_midnight, now, ignore_cutof
     STARTS_ENDS = settings.BOOKING_SYSTEM_STARTS_ENDS
     CUTOFF_PERIOD = datetime.timedelta(days=settings.BOOKING_SYSTEM_CUTOFF_DAYS)
 
-    booked_slots.sort(key=operator.itemgetter("start_mins"))
     room_offset_mins = (court-1) * RESOLUTION_MINS;
     start_mins = STARTS_ENDS[0] + room_offset_mins
     end_mins = STARTS_ENDS[1] + room_offset_mins - RESOLUTION_MINS
-    mins_to_slot = dict([(c.start_minutes, c) for c in booked_slots])
-    nbookings = len(booked_slots)
-    idx = 0
     cutoff_point = now + CUTOFF_PERIOD
 
-    iter_mins = 7*60 # sometimes courts are reserved by admin earlier than they can be booked.
-    while iter_mins < end_mins:
-        booked_slot = mins_to_slot.get(iter_mins)
-        if booked_slot is not None:
-            iter_mins += booked_slot.duration_minutes
-            continue
-        if iter_mins < start_mins:
-            iter_mins += RESOLUTION_MINS
-            continue
-        next_start = end_mins
-        while idx < nbookings:
-            booked_slot = booked_slots[idx]
-            if booked_slot.start_minutes > iter_mins:
-                next_start = booked_slot.start_minutes
-                break
-            idx += 1
+    new_slots = []
+    for (iter_mins, next_start) in occupancy.free_runs(court, start_mins):
+        if iter_mins >= end_mins:
+            break
+        if next_start == MINUTES_PER_DAY:
+            # not followed by a booking, so fill to the end of the day
+            next_start = end_mins
         # fill to next start (or end)..
-        
         while iter_mins < next_start:
             duration_mins = next_start - iter_mins
             if duration_mins > DEFAULT_DURATION:
@@ -79,6 +78,6 @@ def add_free_slots(court, booked_slots, booking_date_midnight, now, ignore_cutof
             }
             if slot_end_dt > now and (ignore_cutoff or slot_dt < cutoff_point):
                 booking["token"] = BookingSystemEvent.generate_hmac_token(slot_dt, court);
-            booked_slots.append(booking)
+            new_slots.append(booking)
             iter_mins += duration_mins
-    return booked_slots
+    return new_slots
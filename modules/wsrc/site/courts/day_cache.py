@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# This file is part of WSRC.
+#
+# WSRC is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WSRC is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WSRC.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Per-day cache for the court booking grid.
+
+Everything cached for a date is keyed by a version of the bookings on
+that date, read from the database: the number of bookings starting on
+the date, active or not, and their latest update. Saving a booking
+changes the version of its date, and a booking moved away changes the
+count on the day it left, so every server process sees the change
+without sharing a cache. Stale entries are never deleted, they simply
+stop being looked up and expire.
+
+The free slots (and their booking tokens) also depend on the current
+time, but only change when the time crosses a slot boundary, so entries
+are additionally keyed by the current RESOLUTION_MINS period.
+"""
+
+import calendar
+
+from django.core.cache import cache
+
+from wsrc.site.settings import settings
+from wsrc.utils import timezones
+
+from .models import BookingSystemEvent
+
+KEY_PREFIX = "courts.day"
+
+
+def get_date_version(date):
+    "Return (count, latest update) of the bookings on DATE"
+    return BookingSystemEvent.get_change_validator(date, date)
+
+
+def get_time_period(now):
+    "Return the index of the booking-resolution period containing NOW"
+    period_secs = settings.BOOKING_SYSTEM_RESOLUTION_MINS * 60
+    return calendar.timegm(now.utctimetuple()) // period_secs
+
+
+def get_or_set(date, now, variant, factory, version=None):
+    """Return the cached value for (DATE, VARIANT) at time NOW, calling
+    FACTORY() to compute and store it when absent. VARIANT is a tuple
+    distinguishing the different things cached per date. VERSION is the
+    date's version, if the caller has already read it."""
+    if version is None:
+        version = get_date_version(date)
+    count, last_updated = version
+    key = "{prefix}.{date}.{count}.{updated}.{period}.{variant}".format(
+        prefix=KEY_PREFIX,
+        date=timezones.as_iso_date(date),
+        count=count,
+        updated=calendar.timegm(last_updated.utctimetuple()) * 1000000 + last_updated.microsecond
+                if last_updated is not None else 0,
+        period=get_time_period(now),
+        variant=".".join([str(v) for v in variant])
+    )
+    value = cache.get(key)
+    if value is None:
+        value = factory()
+        cache.set(key, value, settings.BOOKING_SYSTEM_RESOLUTION_MINS * 60)
+    return value
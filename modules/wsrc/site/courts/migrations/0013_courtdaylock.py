@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 11:09
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('courts', '0012_bookingsystemevent_opponent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CourtDayLock',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('court', models.SmallIntegerField()),
+                ('date', models.DateField()),
+                ('lock_count', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='courtdaylock',
+            unique_together=set([('court', 'date')]),
+        ),
+    ]
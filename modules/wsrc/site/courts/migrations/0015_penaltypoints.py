@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 11:25
+from __future__ import unicode_literals
+
+import datetime
+
+from django.db import migrations, models
+from django.utils import timezone
+import django.db.models.deletion
+
+from wsrc.utils.timezones import UK_TZINFO
+
+CUTOFF_DAYS = 183
+
+def local_midnight(date):
+    return datetime.datetime.combine(date, datetime.time(0, 0, tzinfo=UK_TZINFO))
+
+def build_ledger(apps, schema_editor):
+    "Total the points of each player's offences in the current window, as PenaltyPoints.recalculate() does"
+    BookingOffence = apps.get_model("courts", "BookingOffence")
+    PenaltyPoints = apps.get_model("courts", "PenaltyPoints")
+    today = timezone.localtime(timezone.now()).date()
+    start = local_midnight(today - datetime.timedelta(days=CUTOFF_DAYS + 1))
+    end = local_midnight(today)
+    offences = BookingOffence.objects.filter(is_active=True).order_by()
+    totals = offences.filter(start_time__gte=start, start_time__lt=end).values("player_id")\
+                     .annotate(points=models.Sum("penalty_points"), first=models.Min("start_time"))
+    pending = offences.filter(start_time__gte=end).exclude(penalty_points=0).values("player_id")\
+                      .annotate(first=models.Min("start_time"))
+    ledgers = dict()
+    for row in totals:
+        first_date = timezone.localtime(row["first"]).date()
+        ledgers[row["player_id"]] = PenaltyPoints(
+            player_id=row["player_id"], points=row["points"],
+            next_expiry=local_midnight(first_date + datetime.timedelta(days=CUTOFF_DAYS + 2)))
+    for row in pending:
+        first_counted = local_midnight(timezone.localtime(row["first"]).date() + datetime.timedelta(days=1))
+        ledger = ledgers.setdefault(row["player_id"], PenaltyPoints(player_id=row["player_id"], points=0))
+        if ledger.next_expiry is None or first_counted < ledger.next_expiry:
+            ledger.next_expiry = first_counted
+    PenaltyPoints.objects.bulk_create(ledgers.values())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usermodel', '0008_auto_20180612_1220'),
+        ('courts', '0014_cancellationnotice'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PenaltyPoints',
+            fields=[
+                ('player', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='penalty_points', serialize=False, to='usermodel.Player')),
+                ('points', models.IntegerField(db_index=True, default=0)),
+                ('next_expiry', models.DateTimeField(blank=True, db_index=True, null=True)),
+            ],
+            options={
+                'ordering': ['-points'],
+                'verbose_name': 'Penalty Points',
+                'verbose_name_plural': 'Penalty Points',
+            },
+        ),
+        migrations.RunPython(build_ledger, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 11:33
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+def classify_bookings(apps, schema_editor):
+    from wsrc.site.courts.usage_categories import classify_bookings
+    BookingSystemEvent = apps.get_model("courts", "BookingSystemEvent")
+    classify_bookings(BookingSystemEvent.objects.all())
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('courts', '0015_penaltypoints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bookingsystemevent',
+            name='usage_category',
+            field=models.CharField(blank=True, choices=[(b'club', b'Club Night'), (b'teams', b'Teams'), (b'junior', b'Junior Coaching'), (b'members', b'Members'), (b'other', b'Other')], db_index=True, editable=False, max_length=8),
+        ),
+        migrations.RunPython(classify_bookings, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 11:47
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('courts', '0016_booking_usage_category'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bookingsystemeventauditentry',
+            name='previous_start_time',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 12:07
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+BATCH_SIZE = 2000
+
+def set_peak_flags(apps, schema_editor):
+    from wsrc.site.courts.usage_categories import is_peak_time
+    BookingSystemEvent = apps.get_model("courts", "BookingSystemEvent")
+    rows = BookingSystemEvent.objects.order_by("pk").values_list("pk", "start_time")
+    last_pk = None
+    while True:
+        batch = list((rows.filter(pk__gt=last_pk) if last_pk is not None else rows)[:BATCH_SIZE])
+        if not batch:
+            break
+        peak_pks = [pk for pk, start_time in batch if is_peak_time(start_time)]
+        BookingSystemEvent.objects.filter(pk__in=peak_pks).update(is_peak=True)
+        last_pk = batch[-1][0]
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('courts', '0018_eventfilter_last_updated'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bookingsystemevent',
+            name='is_peak',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.RunPython(set_peak_flags, migrations.RunPython.noop),
+    ]
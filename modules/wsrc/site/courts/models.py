@@ -16,17 +16,26 @@
 import datetime
 import hmac
 
+from backports.functools_lru_cache import lru_cache
 from django.contrib.auth import models as auth_models
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.utils import timezone
 
 import wsrc.site.settings
 import wsrc.site.usermodel.models as user_models
 from wsrc.utils.text import obfuscate
+from . import usage_categories
 from wsrc.utils.timezones import UK_TZINFO, nearest_last_quarter_hour
 
 
+@lru_cache(maxsize=4096)
+def hmac_digest(key, msg):
+    """Memoised HMAC of MSG. The key is part of the cache key, so changing
+    BOOKING_SYSTEM_HMAC_KEY never returns tokens made with the old one."""
+    return hmac.new(key, msg).hexdigest()
+
+
 class BookingSystemEvent(models.Model):
     EVENT_TYPES = (
         ("I", "Member"),
@@ -41,6 +50,9 @@ class BookingSystemEvent(models.Model):
     description = models.CharField(max_length=128, blank=True, null=True)
     event_type = models.CharField(max_length=1, choices=EVENT_TYPES)
     event_id = models.IntegerField(blank=True, null=True)
+    usage_category = models.CharField(max_length=8, choices=usage_categories.USAGE_CATEGORIES, blank=True,
+                                      db_index=True, editable=False)
+    is_peak = models.BooleanField(default=False, editable=False)
     no_show = models.BooleanField(default=False)
     no_show_reporter = models.ForeignKey(auth_models.User, blank=True, null=True, limit_choices_to={"is_active": True},
                                          on_delete=models.SET_NULL, related_name="none+")
@@ -69,11 +81,11 @@ class BookingSystemEvent(models.Model):
     @staticmethod
     def generate_hmac_token(start_time, court):
         msg = "{start_time:%Y-%m-%dT%H:%M}/{court}".format(**locals())
-        return hmac.new(wsrc.site.settings.settings.BOOKING_SYSTEM_HMAC_KEY, msg).hexdigest()
+        return hmac_digest(wsrc.site.settings.settings.BOOKING_SYSTEM_HMAC_KEY, msg)
 
     @staticmethod
     def generate_hmac_token_raw(msg):
-        return hmac.new(wsrc.site.settings.settings.BOOKING_SYSTEM_HMAC_KEY, msg).hexdigest()
+        return hmac_digest(wsrc.site.settings.settings.BOOKING_SYSTEM_HMAC_KEY, msg)
 
     def hmac_token(self):
         start_time = timezone.localtime(self.start_time)
@@ -117,6 +129,31 @@ class BookingSystemEvent(models.Model):
         return BookingSystemEvent.objects.filter(is_active=True, start_time__gte=cutoff_today,
                                                  start_time__lt=midnight_tomorrow).order_by('start_time')
 
+    @classmethod
+    def get_bookings_for_date_range(cls, start_date, end_date, courts=None, earliest_hour=7):
+        """Active bookings from midnight on START_DATE up to midnight after
+        END_DATE (both local dates), optionally restricted to COURTS,
+        excluding bookings starting before EARLIEST_HOUR on any day."""
+        midnight_start = timezone.make_aware(datetime.datetime.combine(start_date, datetime.time()))
+        midnight_end = timezone.make_aware(datetime.datetime.combine(end_date + datetime.timedelta(days=1), datetime.time()))
+        queryset = BookingSystemEvent.objects.filter(is_active=True, start_time__gte=midnight_start,
+                                                     start_time__lt=midnight_end)
+        if courts is not None:
+            queryset = queryset.filter(court__in=courts)
+        return [booking for booking in queryset.order_by('start_time')
+                if timezone.localtime(booking.start_time).hour >= earliest_hour]
+
+    @classmethod
+    def get_change_validator(cls, start_date, end_date):
+        """Return (count, max last_updated) over all bookings, active or not,
+        starting between START_DATE and END_DATE inclusive; any change to
+        those bookings changes this pair"""
+        midnight_start = timezone.make_aware(datetime.datetime.combine(start_date, datetime.time()))
+        midnight_end = timezone.make_aware(datetime.datetime.combine(end_date + datetime.timedelta(days=1), datetime.time()))
+        result = BookingSystemEvent.objects.filter(start_time__gte=midnight_start, start_time__lt=midnight_end)\
+                                           .aggregate(count=models.Count("id"), last_updated=models.Max("last_updated"))
+        return result["count"], result["last_updated"]
+
     @classmethod
     def get_all_bookings(cls, start_date):
         return BookingSystemEvent.objects.filter(is_active=True, start_time__gte=start_date).order_by('start_time')
@@ -160,18 +197,62 @@ class BookingSystemEvent(models.Model):
 
     def validate_unique(self, exclude):
         super(BookingSystemEvent, self).validate_unique(exclude)
+        self.validate_no_overlap()
+
+    def validate_no_overlap(self, for_update=False):
         overlap = BookingSystemEvent.objects.filter(is_active=True, court=self.court, start_time__lt=self.end_time,
                                                     end_time__gt=self.start_time)
         if self.pk:
             overlap = overlap.exclude(pk=self.pk)
-        if overlap.count() > 0:
-            raise ValidationError("Would conflict with " + unicode(overlap[0]))
+        if for_update:
+            # a locking read sees the latest committed bookings
+            overlap = overlap.select_for_update()
+        overlap = overlap.first()
+        if overlap is not None:
+            raise ValidationError("Would conflict with " + unicode(overlap))
+
+    @classmethod
+    def from_db(clazz, db, field_names, values):
+        instance = super(BookingSystemEvent, clazz).from_db(db, field_names, values)
+        instance.remember_saved_state()
+        return instance
+
+    def remember_saved_state(self):
+        "Record where the booking is held in the database, so that saving it needs no further read"
+        self._saved_state = tuple(self.__dict__.get(name) for name in ("court", "start_time", "end_time", "is_active"))
+
+    def get_saved_state(self):
+        "The (court, start_time, end_time, is_active) held in the database, or None for a new booking"
+        if self.pk is None:
+            return None
+        saved_state = getattr(self, "_saved_state", None)
+        if saved_state is None or None in saved_state:
+            saved_state = BookingSystemEvent.objects.filter(pk=self.pk)\
+                .values_list("court", "start_time", "end_time", "is_active").first()
+            self._saved_state = saved_state
+        return saved_state
 
     def save(self, *args, **kwargs):
-        is_new = self.pk is None
+        saved_state = self.get_saved_state()
+        is_new = saved_state is None
         super(BookingSystemEvent, self).save(*args, **kwargs)
-        audit = BookingSystemEventAuditEntry.create_from_current(self, is_new=is_new)
+        audit = BookingSystemEventAuditEntry.create_from_current(self, is_new=is_new,
+                                                                 previous_start_time=saved_state and saved_state[1])
         audit.save()
+        self.remember_saved_state()
+
+    def save_if_free(self):
+        """Save this booking, raising ValidationError if it overlaps another
+        active booking. Must be called within a transaction - bookings on
+        the same court and day are serialized by holding the CourtDayLock
+        for that day until it ends, so concurrent requests for the same
+        slot cannot both succeed. Edits which keep an active booking in
+        place, or cancel it, cannot conflict and take no lock."""
+        saved_state = self.get_saved_state()
+        if self.is_active and saved_state != (self.court, self.start_time, self.end_time, True):
+            CourtDayLock.acquire(self.court, timezone.localtime(self.start_time).date())
+            self.validate_no_overlap(for_update=True)
+        self.save()
 
     def delete(self, *args, **kwargs):
         raise Exception("Bookings cannot be deleted, set is_active to False instead")
@@ -191,6 +272,34 @@ class BookingSystemEvent(models.Model):
         ordering = ("-start_time", "-court")
 
 
+class CourtDayLock(models.Model):
+    "A row per court and day, updated to serialize booking changes for that day"
+    court = models.SmallIntegerField()
+    date = models.DateField()
+    lock_count = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def acquire(cls, court, date):
+        "Lock COURT on DATE until the end of the current transaction"
+        if not transaction.get_connection().in_atomic_block:
+            raise transaction.TransactionManagementError("CourtDayLock must be acquired within a transaction")
+        def update():
+            return cls.objects.filter(court=court, date=date).update(lock_count=models.F("lock_count") + 1)
+        if update() == 0:
+            try:
+                with transaction.atomic():
+                    cls.objects.create(court=court, date=date, lock_count=1)
+            except IntegrityError:
+                # created concurrently, so wait for that transaction
+                update()
+
+    def __unicode__(self):
+        return u"Court {court} {date:%Y-%m-%d}".format(**self.__dict__)
+
+    class Meta:
+        unique_together = ("court", "date")
+
+
 class BookingSystemEventAuditEntry(models.Model):
     booking = models.ForeignKey(BookingSystemEvent, on_delete=models.CASCADE)
     UPDATE_TYPES = (
@@ -204,17 +313,22 @@ class BookingSystemEventAuditEntry(models.Model):
     event_type = models.CharField(max_length=1, choices=BookingSystemEvent.EVENT_TYPES)
     updated = models.DateTimeField()
     updated_by = models.ForeignKey(auth_models.User, on_delete=models.PROTECT)
+    # where the booking was moved from, so that the change is seen on both days
+    previous_start_time = models.DateTimeField(blank=True, null=True, db_index=True)
 
     @classmethod
-    def create_from_current(cls, obj, is_new=False):
+    def create_from_current(cls, obj, is_new=False, previous_start_time=None):
         if is_new:
             update_type = "C"
         elif obj.is_active:
             update_type = "U"
         else:
             update_type = "D"
+        if previous_start_time == obj.start_time:
+            previous_start_time = None
         self = cls(update_type=update_type, booking=obj, name=obj.name, description=obj.description,
-                   event_type=obj.event_type, updated=obj.last_updated, updated_by=obj.last_updated_by)
+                   event_type=obj.event_type, updated=obj.last_updated, updated_by=obj.last_updated_by,
+                   previous_start_time=previous_start_time)
         return self
 
     def __unicode__(self):
@@ -297,16 +411,159 @@ class BookingOffence(models.Model):
 
     @classmethod
     def get_total_points_for_player(clazz, player, date=None, total_offences=None):
+        if date is None and total_offences is None:
+            # current total, from the ledger
+            return PenaltyPoints.get_points_for_player(player)
         if total_offences is None:
             total_offences = clazz.get_offences_for_player(player, date)
         return total_offences.aggregate(models.Sum('penalty_points')).get('penalty_points__sum')
 
+    @classmethod
+    def get_points_window(clazz, now=None):
+        "Start and end of the window of offences counted today, as in get_offences_for_player()"
+        if now is None:
+            now = timezone.now()
+        today = timezone.localtime(now).date()
+        start_date = today - datetime.timedelta(days=clazz.CUTOFF_DAYS + 1)
+        return (datetime.datetime.combine(start_date, datetime.time(0, 0, tzinfo=UK_TZINFO)),
+                datetime.datetime.combine(today, datetime.time(0, 0, tzinfo=UK_TZINFO)))
+
+    def get_points_start(self):
+        "Time from which this offence's points count"
+        date = timezone.localtime(self.start_time).date() + datetime.timedelta(days=1)
+        return datetime.datetime.combine(date, datetime.time(0, 0, tzinfo=UK_TZINFO))
+
+    def get_points_expiry(self):
+        "Time from which this offence's points no longer count"
+        date = timezone.localtime(self.start_time).date() + datetime.timedelta(days=self.CUTOFF_DAYS + 2)
+        return datetime.datetime.combine(date, datetime.time(0, 0, tzinfo=UK_TZINFO))
+
+    def get_next_points_change(self, now=None):
+        "The next time this offence's points start or stop counting, or None"
+        if now is None:
+            now = timezone.now()
+        for change in (self.get_points_start(), self.get_points_expiry()):
+            if change > now:
+                return change
+        return None
+
+    def get_counted_points(self, window):
+        start, end = window
+        if self.is_active and start <= self.start_time < end:
+            return self.penalty_points
+        return 0
+
+    @classmethod
+    def from_db(clazz, db, field_names, values):
+        instance = super(BookingOffence, clazz).from_db(db, field_names, values)
+        instance.remember_saved_state()
+        return instance
+
+    def remember_saved_state(self):
+        "Record the state held in the database, from which the ledger was updated"
+        self._saved_state = (self.player_id, self.is_active, self.penalty_points, self.start_time)
+
     class Meta:
         verbose_name = "Booking Offence"
         verbose_name_plural = "Booking Offences"
         ordering = ["-start_time"]
 
 
+class PenaltyPoints(models.Model):
+    """Each player's current total of penalty points, kept up to date as
+    offences are saved and deleted, so that totals can be read - and the
+    players near the limit found - without aggregating offences. Points
+    count from the day after an offence until they age out of the
+    window; the daily age() run recalculates the players whose
+    next_expiry, the next time their total changes, has passed."""
+    player = models.OneToOneField(user_models.Player, on_delete=models.CASCADE, primary_key=True,
+                                  related_name="penalty_points")
+    points = models.IntegerField(default=0, db_index=True)
+    next_expiry = models.DateTimeField(blank=True, null=True, db_index=True)
+
+    @classmethod
+    def get_points_for_player(clazz, player):
+        ledger = clazz.objects.filter(player=player).first()
+        # a change due since the ledgers were last aged is applied now
+        if ledger is None or (ledger.next_expiry is not None and ledger.next_expiry <= timezone.now()):
+            ledger = clazz.recalculate([player.pk])[player.pk]
+        return ledger.points
+
+    @classmethod
+    def add_offence(clazz, offence, points):
+        "Apply a change of POINTS counted for OFFENCE's player"
+        ledger = clazz.objects.filter(player_id=offence.player_id)
+        if points != 0:
+            if not ledger.update(points=models.F("points") + points):
+                # no ledger yet - the offence is already saved, so it is included
+                clazz.recalculate([offence.player_id])
+                return
+        elif not offence.is_active or not offence.penalty_points:
+            return
+        change = offence.get_next_points_change()
+        if change is not None and offence.is_active:
+            if not ledger.filter(models.Q(next_expiry__isnull=True) | models.Q(next_expiry__gt=change))\
+                         .update(next_expiry=change) and not ledger.exists():
+                clazz.recalculate([offence.player_id])
+
+    @classmethod
+    def recalculate(clazz, player_ids, now=None):
+        "Recalculate the ledgers of the given players from their offences, returning them by player id"
+        player_ids = set(player_ids)
+        start, end = BookingOffence.get_points_window(now)
+        offences = BookingOffence.objects.filter(player_id__in=player_ids, is_active=True).order_by()
+        totals = offences.filter(start_time__gte=start, start_time__lt=end).values("player_id")\
+                         .annotate(points=models.Sum("penalty_points"), first=models.Min("start_time"))
+        totals = dict([(row["player_id"], row) for row in totals])
+        # offences not counted until a later day
+        pending = offences.filter(start_time__gte=end).exclude(penalty_points=0).values("player_id")\
+                          .annotate(first=models.Min("start_time"))
+        pending = dict([(row["player_id"], row["first"]) for row in pending])
+        result = dict()
+        with transaction.atomic():
+            for player_id in player_ids:
+                row = totals.get(player_id)
+                changes = []
+                if row is not None:
+                    changes.append(BookingOffence(start_time=row["first"]).get_points_expiry())
+                if player_id in pending:
+                    changes.append(BookingOffence(start_time=pending[player_id]).get_points_start())
+                defaults = {"points": row["points"] if row is not None else 0,
+                            "next_expiry": min(changes) if changes else None}
+                result[player_id], created = clazz.objects.update_or_create(player_id=player_id, defaults=defaults)
+        return result
+
+    @classmethod
+    def age(clazz, now=None):
+        "Apply the day's changes, recalculating only the ledgers with a change due. Returns the number updated"
+        if now is None:
+            now = timezone.now()
+        player_ids = clazz.objects.filter(next_expiry__lte=now).values_list("player_id", flat=True)
+        return len(clazz.recalculate(list(player_ids), now))
+
+    @classmethod
+    def rebuild(clazz, now=None):
+        "Recalculate the ledgers of every player with offences"
+        player_ids = set(BookingOffence.objects.values_list("player_id", flat=True).distinct())
+        player_ids.update(clazz.objects.values_list("player_id", flat=True))
+        return len(clazz.recalculate(player_ids, now))
+
+    @classmethod
+    def get_players_near_limit(clazz, margin=2):
+        "Ledgers of players within MARGIN points of the limit or over it, highest first"
+        clazz.age()
+        return clazz.objects.filter(points__gte=BookingOffence.POINT_LIMIT - margin)\
+                            .select_related("player__user").order_by("-points")
+
+    def __unicode__(self):
+        return u"{0}: {1}".format(self.player, self.points)
+
+    class Meta:
+        verbose_name = "Penalty Points"
+        verbose_name_plural = "Penalty Points"
+        ordering = ["-points"]
+
+
 class DayOfWeek(models.Model):
     name = models.CharField(max_length=3)
     ordinal = models.IntegerField(unique=True)
@@ -325,6 +582,7 @@ class EventFilter(models.Model):
     latest = models.TimeField()
     days = models.ManyToManyField(DayOfWeek, blank=True)
     notice_period_minutes = models.IntegerField("Minimum Notice")
+    last_updated = models.DateTimeField(auto_now=True)
 
     def clean(self):
         super(EventFilter, self).clean()
@@ -340,6 +598,12 @@ class EventFilter(models.Model):
         verbose_name = "Cancellation Notifier"
 
 
+class CancellationNotice(models.Model):
+    "A cancelled booking, awaiting the next cancellation digest - see cancel_notifier"
+    booking = models.ForeignKey(BookingSystemEvent, on_delete=models.CASCADE)
+    cancelled_at = models.DateTimeField()
+
+
 class ClimateMeasurement(models.Model):
     location = models.CharField(max_length=64)
     time = models.DateTimeField()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# This file is part of WSRC.
+#
+# WSRC is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WSRC is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WSRC.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Court occupancy at a fixed time resolution.
+
+Each court's day is packed into an integer bitset, bit N being set if
+the slot starting N*resolution minutes after midnight is booked, so
+that free and booked runs can be found with a handful of integer
+operations per run rather than by walking the day slot-by-slot.
+"""
+
+import collections
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def _lowest_bit_index(bits):
+    return (bits & -bits).bit_length() - 1
+
+
+def _iter_runs(bits):
+    "Yield (first, last+1) slot indices of each run of set bits"
+    while bits:
+        first = _lowest_bit_index(bits)
+        shifted = bits >> first
+        length = _lowest_bit_index(~shifted & (shifted + 1))
+        yield first, first + length
+        bits &= ~(((1 << length) - 1) << first)
+
+
+class DayOccupancy(object):
+    "Occupancy of each court on a single day"
+
+    def __init__(self, resolution_mins, date=None):
+        self.resolution = resolution_mins
+        self.nslots = MINUTES_PER_DAY // resolution_mins
+        self.date = date
+        self.full_mask = (1 << self.nslots) - 1
+        self.courts = collections.defaultdict(int)
+
+    def to_slot(self, mins):
+        return mins // self.resolution
+
+    def to_mins(self, slot):
+        return slot * self.resolution
+
+    def range_mask(self, start_mins, end_mins):
+        "Bitmask for the slots covering [START_MINS, END_MINS), clipped to the day"
+        first = max(0, self.to_slot(start_mins))
+        last = min(self.nslots, -(-end_mins // self.resolution))
+        if last <= first:
+            return 0
+        return ((1 << (last - first)) - 1) << first
+
+    def add(self, court, start_mins, duration_mins):
+        self.courts[court] |= self.range_mask(start_mins, start_mins + duration_mins)
+
+    def add_booking(self, booking):
+        self.add(booking.court, booking.start_minutes, booking.duration_minutes)
+
+    def bits(self, court):
+        return self.courts.get(court, 0)
+
+    def is_free(self, court, start_mins, duration_mins):
+        return not (self.bits(court) & self.range_mask(start_mins, start_mins + duration_mins))
+
+    def booked_slot_count(self, court):
+        return bin(self.bits(court)).count("1")
+
+    def booked_runs(self, court):
+        "Yield (start_slot, end_slot) for each contiguous booked period"
+        return _iter_runs(self.bits(court))
+
+    def free_runs(self, court, start_mins=0, end_mins=MINUTES_PER_DAY):
+        "Yield (start_mins, end_mins) for each free period within [START_MINS, END_MINS)"
+        free = ~self.bits(court) & self.range_mask(start_mins, end_mins)
+        for first, last in _iter_runs(free):
+            yield self.to_mins(first), self.to_mins(last)
+
+
+class OccupancyGrid(object):
+    "Occupancy indexed by (date, court, slot) over any number of days"
+
+    def __init__(self, resolution_mins):
+        self.resolution = resolution_mins
+        self.days = dict()
+
+    def day(self, date):
+        day = self.days.get(date)
+        if day is None:
+            day = self.days[date] = DayOccupancy(self.resolution, date)
+        return day
+
+    def add(self, date, court, start_mins, duration_mins):
+        self.day(date).add(court, start_mins, duration_mins)
+
+    def add_bookings(self, bookings, date_getter=lambda b: b.start_time.date()):
+        for booking in bookings:
+            self.day(date_getter(booking)).add_booking(booking)
+        return self
+
+    def slot_totals(self, dates, courts):
+        "Number of the given (date, court) pairs booked in each slot of the day"
+        # mark where each booked run starts and ends, then accumulate, so
+        # the cost is per run and per slot of the day, not per booked slot
+        nslots = MINUTES_PER_DAY // self.resolution
+        changes = [0] * (nslots + 1)
+        for date in dates:
+            day = self.days.get(date)
+            if day is None:
+                continue
+            for court in courts:
+                for first, last in day.booked_runs(court):
+                    changes[first] += 1
+                    changes[last] -= 1
+        totals = []
+        count = 0
+        for change in changes[:nslots]:
+            count += change
+            totals.append(count)
+        return totals
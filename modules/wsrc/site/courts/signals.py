@@ -14,15 +14,61 @@
 # along with WSRC.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from django.db.models.signals import post_save
+from django.contrib.auth.models import User
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
 from django.dispatch import receiver
-from .models import BookingSystemEvent
-from .cancel_notifier import Notifier
+from .models import BookingOffence, BookingSystemEvent, EventFilter, PenaltyPoints
+from .cancel_notifier import queue_cancellation, invalidate_subscription_index
+from .usage_categories import classify_booking
 
 @receiver(post_save, sender=BookingSystemEvent, dispatch_uid="42fd3c1e732611e8a541e512b4beadf4")
 def my_handler(sender, *args, **kwargs):
     if kwargs.get("created", False) != True:
         instance = kwargs["instance"]
         if not instance.is_active:
-            notifier = Notifier()
-            notifier.async_process_removed_events(instance)
+            queue_cancellation(instance)
+
+@receiver(pre_save, sender=BookingSystemEvent, dispatch_uid="5e2a7c9b1d3f11f1b6a80242ac120002")
+def set_usage_category(sender, instance, raw=False, *args, **kwargs):
+    if not raw:
+        classify_booking(instance)
+
+# saving or deleting a filter, or the email template, is seen by the
+# notifier from the tables; changes to days and users are not
+@receiver(m2m_changed, sender=EventFilter.days.through, dispatch_uid="c3e8a0d6f21b4c7e9a5d1b2f6e4c8a03")
+def invalidate_notifier_subscriptions(sender, instance, action, reverse=False, *args, **kwargs):
+    if not action.startswith("post_"):
+        return
+    if reverse:
+        invalidate_subscription_index(EventFilter.objects.all())
+    else:
+        invalidate_subscription_index(EventFilter.objects.filter(pk=instance.pk))
+
+@receiver(post_save, sender=User, dispatch_uid="c3e8a0d6f21b4c7e9a5d1b2f6e4c8a04")
+def invalidate_notifier_subscriber(sender, instance, update_fields=None, *args, **kwargs):
+    # subscriptions hold the player's name and are dropped when the user
+    # is deactivated; ignore the last_login update made on every login
+    if update_fields is not None and set(update_fields) <= set(["last_login"]):
+        return
+    invalidate_subscription_index(EventFilter.objects.filter(player__user=instance))
+
+@receiver(post_save, sender=BookingOffence, dispatch_uid="5e0b7c2a94d311f1b6c80242ac120003")
+def update_penalty_points(sender, instance, created=False, raw=False, *args, **kwargs):
+    previous = getattr(instance, "_saved_state", None)
+    if not created and (raw or previous is None or previous[0] != instance.player_id):
+        # the points previously counted are unknown
+        player_ids = [instance.player_id] if previous is None else [previous[0], instance.player_id]
+        PenaltyPoints.recalculate(player_ids)
+    else:
+        window = BookingOffence.get_points_window()
+        points = instance.get_counted_points(window)
+        if previous is not None:
+            player_id, is_active, penalty_points, start_time = previous
+            if is_active and window[0] <= start_time < window[1]:
+                points -= penalty_points
+        PenaltyPoints.add_offence(instance, points)
+    instance.remember_saved_state()
+
+@receiver(post_delete, sender=BookingOffence, dispatch_uid="5e0b7c2a94d311f1b6c80242ac120004")
+def remove_penalty_points(sender, instance, *args, **kwargs):
+    PenaltyPoints.add_offence(instance, -instance.get_counted_points(BookingOffence.get_points_window()))
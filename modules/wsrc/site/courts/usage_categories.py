@@ -0,0 +1,126 @@
+# This file is part of WSRC.
+#
+# WSRC is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WSRC is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WSRC.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Usage categories of court bookings.
+
+Each booking is classified when it is saved, and the category stored
+in its usage_category column so that court usage can be summarised in
+the database. The classifier is the function named by the
+BOOKING_USAGE_CLASSIFIER setting, taking a booking's name and event
+type and returning one of the category codes below; by default it is
+classify(), which applies USAGE_RULES in order. After changing the
+rules, run "wsrc classify-bookings --all" to reclassify existing
+bookings. Whether a booking starts at a peak time is stored alongside
+its category, in its is_peak column.
+"""
+
+import logging
+
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+import wsrc.site.settings.settings as settings
+from wsrc.utils.timezones import UK_TZINFO
+
+LOGGER = logging.getLogger(__name__)
+
+CLUB_NIGHT = "club"
+TEAMS = "teams"
+JUNIOR_COACHING = "junior"
+MEMBERS = "members"
+OTHER = "other"
+
+USAGE_CATEGORIES = (
+    (CLUB_NIGHT, "Club Night"),
+    (TEAMS, "Teams"),
+    (JUNIOR_COACHING, "Junior Coaching"),
+    (MEMBERS, "Members"),
+    (OTHER, "Other"),
+)
+
+TEAM_NAMES = ("mens", "woking", "vets", "vintage", "ladies", "racketball")
+
+# (category, predicate on lower-cased name and event type), first match wins
+USAGE_RULES = [
+    (CLUB_NIGHT, lambda name, event_type: name == "club night"),
+    (TEAMS, lambda name, event_type: (" vs " in name or " vs. " in name) and
+     any(team in name for team in TEAM_NAMES)),
+    (JUNIOR_COACHING, lambda name, event_type: "junior" in name),
+    (MEMBERS, lambda name, event_type: event_type in ("I", "")),
+]
+
+# weekdays from 5pm until 9pm, UK time
+PEAK_HOURS = (17, 21)
+PEAK_WEEKDAYS = range(0, 5)
+
+BATCH_SIZE = 2000
+
+_classifier = None
+
+
+def classify(name, event_type):
+    "The default classifier, applying USAGE_RULES"
+    name = (name or "").lower().strip()
+    for category, rule in USAGE_RULES:
+        if rule(name, event_type):
+            return category
+    return OTHER
+
+
+def get_classifier():
+    global _classifier
+    if _classifier is None:
+        path = getattr(settings, "BOOKING_USAGE_CLASSIFIER", None)
+        _classifier = import_string(path) if path else classify
+    return _classifier
+
+
+def is_peak_time(start_time):
+    start_time = start_time.astimezone(UK_TZINFO)
+    return start_time.weekday() in PEAK_WEEKDAYS and PEAK_HOURS[0] <= start_time.hour < PEAK_HOURS[1]
+
+
+def classify_booking(booking):
+    "Set the usage category and peak flag of BOOKING, returning the category"
+    booking.usage_category = get_classifier()(booking.name, booking.event_type)
+    booking.is_peak = is_peak_time(booking.start_time)
+    return booking.usage_category
+
+
+def classify_bookings(queryset):
+    """Reclassify the bookings in QUERYSET a batch at a time, with one
+    UPDATE per category and peak flag in each batch. Returns the number
+    changed."""
+    classifier = get_classifier()
+    rows = queryset.order_by("pk").values_list("pk", "name", "event_type", "start_time", "usage_category", "is_peak")
+    nchanged = 0
+    last_pk = None
+    while True:
+        batch = rows.filter(pk__gt=last_pk) if last_pk is not None else rows
+        batch = list(batch[:BATCH_SIZE])
+        if not batch:
+            break
+        changes = dict()
+        for pk, name, event_type, start_time, current, current_peak in batch:
+            classification = (classifier(name, event_type), is_peak_time(start_time))
+            if classification != (current, current_peak):
+                changes.setdefault(classification, []).append(pk)
+        with transaction.atomic():
+            for (category, is_peak), pks in changes.iteritems():
+                nchanged += queryset.model.objects.filter(pk__in=pks).update(usage_category=category,
+                                                                             is_peak=is_peak)
+        last_pk = batch[-1][0]
+    LOGGER.info("reclassified %d booking(s)", nchanged)
+    return nchanged
@@ -27,6 +27,7 @@ from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.auth.models import User
 from django.core.exceptions import SuspiciousOperation, PermissionDenied, ValidationError
 from django.core.mail import SafeMIMEMultipart, SafeMIMEText
+from django.core.validators import validate_email
 from django.db import transaction
 from django.db.models import Q
 from django.http import HttpResponse, HttpResponsePermanentRedirect, HttpResponseNotFound
@@ -44,8 +45,11 @@ from wsrc.site.courts.models import BookingSystemEvent, EventFilter, BookingOffe
 from wsrc.site.usermodel.models import Player
 from wsrc.utils import timezones, email_utils
 from wsrc.utils.form_utils import make_readonly_widget, add_formfield_attrs
+from wsrc.utils.http_utils import make_etag, conditional_response
 from wsrc.utils.html_table import Table, Cell, SpanningCell
-from .court_slot_utils import add_free_slots
+from . import day_cache
+from .court_slot_utils import add_free_slots, get_free_slots
+from .occupancy import OccupancyGrid
 from .forms import START_TIME, END_TIME, RESOLUTION, COURTS, \
     format_date, make_date_formats, create_notifier_filter_formset_factory, \
     BookingForm, CalendarInviteForm, CondensationReportForm
@@ -79,17 +83,19 @@ def get_server_time(headers):
 def get_bookings(date, ignore_cutoff=False):
     if True:
         MIDNIGHT_NAIVE = datetime.time()
-        date = timezone.make_aware(datetime.datetime.combine(date, MIDNIGHT_NAIVE))
-        booked_slots = BookingSystemEvent.get_bookings_for_date(date)
+        midnight = timezone.make_aware(datetime.datetime.combine(date, MIDNIGHT_NAIVE))
         now = timezone.localtime(timezone.now())
-        results = dict([(court, []) for court in COURTS])
-        for booked_slot in booked_slots:
-            results[booked_slot.court].append(booked_slot)
-        for court in COURTS:
-            booked_slots = results[court]
-            add_free_slots(court, booked_slots, date, now, ignore_cutoff)
-            results[court] = dict([(slot["start_mins"], slot) for slot in booked_slots])
-        return now, results
+        def compute_grid():
+            booked_slots = BookingSystemEvent.get_bookings_for_date(midnight)
+            results = dict([(court, []) for court in COURTS])
+            for booked_slot in booked_slots:
+                results[booked_slot.court].append(booked_slot)
+            for court in COURTS:
+                court_slots = results[court]
+                add_free_slots(court, court_slots, midnight, now, ignore_cutoff)
+                results[court] = dict([(slot["start_mins"], slot) for slot in court_slots])
+            return results
+        return now, day_cache.get_or_set(date, now, ("grid", ignore_cutoff), compute_grid)
 
 
 def get_booking_form_data(id):
@@ -110,8 +116,7 @@ def create_booking(user, slot, is_admin_view=False):
         model.created_by_user = user
         model.last_updated_by = user
         model.created_time = now
-        model.validate_unique([])
-        model.save()
+        model.save_if_free()
         return now, model
 
 
@@ -130,7 +135,7 @@ def update_booking(user, event_id, booking_form):
         model.description = slot["description"]
         model.event_type = slot["booking_type"]
         model.last_updated_by = user
-        model.save()
+        model.save_if_free()
         now = timezone.localtime(timezone.now())
         return now, model
 
@@ -322,15 +327,22 @@ def day_view(request, date=None, is_admin_view=False):
         date = datetime.date.today()
     else:
         date = timezones.parse_iso_date_to_naive(date)
-    player = Player.get_player_for_user(request.user)
-    server_time, bookings = get_bookings(date, ignore_cutoff=is_admin_view)
     allow_booking_shortcut = settings.BOOKING_SYSTEM_ALLOW_BOOKING_SHORTCUT and \
                              request.user.is_authenticated()
     if is_admin_view:
         allow_booking_shortcut = False
-    table_html = render_day_table(bookings, date, server_time, allow_booking_shortcut, is_admin_view)
+    def compute_table():
+        server_time, bookings = get_bookings(date, ignore_cutoff=is_admin_view)
+        return render_day_table(bookings, date, server_time, allow_booking_shortcut, is_admin_view)
+    now = timezone.localtime(timezone.now())
+    variant = ("table", allow_booking_shortcut, is_admin_view)
     if request.GET.get("table_only") is not None:
-        return HttpResponse(table_html)
+        # the table changes with the bookings and, via the booking tokens, with the time period
+        version = day_cache.get_date_version(date)
+        etag = make_etag(date, version[0], version[1], day_cache.get_time_period(now), *variant)
+        return conditional_response(request, etag,
+                                    lambda: HttpResponse(day_cache.get_or_set(date, now, variant, compute_table, version)))
+    table_html = day_cache.get_or_set(date, now, variant, compute_table)
     context = {
         "date": date,
         "prev_date": date - datetime.timedelta(days=1),
@@ -349,6 +361,85 @@ def day_view_redirect(request, date=None):
     return HttpResponsePermanentRedirect(url)
 
 
+def find_available_slots(start_date, end_date, earliest_mins, latest_mins, min_duration_mins,
+                         courts=COURTS, days_of_week=None):
+    """Find bookable slots between START_DATE and END_DATE inclusive, lying
+    within [EARLIEST_MINS, LATEST_MINS] of the day and at least
+    MIN_DURATION_MINS long, on any of COURTS and optionally only on the
+    given DAYS_OF_WEEK (ISO weekday numbers). A booking may run on over
+    the free slots following its first, so each slot's duration is
+    extended by those slots until it reaches MIN_DURATION_MINS. Returns a
+    list of (date, court, slot) tuples in date and time order."""
+    now = timezone.localtime(timezone.now())
+    bookings = BookingSystemEvent.get_bookings_for_date_range(start_date, end_date, courts)
+    grid = OccupancyGrid(settings.BOOKING_SYSTEM_RESOLUTION_MINS)
+    grid.add_bookings(bookings, lambda b: timezone.localtime(b.start_time).date())
+    results = []
+    date = start_date
+    while date <= end_date:
+        if days_of_week is None or date.isoweekday() in days_of_week:
+            midnight = timezone.make_aware(datetime.datetime.combine(date, datetime.time()))
+            occupancy = grid.day(date)
+            for court in courts:
+                slots = [slot for slot in get_free_slots(court, occupancy, midnight, now)
+                         if "token" in slot and slot["start_mins"] >= earliest_mins and
+                         slot["start_mins"] + slot["duration_mins"] <= latest_mins]
+                for idx, slot in enumerate(slots):
+                    duration_mins = slot["duration_mins"]
+                    for following in slots[idx+1:]:
+                        if duration_mins >= min_duration_mins or \
+                           following["start_mins"] != slot["start_mins"] + duration_mins:
+                            break
+                        duration_mins += following["duration_mins"]
+                    if duration_mins >= min_duration_mins:
+                        results.append((date, court, dict(slot, duration_mins=duration_mins)))
+        date += datetime.timedelta(days=1)
+    results.sort(key=lambda r: (r[0], r[2]["start_mins"], r[1]))
+    return results
+
+
+@require_safe
+def availability_view(request):
+    """JSON search for bookable slots. Parameters are start_date and
+    optional end_date (YYYY-MM-DD), earliest and latest times of day
+    (HH:MM), min_duration in minutes, and comma-separated courts and
+    days (ISO weekday numbers)."""
+    MAX_DAYS = 31
+    params = request.GET
+    def parse_mins(s):
+        (hour, minute) = [int(x) for x in s.split(":")]
+        return hour * 60 + minute
+    def parse_list(s):
+        return [int(x) for x in s.split(",")]
+    try:
+        start_date = timezones.parse_iso_date_to_naive(params["start_date"])
+        end_date = timezones.parse_iso_date_to_naive(params.get("end_date", params["start_date"]))
+        earliest_mins = parse_mins(params.get("earliest", "00:00"))
+        latest_mins = parse_mins(params.get("latest", "24:00"))
+        min_duration_mins = int(params.get("min_duration", RESOLUTION))
+        courts = parse_list(params["courts"]) if "courts" in params else COURTS
+        days_of_week = parse_list(params["days"]) if "days" in params else None
+    except (KeyError, ValueError), e:
+        raise SuspiciousOperation("invalid search parameters: " + str(e))
+    if end_date < start_date or (end_date - start_date).days >= MAX_DAYS:
+        raise SuspiciousOperation("date range must be between 1 and {0} days".format(MAX_DAYS))
+    if not set(courts).issubset(COURTS):
+        raise SuspiciousOperation("unknown court requested")
+
+    slots = []
+    for date, court, slot in find_available_slots(start_date, end_date, earliest_mins, latest_mins,
+                                                  min_duration_mins, courts, days_of_week):
+        slots.append({
+            "date": timezones.as_iso_date(date),
+            "court": court,
+            "start_time": slot["start_time"],
+            "duration_mins": slot["duration_mins"],
+            "token": slot["token"],
+            "booking_link": make_booking_link(slot, court, date),
+        })
+    return HttpResponse(json.dumps({"slots": slots}), content_type="application/json")
+
+
 @user_passes_test(has_admin_permission)
 def edit_entry_admin_view(request, id=None):
     return edit_entry_view(request, id, is_admin_view=True)
@@ -435,6 +526,9 @@ def edit_entry_view(request, event_id=None, is_admin_view=False):
                     send_calendar_invite(request, booking_form.cleaned_data, [request.user], "update")
                     back = reverse_url(reverse_view, args=[booking_form.cleaned_data["date"]])
                     return redirect(back)
+        except ValidationError, e:
+            booking_form.add_error(None, ", ".join(e.messages))
+            response_code = httplib.CONFLICT
         except RemoteException, e:
             if e.status == httplib.NOT_MODIFIED:
                 back = reverse_url(day_view, booking_form.cleaned_data["date"])
@@ -543,37 +637,40 @@ def edit_entry_view(request, event_id=None, is_admin_view=False):
 
 
 def send_calendar_invite(request, slot, recipients, event_type):
-    method = "CANCEL" if event_type == "delete" else "REQUEST"
-    cal = create_icalendar(request, slot, recipients, method)
-    encoding = settings.DEFAULT_CHARSET
-    cal_encoding = parser_tools.DEFAULT_ENCODING
-    cal_body_unicode = cal.to_ical().decode(cal_encoding)
-    msg_cal = SafeMIMEText(cal_body_unicode, "calendar", encoding)
-    msg_cal.set_param("method", method)
-    context = {
-        'event_type': event_type
-    }
-    context.update(slot)
-    text_body, html_body = email_utils.get_email_bodies("BookingUpdate", context)
-    msg_bodies = SafeMIMEMultipart(_subtype="alternative", encoding=encoding)
-    msg_bodies.attach(SafeMIMEText(text_body, "plain", encoding))
-    msg_bodies.attach(SafeMIMEText(html_body, "html", encoding))
-    to_list = [user.email for user in recipients]
-    subject = "WSRC Court Booking - {date:%Y-%m-%d} {start_time:%H:%M} Court {court}".format(**slot)
+    """Queue the calendar invite for a booking change. The message is
+    built in full first, so that any failure is reported to the user
+    rather than left for the outbox's delivery job."""
     try:
-        email_utils.send_email(subject, "", None,
-                               from_address=settings.BOOKING_SYSTEM_EMAIL_ADDRESS,
-                               to_list=to_list, cc_list=None,
-                               extra_attachments=[msg_bodies, msg_cal])
+        to_list = [user.email for user in recipients]
+        if not all(to_list):
+            raise ValidationError("no email address for the calendar invite")
+        for address in to_list:
+            validate_email(address)
+        method = "CANCEL" if event_type == "delete" else "REQUEST"
+        cal = create_icalendar(request, slot, recipients, method)
+        encoding = settings.DEFAULT_CHARSET
+        cal_encoding = parser_tools.DEFAULT_ENCODING
+        cal_body_unicode = cal.to_ical().decode(cal_encoding)
+        msg_cal = SafeMIMEText(cal_body_unicode, "calendar", encoding)
+        msg_cal.set_param("method", method)
+        context = {
+            'event_type': event_type
+        }
+        context.update(slot)
+        text_body, html_body = email_utils.get_email_bodies("BookingUpdate", context)
+        msg_bodies = SafeMIMEMultipart(_subtype="alternative", encoding=encoding)
+        msg_bodies.attach(SafeMIMEText(text_body, "plain", encoding))
+        msg_bodies.attach(SafeMIMEText(html_body, "html", encoding))
+        subject = "WSRC Court Booking - {date:%Y-%m-%d} {start_time:%H:%M} Court {court}".format(**slot)
+        email_utils.queue_email(subject, "", None,
+                                from_address=settings.BOOKING_SYSTEM_EMAIL_ADDRESS,
+                                to_list=to_list, cc_list=None,
+                                extra_attachments=[msg_bodies, msg_cal])
     except Exception, e:
-        LOGGER.exception("unable to send email")
-        err = ""
-        if hasattr(e, "smtp_code"):
-            err += "EMAIL SERVER ERROR [{smtp_code:d}] {smtp_error:s} ".format(**e.__dict__)
-            if e.message:
-                err += " - "
-        err += e.message
-        raise EmailingException(err)
+        LOGGER.exception("unable to queue email")
+        if isinstance(e, ValidationError):
+            raise EmailingException(", ".join(e.messages))
+        raise EmailingException(e.message or str(e))
 
 
 def create_icalendar(request, cal_data, recipients, method):
@@ -744,7 +841,7 @@ def penalty_points_view(request):
     context = {
         "player": player,
         "total_offences": total_offences,
-        "total_points": BookingOffence.get_total_points_for_player(player, None, total_offences),
+        "total_points": BookingOffence.get_total_points_for_player(player),
         "point_limit": BookingOffence.POINT_LIMIT
     }
     return TemplateResponse(request, 'penalty_points.html', context)
@@ -0,0 +1,190 @@
+# This file is part of WSRC.
+#
+# WSRC is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WSRC is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WSRC.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Durable background jobs, held in the database.
+
+Work that need not hold up a web request - sending emails, notifying
+players of cancellations - is queued with enqueue(), which stores the
+dotted path of a module-level function and its (JSON-serializable)
+keyword arguments as a BackgroundJob row, in the same transaction as
+the request's own changes.
+
+The jobs are run by "wsrc run-worker", a fixed pool of threads which
+each claim one job at a time. Claiming a job leases it for
+VISIBILITY_TIMEOUT_SECS, after which a job whose worker has died is
+picked up again. Failed jobs are retried with exponential backoff
+until they have been attempted max_attempts times.
+"""
+
+import datetime
+import json
+import logging
+import threading
+import traceback
+
+from django.db import close_old_connections, connection
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from wsrc.site.models import BackgroundJob
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_MAX_ATTEMPTS = 5
+VISIBILITY_TIMEOUT_SECS = 300
+BACKOFF_BASE_SECS = 30
+BACKOFF_MAX_SECS = 3600
+POLL_SECS = 5
+PURGE_AFTER_DAYS = 7
+CLAIM_CANDIDATES = 10
+
+
+def enqueue(func, delay=None, max_attempts=DEFAULT_MAX_ATTEMPTS, **kwargs):
+    """Queue a call of FUNC(**KWARGS), to be made no sooner than DELAY
+    (a timedelta) from now. FUNC must be a module-level function."""
+    run_after = timezone.now()
+    if delay is not None:
+        run_after += delay
+    handler = "{0}.{1}".format(func.__module__, func.__name__)
+    return BackgroundJob.objects.create(handler=handler, payload=json.dumps(kwargs),
+                                        run_after=run_after, max_attempts=max_attempts)
+
+
+def enqueue_once(func, delay=datetime.timedelta(0), **kwargs):
+    """Queue a call of FUNC to be made after DELAY, unless a call is
+    already pending which will be made by then. For jobs which process
+    everything outstanding, so that one run covers a burst of work."""
+    handler = "{0}.{1}".format(func.__module__, func.__name__)
+    if not BackgroundJob.objects.filter(handler=handler, status=BackgroundJob.PENDING,
+                                        run_after__lte=timezone.now() + delay).exists():
+        return enqueue(func, delay=delay, **kwargs)
+    return None
+
+
+def get_backoff(attempts):
+    "Delay before the retry following the given number of failed attempts"
+    return datetime.timedelta(seconds=min(BACKOFF_MAX_SECS, BACKOFF_BASE_SECS * 2 ** (attempts - 1)))
+
+
+def claim_next(visibility_timeout=VISIBILITY_TIMEOUT_SECS):
+    """Lease the next due job to this worker, returning it or None. A
+    conditional UPDATE makes the claim, so no two workers can win the
+    same job whatever the database's locking support."""
+    now = timezone.now()
+    available = Q(status=BackgroundJob.PENDING, run_after__lte=now) | \
+        Q(status=BackgroundJob.RUNNING, locked_until__lt=now)
+    candidates = BackgroundJob.objects.filter(available).order_by("run_after").values_list("pk", flat=True)
+    for pk in candidates[:CLAIM_CANDIDATES]:
+        claimed = BackgroundJob.objects.filter(available, pk=pk).update(
+            status=BackgroundJob.RUNNING,
+            locked_until=now + datetime.timedelta(seconds=visibility_timeout),
+            attempts=F("attempts") + 1)
+        if claimed:
+            return BackgroundJob.objects.get(pk=pk)
+    return None
+
+
+def run_job(job):
+    "Call the job's handler and record the outcome"
+    try:
+        if job.attempts > job.max_attempts:
+            raise Exception("abandoned after {0} attempts".format(job.max_attempts))
+        func = import_string(job.handler)
+        func(**json.loads(job.payload))
+    except Exception:
+        LOGGER.exception("job {0} ({1}) failed".format(job.pk, job.handler))
+        fields = {"last_error": traceback.format_exc(), "locked_until": None}
+        if job.attempts >= job.max_attempts:
+            fields.update(status=BackgroundJob.FAILED, completed=timezone.now())
+        else:
+            fields.update(status=BackgroundJob.PENDING, run_after=timezone.now() + get_backoff(job.attempts))
+        BackgroundJob.objects.filter(pk=job.pk, status=BackgroundJob.RUNNING).update(**fields)
+        return False
+    BackgroundJob.objects.filter(pk=job.pk, status=BackgroundJob.RUNNING).update(
+        status=BackgroundJob.DONE, completed=timezone.now(), locked_until=None)
+    return True
+
+
+def run_pending(visibility_timeout=VISIBILITY_TIMEOUT_SECS):
+    "Run due jobs in this thread until there are none left; returns the number run"
+    njobs = 0
+    while True:
+        job = claim_next(visibility_timeout)
+        if job is None:
+            return njobs
+        run_job(job)
+        njobs += 1
+
+
+def purge_completed(days=PURGE_AFTER_DAYS):
+    "Delete jobs which finished, successfully or not, more than DAYS ago"
+    cutoff = timezone.now() - datetime.timedelta(days=days)
+    BackgroundJob.objects.filter(status__in=[BackgroundJob.DONE, BackgroundJob.FAILED],
+                                 completed__lt=cutoff).delete()
+
+
+class Worker(threading.Thread):
+    "Runs jobs until told to stop, polling for new ones when idle"
+
+    def __init__(self, stop_event, poll_secs, visibility_timeout):
+        super(Worker, self).__init__()
+        self.daemon = True
+        self.stop_event = stop_event
+        self.poll_secs = poll_secs
+        self.visibility_timeout = visibility_timeout
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                close_old_connections()
+                job = None
+                try:
+                    job = claim_next(self.visibility_timeout)
+                except Exception:
+                    LOGGER.exception("unable to claim job")
+                if job is None:
+                    self.stop_event.wait(self.poll_secs)
+                else:
+                    run_job(job)
+        finally:
+            connection.close()
+
+
+def run_worker(nthreads=4, poll_secs=POLL_SECS, visibility_timeout=VISIBILITY_TIMEOUT_SECS, stop_event=None):
+    """Run jobs with a pool of NTHREADS threads until STOP_EVENT is set.
+    Blocks the calling thread, which purges old jobs periodically."""
+    if stop_event is None:
+        stop_event = threading.Event()
+    LOGGER.info("starting {0} job worker thread(s)".format(nthreads))
+    workers = [Worker(stop_event, poll_secs, visibility_timeout) for i in range(nthreads)]
+    for worker in workers:
+        worker.start()
+    try:
+        while not stop_event.is_set():
+            try:
+                close_old_connections()
+                purge_completed()
+            except Exception:
+                LOGGER.exception("unable to purge completed jobs")
+            # wait() with a timeout so that signals reach the main thread
+            for i in range(3600):
+                if stop_event.wait(1):
+                    break
+    finally:
+        stop_event.set()
+        for worker in workers:
+            worker.join()
+        connection.close()
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 11:18
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('site', '0004_backgroundjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEmail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.CharField(max_length=255)),
+                ('from_address', models.CharField(max_length=255)),
+                ('recipients', models.TextField(help_text=b'JSON list of envelope recipients')),
+                ('message', models.TextField(help_text=b'MIME message')),
+                ('status', models.CharField(choices=[(b'queued', b'Queued'), (b'sending', b'Sending'), (b'sent', b'Sent'), (b'failed', b'Failed')], default=b'queued', max_length=8)),
+                ('attempts', models.IntegerField(default=0)),
+                ('send_after', models.DateTimeField()),
+                ('locked_until', models.DateTimeField(blank=True, null=True)),
+                ('claim', models.CharField(blank=True, max_length=32)),
+                ('last_error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('sent', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Outbox Email',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='outboxemail',
+            index_together=set([('status', 'send_after')]),
+        ),
+    ]
@@ -284,3 +284,65 @@ class OAuthAccess(models.Model):
         unique_together = ("auth_server_uri", "client_id")
         verbose_name = "OAuth Credentials"
         verbose_name_plural = "OAuth Credentials"
+
+class BackgroundJob(models.Model):
+    "A unit of deferred work, run by the job worker - see wsrc.site.jobs"
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = (
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    )
+    handler = models.CharField(max_length=128, help_text="Dotted path of the function to call")
+    payload = models.TextField(help_text="JSON-encoded keyword arguments")
+    status = models.CharField(max_length=8, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=5)
+    run_after = models.DateTimeField()
+    locked_until = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    completed = models.DateTimeField(blank=True, null=True)
+
+    def __unicode__(self):
+        return u"{0} [{1}]".format(self.handler, self.status)
+
+    class Meta:
+        index_together = ("status", "run_after")
+        verbose_name = "Background Job"
+
+class OutboxEmail(models.Model):
+    "A fully formatted email awaiting delivery - see wsrc.site.outbox"
+    QUEUED = "queued"
+    SENDING = "sending"
+    SENT = "sent"
+    FAILED = "failed"
+    STATUS_CHOICES = (
+        (QUEUED, "Queued"),
+        (SENDING, "Sending"),
+        (SENT, "Sent"),
+        (FAILED, "Failed"),
+    )
+    subject = models.CharField(max_length=255)
+    from_address = models.CharField(max_length=255)
+    recipients = models.TextField(help_text="JSON list of envelope recipients")
+    message = models.TextField(help_text="MIME message")
+    status = models.CharField(max_length=8, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.IntegerField(default=0)
+    send_after = models.DateTimeField()
+    locked_until = models.DateTimeField(blank=True, null=True)
+    claim = models.CharField(max_length=32, blank=True)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    sent = models.DateTimeField(blank=True, null=True)
+
+    def __unicode__(self):
+        return u"{0} [{1}]".format(self.subject, self.status)
+
+    class Meta:
+        index_together = ("status", "send_after")
+        verbose_name = "Outbox Email"
@@ -0,0 +1,174 @@
+# This file is part of WSRC.
+#
+# WSRC is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WSRC is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WSRC.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Outbox for emails, delivered by the background job worker.
+
+queue_message() formats an email and stores it as an OutboxEmail row,
+in the caller's transaction, so that an email is only sent if the
+change it reports is committed, and the caller never waits on the mail
+server. It also queues a delivery job (unless one is already waiting),
+which sends everything in the outbox over a single connection, no
+faster than EMAIL_OUTBOX_RATE_PER_MINUTE, recording the outcome of each
+message. Failed messages are retried with backoff. Each delivery job
+sends no more than it can within the job's lease, queueing another job
+for the rest.
+"""
+
+from __future__ import absolute_import
+
+import datetime
+import email.message
+import json
+import logging
+import time
+import traceback
+import uuid
+
+from django.core.mail import EmailMessage, get_connection
+from django.core.mail.message import MIMEMixin
+from django.db.models import F, Q
+from django.utils import timezone
+
+import wsrc.site.settings.settings as settings
+from wsrc.site import jobs
+from wsrc.site.models import OutboxEmail
+
+LOGGER = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+BATCH_SIZE = 100
+LEASE_MARGIN_SECS = 300
+# time left at the end of each delivery job's lease, for closing the
+# connection and recording the outcome
+JOB_MARGIN_SECS = 60
+
+
+class RawMIMEMessage(MIMEMixin, email.message.Message):
+    pass
+
+
+class StoredEmailMessage(EmailMessage):
+    "An already formatted message, in the form the mail backends expect"
+
+    def __init__(self, outbox_email):
+        super(StoredEmailMessage, self).__init__(subject=outbox_email.subject,
+                                                 from_email=outbox_email.from_address)
+        self.envelope_recipients = json.loads(outbox_email.recipients)
+        self.raw_message = outbox_email.message.encode(settings.DEFAULT_CHARSET)
+
+    def recipients(self):
+        return self.envelope_recipients
+
+    def message(self):
+        return email.message_from_string(self.raw_message, _class=RawMIMEMessage)
+
+
+def queue_message(msg):
+    "Store the EmailMessage MSG in the outbox, and make sure that delivery is scheduled"
+    raw_message = msg.message().as_string().decode(settings.DEFAULT_CHARSET)
+    outbox_email = OutboxEmail.objects.create(subject=msg.subject[:255], from_address=msg.from_email,
+                                              recipients=json.dumps(msg.recipients()), message=raw_message,
+                                              send_after=timezone.now())
+    schedule_delivery()
+    return outbox_email
+
+
+def schedule_delivery(delay=datetime.timedelta(0)):
+    "Queue a delivery job to run after DELAY, unless one will already run by then"
+    # a spare job is harmless, it will find nothing to do
+    jobs.enqueue_once(deliver, delay=delay)
+
+
+def claim_batch(batch_size, lease_secs):
+    "Lease up to BATCH_SIZE due messages to this sender for LEASE_SECS, returning them"
+    now = timezone.now()
+    available = Q(status=OutboxEmail.QUEUED, send_after__lte=now) | \
+        Q(status=OutboxEmail.SENDING, locked_until__lt=now)
+    candidates = list(OutboxEmail.objects.filter(available).order_by("send_after")
+                      .values_list("pk", flat=True)[:batch_size])
+    claim = uuid.uuid4().hex
+    OutboxEmail.objects.filter(available, pk__in=candidates).update(
+        status=OutboxEmail.SENDING, claim=claim, attempts=F("attempts") + 1,
+        locked_until=now + datetime.timedelta(seconds=lease_secs))
+    return list(OutboxEmail.objects.filter(claim=claim, status=OutboxEmail.SENDING).order_by("send_after"))
+
+
+def record_failure(outbox_email, error):
+    fields = {"last_error": error, "locked_until": None}
+    if outbox_email.attempts >= MAX_ATTEMPTS:
+        fields["status"] = OutboxEmail.FAILED
+    else:
+        fields.update(status=OutboxEmail.QUEUED, send_after=timezone.now() + jobs.get_backoff(outbox_email.attempts))
+    OutboxEmail.objects.filter(pk=outbox_email.pk, claim=outbox_email.claim).update(**fields)
+
+
+def release(outbox_emails):
+    "Return claimed but unattempted messages to the queue"
+    for outbox_email in outbox_emails:
+        OutboxEmail.objects.filter(pk=outbox_email.pk, claim=outbox_email.claim).update(
+            status=OutboxEmail.QUEUED, attempts=F("attempts") - 1, locked_until=None)
+
+
+def get_max_messages():
+    "The number of messages one delivery job can send within its lease"
+    budget_secs = jobs.VISIBILITY_TIMEOUT_SECS - JOB_MARGIN_SECS
+    return max(1, int(settings.EMAIL_OUTBOX_RATE_PER_MINUTE * budget_secs / 60))
+
+
+def deliver(batch_size=BATCH_SIZE):
+    """Background job sending the queued messages over one mail server
+    connection, a batch at a time, stopping before the job's lease
+    expires. Returns the number sent."""
+    interval = 60.0 / settings.EMAIL_OUTBOX_RATE_PER_MINUTE
+    max_messages = get_max_messages()
+    deadline = time.time() + jobs.VISIBILITY_TIMEOUT_SECS - JOB_MARGIN_SECS
+    connection = get_connection(fail_silently=False)
+    nattempted = nsent = 0
+    try:
+        connection.open()
+        while nattempted < max_messages and time.time() < deadline:
+            nclaim = min(batch_size, max_messages - nattempted)
+            batch = claim_batch(nclaim, nclaim * interval + LEASE_MARGIN_SECS)
+            if not batch:
+                break
+            for i, outbox_email in enumerate(batch):
+                if time.time() >= deadline:
+                    # sending has been slower than the rate allows for
+                    release(batch[i:])
+                    break
+                nattempted += 1
+                started = time.time()
+                try:
+                    connection.send_messages([StoredEmailMessage(outbox_email)])
+                except Exception:
+                    LOGGER.exception("unable to send email {0}".format(outbox_email.pk))
+                    record_failure(outbox_email, traceback.format_exc())
+                    # the connection may not have survived the error
+                    connection.close()
+                    connection.open()
+                else:
+                    OutboxEmail.objects.filter(pk=outbox_email.pk, claim=outbox_email.claim).update(
+                        status=OutboxEmail.SENT, sent=timezone.now(), locked_until=None, last_error="")
+                    nsent += 1
+                time.sleep(max(0, interval - (time.time() - started)))
+    finally:
+        connection.close()
+    LOGGER.info("sent {0} email(s)".format(nsent))
+    # messages left for the next job, retries, and messages queued
+    # while this job was finishing
+    next_due = OutboxEmail.objects.filter(status=OutboxEmail.QUEUED).order_by("send_after").first()
+    if next_due is not None:
+        schedule_delivery(max(datetime.timedelta(0), next_due.send_after - timezone.now()))
+    return nsent
@@ -82,6 +82,18 @@ DATABASES = {
     },
 }
 
+# Cache
+# https://docs.djangoproject.com/en/1.11/topics/cache/
+# The default is per-process; set CACHE_BACKEND/CACHE_LOCATION to a
+# shared backend when running more than one server process.
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'wsrc'),
+    },
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
 
@@ -112,6 +124,8 @@ STATICFILES_DIRS = (
 
 MEDIA_ROOT = os.getenv('MEDIA_ROOT')
 MEDIA_URL = os.getenv('MEDIA_URL')
+# generated activity reports, which must not be publicly served
+ACTIVITY_REPORT_DIR = os.getenv('ACTIVITY_REPORT_DIR')
 INTERNAL_IPS = "127.0.0.1"
 
 DEFAULT_FROM_EMAIL = "webmaster@wokingsquashclub.org"
@@ -125,6 +139,8 @@ EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD')
 
 EMAIL_PORT          = int(os.getenv('EMAIL_PORT', '587'))
 EMAIL_USE_TLS       = True
+# maximum rate at which the outbox delivers queued emails
+EMAIL_OUTBOX_RATE_PER_MINUTE = int(os.getenv('EMAIL_OUTBOX_RATE_PER_MINUTE', '60'))
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
@@ -151,4 +167,7 @@ BOOKING_SYSTEM_STARTS_ENDS = [int(t) for t in os.getenv("BOOKING_SYSTEM_STARTS_E
 BOOKING_SYSTEM_CUTOFF_DAYS = int(os.getenv("BOOKING_SYSTEM_CUTOFF_DAYS"))
 BOOKING_SYSTEM_REQUIRE_OPPONENT = bool(os.getenv("BOOKING_SYSTEM_REQUIRE_OPPONENT", "True"))
 BOOKING_SYSTEM_ALLOW_BOOKING_SHORTCUT = False
+BOOKING_SYSTEM_EMAIL_ADDRESS = os.getenv("BOOKING_SYSTEM_EMAIL_ADDRESS", "court_booking@wokingsquashclub.org")
+# cancellations within this period are notified to each player in one email
+BOOKING_SYSTEM_CANCELLATION_DIGEST_SECS = int(os.getenv("BOOKING_SYSTEM_CANCELLATION_DIGEST_SECS", "120"))
 
@@ -56,6 +56,7 @@ urlpatterns = [
     url(r'^courts/cal_invite/(\d+)/?$', wsrc.site.courts.views.calendar_invite_view),
     url(r'^courts/agenda/?$', wsrc.site.courts.views.agenda_view, name="agenda"),
     url(r'^courts/notifications/?$', wsrc.site.courts.views.notifier_view, name="notifier"),
+    url(r'^courts/availability/?$', wsrc.site.courts.views.availability_view, name="court_availability"),
     url(r'^courts/penalty_points/?$', wsrc.site.courts.views.penalty_points_view, name="penalty_points"),
     url(r'^courts/condensation_report/?$', wsrc.site.courts.views.CondensationReportCreateView.as_view(), name="condensation_report"),
                        
@@ -103,9 +104,11 @@ urlpatterns = [
     url(r'^data/oauth_token_exchange/(.+)$', wsrc.site.views.OAuthExchangeTokenView.as_view(), name="oauth_token_exchange"),
     url(r'^data/facebook$', wsrc.site.views.facebook_view, name="facebook"),
     url(r'^data/bookings$', wsrc.site.views.BookingList.as_view()),
+    url(r'^data/booking_changes$', wsrc.site.views.booking_changes_view),
     url(r'^data/accounts/',  include(wsrc.site.accounts.data_urls)),
     url(r'^data/auth/', wsrc.site.views.auth_view),
     url(r'^data/club_events/', wsrc.site.views.ClubEventList.as_view()),
+    url(r'^data/activity_report/status$', wsrc.site.usermodel.views.member_activity_status_view),
     url(r'^data/activity_report', wsrc.site.usermodel.views.member_activity_view),                       
     url(r'^data/',    include(wsrc.site.competitions.data_urls)),
     url(r'^data/doorcardevent/$', wsrc.site.usermodel.views.DoorCardEventCreateView.as_view()),
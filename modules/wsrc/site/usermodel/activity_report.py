@@ -15,34 +15,72 @@
 
 "Utilities for determining the activity of members of the club"
 
+import bisect
 import collections
 import colorsys
 import datetime
 import os.path
-import StringIO
-import xlsxwriter
 
-from django.db.models import Q
+from django.db.models import DurationField, ExpressionWrapper, F, Q, Sum
 from django.contrib.staticfiles import finders
 
 from wsrc.site.competitions.models import Match, Competition
 from wsrc.site.courts.models import BookingSystemEvent, BookingOffence
-from wsrc.site.usermodel.models import Subscription, DoorEntryCard, DoorCardEvent
+from wsrc.site.courts.occupancy import OccupancyGrid
+from wsrc.site.courts import usage_categories
+from wsrc.site.usermodel.models import Subscription, DoorCardEvent, DoorCardLease
 from wsrc.utils.timezones import UK_TZINFO
+from wsrc.utils.xlsx_export import FormatCache, compile_accessor, create_workbook, write_temporary_workbook
 
 WEEKDAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
 SLOTS_PER_HOUR = 4
 COL_T = collections.namedtuple("Col", ["name", "path", "fmt", "width"])
-        
+
+# the subscriptions reported on, by name
+SUBSCRIPTION_FILTERS = {
+    "adult": Q(player__user__is_active=True) & Q(season__has_ended=False) & ~Q(subscription_type__short_code="junior"),
+    "all": Q(player__user__is_active=True) & Q(season__has_ended=False),
+}
+DEFAULT_SUBSCRIPTION_FILTER = "adult"
+
+
+class DoorCardLeaseIndex(object):
+    "The leases of each door card, ordered by issue date, to find who held a card on a given date"
+
+    def __init__(self, leases):
+        "LEASES are (card_id, date_issued, date_returned, player_id) tuples"
+        by_card = dict()
+        for lease in sorted(leases, key=lambda lease: lease[1]):
+            by_card.setdefault(lease[0], []).append(lease)
+        self.cards = dict([(card_id, ([lease[1] for lease in leases], leases))
+                           for card_id, leases in by_card.iteritems()])
+
+    @classmethod
+    def for_dates(cls, start_date, end_date):
+        "Index of the leases overlapping the given dates"
+        leases = DoorCardLease.objects.filter(Q(date_returned__isnull=True) | Q(date_returned__gte=start_date),
+                                              date_issued__lte=end_date)\
+                                      .values_list("card_id", "date_issued", "date_returned", "player_id")
+        return cls(leases)
+
+    def get_player_id(self, card_id, date):
+        "Player holding the card on DATE, or None. The later lease wins on a day the card changed hands."
+        card = self.cards.get(card_id)
+        if card is None:
+            return None
+        starts, leases = card
+        idx = bisect.bisect_right(starts, date) - 1
+        if idx < 0:
+            return None
+        date_returned = leases[idx][2]
+        if date_returned is not None and date_returned < date:
+            return None
+        return leases[idx][3]
 
 
 class ActivityReport(object):
     "Report on the activity of subscribed members between two dates"
-    def __init__(self, start_date, end_date, subs_filter=\
-                 Q(player__user__is_active=True) &\
-                 Q(season__has_ended=False) &\
-                 ~Q(subscription_type__short_code="junior")\
-    ):
+    def __init__(self, start_date, end_date, subs_filter=SUBSCRIPTION_FILTERS[DEFAULT_SUBSCRIPTION_FILTER]):
         "Initialize report with given dates and filters"
         midnight = datetime.time(0, tzinfo=UK_TZINFO)
         self.start_date = datetime.datetime.combine(start_date, midnight)
@@ -73,14 +111,6 @@ class ActivityReport(object):
             result = results[key] = factory()
         return result
 
-    @staticmethod
-    def getitem(record, name):
-        for tok in name.split("."):
-            item = record = getattr(record, tok)
-            if hasattr(item, "__call__"):
-                item = record = item()
-        return item
-
     @staticmethod
     def write_data_to_sheet(worksheet, data, fields, cell_formats, row_idx, col_idx, alt_row_format=None, autofilter=False, totals=None, width_in_cells=False):
         merged_cells = 0
@@ -97,6 +127,7 @@ class ActivityReport(object):
         rows += 1
         if totals is not None:
             totals = dict([(jdx, 0) for jdx in totals])
+        accessors = [compile_accessor(field.path) for field in fields]
         for idx, row in enumerate(data):
             idx += row_idx + 1
             merged_cells = 0
@@ -108,7 +139,7 @@ class ActivityReport(object):
                     fmt = alt_row_format if field.fmt is None else cell_formats[field.fmt + "_alt"]
                 else:
                     fmt = None if field.fmt is None else cell_formats[field.fmt]
-                val = ActivityReport.getitem(row, field.path)
+                val = accessors[field_idx](row)
                 if width_in_cells and field.width > 1:
                     worksheet.merge_range(idx, jdx, idx, jdx+field.width-1, val, fmt)
                     merged_cells += field.width - 1
@@ -138,7 +169,7 @@ class ActivityReport(object):
         return rows
 
     @staticmethod
-    def write_heatmap(workbook, worksheet, data, cell_formats, row_headers, col_headers, row_idx, col_idx):
+    def write_heatmap(format_cache, worksheet, data, cell_formats, row_headers, col_headers, row_idx, col_idx):
         low_color = (0.8, 0.01, 1.0)
         high_color = (0.01, 1.0, 1.0)
         def make_rgb(val):
@@ -148,48 +179,59 @@ class ActivityReport(object):
         for jdx, header in enumerate(col_headers):
             jdx = jdx * 2 + col_idx + 1
             worksheet.merge_range(row_idx, jdx, row_idx, jdx+1, header, cell_formats["header"])
-        for idx, header in enumerate(row_headers):
+        # each row is written complete, as the worksheet is streamed
+        for idx, (header, row) in enumerate(zip(row_headers, data)):
             idx += row_idx+1
-            worksheet.write(idx, col_idx, header, cell_formats["header"])
             worksheet.set_row(idx, 20)
-        for idx, row in enumerate(data):
-            idx += row_idx+1
+            worksheet.write(idx, col_idx, header, cell_formats["header"])
             for jdx, val in enumerate(row):
                 jdx = jdx * 2 + col_idx + 1
-                fmt = {'num_format': '0.%', 'bg_color': make_rgb(val)}
-                print fmt
-                fmt = workbook.add_format(fmt)
+                # shades are whole percentages, so that cells share a few formats
+                fmt = format_cache.get({'num_format': '0.%', 'bg_color': make_rgb(round(val, 2))})
                 worksheet.merge_range(idx, jdx, idx, jdx+1, val, fmt)
         return row_idx + 1 + len(data)
     
-    def get_doorcard_events(self):
+    def get_doorcard_events(self, lookback=None):
+        """Entries by each player, ignoring repeats within two hours. Entries
+        within the timedelta LOOKBACK before the start date are considered
+        when ignoring repeats but not returned, so that entries are counted
+        the same whether or not the period is reported on its own"""
+        first_time = self.start_date - lookback if lookback is not None else self.start_date
         dce_qs = DoorCardEvent.objects\
                               .filter(event="Granted",\
-                                      received_time__gte=self.start_date,\
+                                      received_time__gte=first_time,\
                                       received_time__lt=self.end_date)\
-                              .prefetch_related("card__doorcardlease_set__player__user")
-        
+                              .order_by("timestamp")
+        # attribute each entry to whoever held the card at the time
+        one_day = datetime.timedelta(days=1)
+        lease_index = DoorCardLeaseIndex.for_dates(first_time.date() - one_day, self.end_date.date() + one_day)
         results = dict()
         for dce in dce_qs:
-            card = dce.card
-            if card is not None:
-                current_lease = card.get_current_ownership_data()
-                if current_lease is None:
+            if dce.card_id is not None:
+                player_id = lease_index.get_player_id(dce.card_id, dce.timestamp.astimezone(UK_TZINFO).date())
+                if player_id is None:
                     continue
-                player_list = self._get_or_add_set(results, current_lease.player.pk, lambda: list())
+                player_list = self._get_or_add_set(results, player_id, lambda: list())
                 if len(player_list) > 0:
                     # ignore repeat entries by the same card
                     if (dce.timestamp - player_list[-1].timestamp).total_seconds() < (2 * 60 * 60):
                         continue
                 player_list.append(dce)
+        if lookback is not None:
+            for player_id, player_list in results.items():
+                player_list = [dce for dce in player_list if dce.received_time >= self.start_date]
+                if player_list:
+                    results[player_id] = player_list
+                else:
+                    del results[player_id]
         return results
 
 
     def get_courts_booked(self):
         results = dict()
         for booking in self.bookings:
-            if booking.created_by is not None:
-                player_set = self._get_or_add_set(results, booking.created_by.pk)
+            if booking.created_by_id is not None:
+                player_set = self._get_or_add_set(results, booking.created_by_id)
                 player_set.add(booking)
         return results
 
@@ -217,52 +259,28 @@ class ActivityReport(object):
                          COL_T("Matches", "n_matches", None, 2)]
         
     def get_court_usage(self):
-        class Court:
-            def __init__(self, court):
-                self.court = court
-                self.slots = [False] * (SLOTS_PER_HOUR * 24)
-            def slot(self, start, end):
-                slot = start.hour * SLOTS_PER_HOUR + (start.minute * SLOTS_PER_HOUR / 60)
-                while start < end:
-                    self.slots[slot] = True
-                    start += datetime.timedelta(minutes=60/SLOTS_PER_HOUR)
-                    slot += 1
-        class Day:
-            def __init__(self, date):
-                self.date = date
-                self.courts = [Court(idx) for idx in range(1,4)]
-            def slot(self, booking):
-                court = self.courts[booking.court-1]
-                court.slot(booking.start_time, booking.end_time)
-
+        courts = range(1,4)
         def collate_bookings(bookings):
-            dates = dict()
-            for bslot in bookings:
-                date = bslot.start_time.date()
-                day = self._get_or_add_set(dates, date, lambda: Day(date))
-                day.slot(bslot)
-            return dates.values()
-
-        def day_of_week_reduce(date_summaries):
-            class DayAvg:
-                def __init__(self):
-                    self.count = 0
-                    self.slots = [0.0 for jdx in range(0, (4*24))]
-                def process(self):
-                    return [self.count > 0 and (slot / self.count) or 0.0 for slot in self.slots]
-            day_avg = [DayAvg() for i in range(0, 7)]
-            for day in date_summaries:
-                avg = day_avg[day.date.weekday()]
-                for idx in range(0, 3):
-                    court = day.courts[idx]
-                    avg.count += 1
-                    for (jdx,slot) in enumerate(court.slots):
-                        if slot:
-                            avg.slots[jdx] += 1
-            return [s.process() for s in day_avg]
-
-        date_summaries = collate_bookings(self.bookings)
-        day_averages = day_of_week_reduce(date_summaries)
+            grid = OccupancyGrid(60/SLOTS_PER_HOUR)
+            # only the times and courts are needed, so skip building model instances
+            for start, end, court in bookings.values_list("start_time", "end_time", "court").order_by():
+                duration_mins = int((end - start).total_seconds() / 60)
+                grid.add(start.date(), court, start.hour * 60 + start.minute, duration_mins)
+            return grid
+
+        def day_of_week_reduce(grid):
+            dates_by_weekday = [[] for i in range(0, 7)]
+            for date in grid.days.iterkeys():
+                dates_by_weekday[date.weekday()].append(date)
+            results = []
+            for dates in dates_by_weekday:
+                count = len(dates) * len(courts)
+                totals = grid.slot_totals(dates, courts)
+                results.append([count > 0 and (float(total) / count) or 0.0 for total in totals])
+            return results
+
+        grid = collate_bookings(self.bookings)
+        day_averages = day_of_week_reduce(grid)
         result_t = collections.namedtuple("CourtUsage", ["time"] + WEEKDAYS)
         results = []
         for idx in range(SLOTS_PER_HOUR*7, SLOTS_PER_HOUR*23):
@@ -273,53 +291,35 @@ class ActivityReport(object):
 
     def bucket_court_usage(self, data, bin_width):
         results = []
-        bin_idx = 0
-        sums = [0] * 7
-        first_time = ""
         result_t = collections.namedtuple("CourtUsage", ["time"] + WEEKDAYS)
-        for row_idx, row in enumerate(data):
-            if bin_idx == 0:
-                first_time = row[0]
-            bin_idx += 1
-            for dow, val in enumerate(row[1:]):
-                sums[dow] += val
-            if bin_idx == bin_width or row_idx == len(data)-1:
-                time = "{first}-".format(first=first_time)
-                results.append(result_t(time, *[float(val)/bin_width for val in sums]))
-                bin_idx = 0
-                sums = [0] * 7
+        for idx in range(0, len(data), bin_width):
+            rows = data[idx:idx+bin_width]
+            # sum each weekday's column over the rows in the bin
+            sums = [sum(column) for column in zip(*rows)[1:]]
+            time = "{first}-".format(first=rows[0][0])
+            results.append(result_t(time, *[float(val)/bin_width for val in sums]))
         return results
                 
     def get_court_usage_summary(self):
         result_t = collections.namedtuple("CourtSummary", ["booking_type", "slots", "fraction", "peak_slots", "peak_fraction"])
-        results = dict([(typ, [0,0]) for typ in ("Club Night", "Teams", "Junior Coaching", "Members", "Other")])
+        labels = dict(usage_categories.USAGE_CATEGORIES)
+        results = dict([(label, [0,0]) for label in labels.itervalues()])
         total = 0
         total_peak = 0
-        for booking in self.bookings:
-            duration_mins = int((booking.end_time - booking.start_time).total_seconds() / 60)
+        duration = ExpressionWrapper(F("end_time") - F("start_time"), output_field=DurationField())
+        rows = self.bookings.order_by().values_list("usage_category", "is_peak")\
+                                      .annotate(duration=Sum(duration))
+        for category, peak, duration in rows:
+            duration_mins = int(duration.total_seconds() / 60)
+            totals = results[labels.get(category, "Other")]
+            totals[0] += duration_mins
             total += duration_mins
-            is_peak = booking.start_time.time().hour >= 17 and booking.start_time.time().hour <= 20 and booking.start_time.date().weekday() <= 4
-            if is_peak:
+            if peak:
+                totals[1] += duration_mins
                 total_peak += duration_mins
-            name = booking.name.lower().strip()
-            def add(key):
-                totals = results[key]
-                totals[0] += duration_mins
-                if is_peak:
-                    totals[1] += duration_mins
-            if name == "club night":
-                add("Club Night")
-            elif (" vs " in name or " vs. " in name) and\
-                 ("mens" in name or "woking" in name or "vets" in name or\
-                  "vintage" in name or "ladies" in name or "racketball" in name):
-                add("Teams")
-            elif "junior" in name:
-                add("Junior Coaching")
-            elif booking.event_type in ["I", ""]:
-                add("Members")
-            else:
-                add("Other")
-        results = [result_t(key, val[0]/45, float(val[0])/total, val[1]/45, float(val[1])/total_peak) for key,val in results.iteritems()]
+        total = float(max(total, 1))
+        total_peak = float(max(total_peak, 1))
+        results = [result_t(key, val[0]/45, val[0]/total, val[1]/45, val[1]/total_peak) for key,val in results.iteritems()]
         results.sort(key=lambda x: x.slots, reverse=True)
         return results, [COL_T("Type", "booking_type", None, 3),
                          COL_T("All (45m) Slots", "slots", None, 5),
@@ -329,9 +329,8 @@ class ActivityReport(object):
         ]
 
     def get_player_activity_data(self):
-        matches = self.get_matches_played()
-        bookings = self.get_courts_booked()
-        door_events = self.get_doorcard_events()
+        from .activity_rollup import get_activity_totals
+        totals = get_activity_totals(self.start_date.date(), self.end_date.date() - datetime.timedelta(days=1))
         players = []
         player_summary_type = collections.namedtuple("PlayerData",
                                                      ["sub", "player", "n_matches", "n_bookings",
@@ -339,12 +338,10 @@ class ActivityReport(object):
 
         for sub in self.subscriptions:
             player = sub.player
-            p_matches = matches.get(player.pk) or []
-            p_bookings = bookings.get(player.pk) or []
-            p_visits = door_events.get(player.pk) or []
-            p_sum = player_summary_type(sub, player,
-                                        len(p_matches), len(p_bookings), len(p_visits),
-                                        len(p_matches) + len(p_bookings) + len(p_visits))
+            p_totals = totals.get(player.pk) or {}
+            n_matches, n_bookings, n_visits = [p_totals.get(key, 0) for key in ("matches", "bookings", "visits")]
+            p_sum = player_summary_type(sub, player, n_matches, n_bookings, n_visits,
+                                        n_matches + n_bookings + n_visits)
             players.append(p_sum)
         return players
 
@@ -373,12 +370,24 @@ class ActivityReport(object):
                          COL_T("Recently Joined", "n_recent", None, 3),
                          COL_T("Inactive", "n_inactive", "numeric", 3)]
 
-    def create_report(self):
-        output = StringIO.StringIO()
-        workbook = xlsxwriter.Workbook(output, {'in_memory': True, 'remove_timezone': True})
-        
+    def create_report(self, filename=None, progress=None):
+        """Create the XLSX workbook, writing it to FILENAME if given or
+        otherwise returning its contents. PROGRESS, if given, is called
+        with the fraction complete and a description of the next stage."""
+        if progress is None:
+            progress = lambda fraction, stage: None
+        options = {'remove_timezone': True}
+        if filename is None:
+            with write_temporary_workbook(lambda workbook: self.write_report(workbook, progress), options) as fh:
+                return fh.read()
+        workbook = create_workbook(filename, options)
+        self.write_report(workbook, progress)
+        workbook.close()
+
+    def write_report(self, workbook, progress):
+        format_cache = FormatCache(workbook)
         alt_color_fmt = {'bg_color': '#EBEDEF'}
-        alt_row_format = workbook.add_format(alt_color_fmt)
+        alt_row_format = format_cache.get(alt_color_fmt)
         formats = {
             "title": {'bold': True,  'font_size': 13},
             "header": {'align': 'center', 'valign': 'vjustify', 'bold': False,  'bottom': 1, 'bg_color': '#AEB6BF'},
@@ -391,10 +400,10 @@ class ActivityReport(object):
         }
         cell_formats = {}
         for key, val in formats.iteritems():
-            cell_formats[key] = workbook.add_format(val)
+            cell_formats[key] = format_cache.get(val)
             fmt = val.copy()
             fmt.update(alt_color_fmt)
-            cell_formats[key + "_alt"] = workbook.add_format(fmt)
+            cell_formats[key + "_alt"] = format_cache.get(fmt)
 
         exec_summary_ws = workbook.add_worksheet("Executive Summary")
 
@@ -405,6 +414,7 @@ class ActivityReport(object):
                                      alt_row_format, autofilter)
             return worksheet        
 
+        progress(0.0, "member activity")
         activity_data = self.get_player_activity_data()
         add_worksheet("Member Activity", activity_data,
                       [COL_T("Name", "player.get_ordered_name", None, 25),
@@ -422,6 +432,7 @@ class ActivityReport(object):
                        COL_T("Match", "get_teams_display", None, 40),
                        COL_T("Score", "get_scores_display", None, 25),
                       ], autofilter=True)
+        progress(0.4, "court use")
         cudata = self.get_court_usage()
         cudata = self.bucket_court_usage(cudata, 4)
         cuws = add_worksheet("Court Use", cudata,
@@ -437,6 +448,7 @@ class ActivityReport(object):
         exec_summary_ws.insert_image(0, 0, absolute_path, {'positioning': 3, 'x_offset': 10, 'y_offset': 10, 'x_scale': 0.5, 'y_scale': 0.5})
         exec_summary_ws.write(2, 3, "Data for {start:%d %b %Y} to {end:%d %b %Y}".format(start=self.start_date, end=self.end_date), cell_formats["title"])
 
+        progress(0.6, "summary")
         row_idx = 6
         exec_summary_ws.write(row_idx, 0, "Membership", cell_formats["section_header"])
         data, fields = self.get_membership_summary(activity_data)
@@ -507,9 +519,10 @@ class ActivityReport(object):
         row_headers = [row[0].split("-")[0] + "-" for row in cudata]
         rows = [row[1:] for row in cudata]
 #        cudata = zip(*cudata)
-        row_idx = self.write_heatmap(workbook, exec_summary_ws, rows, cell_formats, row_headers, WEEKDAYS, row_idx, 0)
+        row_idx = self.write_heatmap(format_cache, exec_summary_ws, rows, cell_formats, row_headers, WEEKDAYS, row_idx, 0)
         row_idx += 2
         
+        progress(0.8, "competitions")
         exec_summary_ws.write(row_idx, 0, "Internal Competitions", cell_formats["section_header"])
         row_idx += 2
         player_ids = set()
@@ -527,5 +540,4 @@ class ActivityReport(object):
 
         row_idx += 1
         exec_summary_ws.write(row_idx, 0, "Note that racketball and junior competitions are not currently captured in this data.")
-        workbook.close()
-        return output.getvalue()
+        progress(0.9, "saving")
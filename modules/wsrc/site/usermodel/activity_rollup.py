@@ -0,0 +1,145 @@
+# This file is part of WSRC.
+#
+# WSRC is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WSRC is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WSRC.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Daily rollup of each member's activity.
+
+Bookings made, matches played, visits to the club (door card entries,
+ignoring repeats within two hours) and offences are counted per player
+and per day into DailyActivity rows, so that activity over any period
+is a sum over those rows. A DailyActivityRollup row marks each day
+that has been rolled up; changes to the underlying data remove the
+marks for the days they affect, and get_activity_totals() rolls up
+any unmarked days before summing. Only days before today are stored.
+"""
+
+import datetime
+import logging
+
+from django.db import transaction
+from django.db.models import Sum
+
+from wsrc.utils.timezones import UK_TZINFO
+
+from .activity_report import ActivityReport
+from .models import DailyActivity, DailyActivityRollup
+
+LOGGER = logging.getLogger(__name__)
+
+COUNTS = ("bookings", "matches", "visits", "offences")
+# days rolled up at once, bounding the rows held in memory
+CHUNK_DAYS = 31
+# days re-rolled every night, to pick up late results and offences
+NIGHTLY_DAYS = 7
+# entries before the first day considered when ignoring repeat visits,
+# so that a visit spanning midnight is counted once whatever the chunks
+VISITS_LOOKBACK = datetime.timedelta(days=1)
+
+
+def local_date(dt):
+    return dt.astimezone(UK_TZINFO).date()
+
+
+def date_range(first_date, last_date):
+    date = first_date
+    while date <= last_date:
+        yield date
+        date += datetime.timedelta(days=1)
+
+
+def compute_daily_activity(first_date, last_date):
+    "Counts for each (player id, date) from FIRST_DATE to LAST_DATE inclusive, from the raw data"
+    report = ActivityReport(first_date, last_date + datetime.timedelta(days=1))
+    counts = dict()
+
+    def add(player_id, date, key):
+        player_counts = counts.get((player_id, date))
+        if player_counts is None:
+            player_counts = counts[(player_id, date)] = dict([(name, 0) for name in COUNTS])
+        player_counts[key] += 1
+
+    for player_id, bookings in report.get_courts_booked().iteritems():
+        for booking in bookings:
+            add(player_id, local_date(booking.start_time), "bookings")
+    for player_id, matches in report.get_matches_played().iteritems():
+        for match in matches:
+            add(player_id, local_date(match.last_updated), "matches")
+    for player_id, events in report.get_doorcard_events(VISITS_LOOKBACK).iteritems():
+        for event in events:
+            add(player_id, local_date(event.received_time), "visits")
+    for offence in report.offences.filter(is_active=True):
+        add(offence.player_id, local_date(offence.start_time), "offences")
+    return counts
+
+
+def rollup_dates(first_date, last_date):
+    "Recalculate the rollup for the days from FIRST_DATE to LAST_DATE inclusive, excluding today and later"
+    last_date = min(last_date, datetime.date.today() - datetime.timedelta(days=1))
+    while first_date <= last_date:
+        chunk_last = min(last_date, first_date + datetime.timedelta(days=CHUNK_DAYS-1))
+        counts = compute_daily_activity(first_date, chunk_last)
+        with transaction.atomic():
+            DailyActivity.objects.filter(date__gte=first_date, date__lte=chunk_last).delete()
+            DailyActivity.objects.bulk_create([DailyActivity(player_id=player_id, date=date, **player_counts)
+                                               for (player_id, date), player_counts in counts.iteritems()])
+            DailyActivityRollup.objects.filter(date__gte=first_date, date__lte=chunk_last).delete()
+            DailyActivityRollup.objects.bulk_create([DailyActivityRollup(date=date)
+                                                     for date in date_range(first_date, chunk_last)])
+        LOGGER.info("rolled up activity for %s to %s", first_date, chunk_last)
+        first_date = chunk_last + datetime.timedelta(days=1)
+
+
+def rollup_recent(ndays=NIGHTLY_DAYS):
+    "Nightly job recalculating the rollup for the NDAYS days up to yesterday"
+    yesterday = datetime.date.today() - datetime.timedelta(days=1)
+    rollup_dates(yesterday - datetime.timedelta(days=ndays-1), yesterday)
+
+
+def invalidate_dates(first_date, last_date=None):
+    "Mark the rollup of the given days out of date"
+    if last_date is None:
+        last_date = first_date
+    DailyActivityRollup.objects.filter(date__gte=first_date, date__lte=last_date).delete()
+
+
+def get_activity_totals(first_date, last_date):
+    """Totals of each count for the days from FIRST_DATE to LAST_DATE
+    inclusive, as dicts keyed by player id. Days not yet rolled up are
+    rolled up first, and today and later are counted from the raw data."""
+    today = datetime.date.today()
+    stored_last_date = min(last_date, today - datetime.timedelta(days=1))
+    totals = dict()
+    if first_date <= stored_last_date:
+        rolled_up = set(DailyActivityRollup.objects.filter(date__gte=first_date, date__lte=stored_last_date)
+                        .values_list("date", flat=True))
+        run_start = None
+        for date in date_range(first_date, stored_last_date + datetime.timedelta(days=1)):
+            # roll up each run of missing days
+            if date not in rolled_up and date <= stored_last_date:
+                if run_start is None:
+                    run_start = date
+            elif run_start is not None:
+                rollup_dates(run_start, date - datetime.timedelta(days=1))
+                run_start = None
+        rows = DailyActivity.objects.filter(date__gte=first_date, date__lte=stored_last_date)\
+                                    .order_by().values("player_id")\
+                                    .annotate(*[Sum(name) for name in COUNTS])
+        for row in rows:
+            totals[row["player_id"]] = dict([(name, row[name + "__sum"]) for name in COUNTS])
+    if last_date >= today:
+        for (player_id, date), counts in compute_daily_activity(max(first_date, today), last_date).iteritems():
+            player_totals = totals.setdefault(player_id, dict([(name, 0) for name in COUNTS]))
+            for name in COUNTS:
+                player_totals[name] += counts[name]
+    return totals
@@ -3,3 +3,5 @@ from django.apps import AppConfig
 class UserModelAppConfig(AppConfig):
     name = 'wsrc.site.usermodel'
     verbose_name = 'Members and Subscriptions'
+    def ready(self):
+        from . import signals
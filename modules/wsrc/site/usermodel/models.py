@@ -544,3 +544,27 @@ class MembershipApplication(AbstractPlayer, AbstractSubscription):
     class Meta:
         verbose_name = "Membership Application"
     
+
+
+class DailyActivity(models.Model):
+    "Counts of a player's activity on one day, rolled up by activity_rollup"
+    player = models.ForeignKey(Player, on_delete=models.CASCADE)
+    date = models.DateField(db_index=True)
+    bookings = models.PositiveIntegerField(default=0)
+    matches = models.PositiveIntegerField(default=0)
+    visits = models.PositiveIntegerField(default=0)
+    offences = models.PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        return u"{0} {1:%Y-%m-%d}".format(self.player, self.date)
+
+    class Meta:
+        unique_together = ("player", "date")
+        verbose_name = "Daily Activity"
+        verbose_name_plural = "Daily Activity"
+
+
+class DailyActivityRollup(models.Model):
+    "Marks a date whose DailyActivity rows are complete and up to date"
+    date = models.DateField(primary_key=True)
+    updated = models.DateTimeField(auto_now=True)
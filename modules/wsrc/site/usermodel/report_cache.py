@@ -0,0 +1,223 @@
+# This file is part of WSRC.
+#
+# WSRC is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WSRC is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WSRC.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Activity reports generated in the background and kept on disk.
+
+A report is identified by its dates and subscription filter, and is
+stored with a fingerprint of the data in its window - counts and
+latest changes of the bookings, matches, offences, door card events
+and subscriptions it covers - so that a stored workbook is served
+until something it reports on changes. A status file alongside each
+report records the progress of its generation, for polling clients.
+Only one report for each set of dates and filter is generated at a
+time, and the previous report is served, marked as out of date, until
+the new one is ready. Files unused for a week are removed.
+"""
+
+import datetime
+import glob
+import hashlib
+import json
+import logging
+import os
+import os.path
+import tempfile
+import time
+
+from django.db.models import Count, Max
+
+import wsrc.site.settings.settings as settings
+from wsrc.site import jobs
+from wsrc.site.competitions.models import Match
+from wsrc.site.courts.models import BookingOffence, BookingSystemEvent
+from wsrc.site.usermodel.models import DoorCardEvent, Subscription
+from wsrc.utils.timezones import UK_TZINFO, as_iso_date, parse_iso_date_to_naive
+
+from .activity_report import ActivityReport, SUBSCRIPTION_FILTERS
+
+LOGGER = logging.getLogger(__name__)
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# a report which is not done and has not been heard of in this time is requested again
+STALE_SECS = 3600
+# reports for windows ending today are stored under a new key each day,
+# so files not used in this time are removed
+MAX_AGE_SECS = 7 * 24 * 3600
+
+
+def get_report_dir():
+    path = getattr(settings, "ACTIVITY_REPORT_DIR", None) or \
+        os.path.join(tempfile.gettempdir(), "wsrc_activity_reports")
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+def get_report_key(start_date, end_date, filter_name):
+    return "activity_{0}_{1}_{2}".format(as_iso_date(start_date), as_iso_date(end_date), filter_name)
+
+
+def get_data_fingerprint(start_date, end_date, filter_name):
+    "Hash of the counts and latest changes of the data reported on between the dates"
+    midnight = datetime.time(0, tzinfo=UK_TZINFO)
+    start = datetime.datetime.combine(start_date, midnight)
+    end = datetime.datetime.combine(end_date, midnight)
+    summary = [
+        BookingSystemEvent.objects.filter(start_time__gte=start, start_time__lt=end)
+        .aggregate(n=Count("id"), latest=Max("last_updated")),
+        Match.objects.filter(last_updated__gte=start, last_updated__lt=end)
+        .aggregate(n=Count("id"), latest=Max("last_updated")),
+        BookingOffence.objects.filter(start_time__gte=start, start_time__lt=end)
+        .aggregate(n=Count("id"), latest=Max("id")),
+        BookingOffence.objects.filter(start_time__gte=start, start_time__lt=end, is_active=True).count(),
+        DoorCardEvent.objects.filter(received_time__gte=start, received_time__lt=end)
+        .aggregate(n=Count("id"), latest=Max("id")),
+        Subscription.objects.filter(SUBSCRIPTION_FILTERS[filter_name])
+        .aggregate(n=Count("id"), latest=Max("id")),
+    ]
+    return hashlib.sha1(repr(summary)).hexdigest()[:16]
+
+
+def get_report_path(key, fingerprint):
+    return os.path.join(get_report_dir(), "{0}_{1}.xlsx".format(key, fingerprint))
+
+
+def get_status_path(key):
+    return os.path.join(get_report_dir(), key + ".json")
+
+
+def read_status(key):
+    try:
+        with open(get_status_path(key)) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return None
+
+
+def write_status(key, **status):
+    "Replace the status file for KEY atomically, so that readers never see it half written"
+    status["updated"] = time.time()
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=get_report_dir())
+    with os.fdopen(fd, "w") as fh:
+        json.dump(status, fh)
+    os.rename(tmp_path, get_status_path(key))
+    return status
+
+
+def open_report(path):
+    "The report at PATH opened for reading, or None if it has been removed"
+    try:
+        report_file = open(path, "rb")
+    except IOError:
+        return None
+    # keep reports in use from being pruned
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+    return report_file
+
+
+def get_stored_reports(key):
+    "Paths of the stored reports for KEY, newest first"
+    dated_paths = []
+    for path in glob.glob(os.path.join(get_report_dir(), key + "_*.xlsx")):
+        try:
+            dated_paths.append((os.path.getmtime(path), path))
+        except OSError:
+            pass
+    dated_paths.sort(reverse=True)
+    return [path for mtime, path in dated_paths]
+
+
+def is_under_way(status):
+    return status is not None and status.get("status") in (PENDING, RUNNING) and \
+        time.time() - status["updated"] < STALE_SECS
+
+
+def request_report(start_date, end_date, filter_name):
+    """Returns the stored report for the dates and filter, opened for
+    reading, the status of the report for the current data and whether
+    the stored report is that report. If there is no stored report for
+    the current data its generation is queued, unless a report for the
+    same dates and filter is already under way, and the newest stored
+    report is returned meanwhile, or None if there is none. A failed
+    report is queued again at once, and its failure returned."""
+    key = get_report_key(start_date, end_date, filter_name)
+    fingerprint = get_data_fingerprint(start_date, end_date, filter_name)
+    report_file = open_report(get_report_path(key, fingerprint))
+    if report_file is not None:
+        return report_file, dict(status=DONE, progress=1.0, stage="done", fingerprint=fingerprint), True
+    status = read_status(key)
+    if is_under_way(status):
+        if status.get("fingerprint") != fingerprint:
+            # queued when the report for the current data has been generated
+            status = dict(status=PENDING, progress=0.0, stage="waiting for an earlier report",
+                          fingerprint=fingerprint)
+    else:
+        queued = write_status(key, status=PENDING, progress=0.0, stage="queued", fingerprint=fingerprint)
+        jobs.enqueue(generate_report, start_date=as_iso_date(start_date), end_date=as_iso_date(end_date),
+                     filter_name=filter_name, fingerprint=fingerprint, max_attempts=1)
+        if status is None or status.get("status") != FAILED or status.get("fingerprint") != fingerprint:
+            status = queued
+    for path in get_stored_reports(key):
+        report_file = open_report(path)
+        if report_file is not None:
+            return report_file, status, False
+    return None, status, False
+
+
+def prune_reports(max_age_secs=MAX_AGE_SECS):
+    "Remove the reports, status files and leftovers of failed jobs which have not changed in MAX_AGE_SECS"
+    cutoff = time.time() - max_age_secs
+    for pattern in ("*.xlsx", "*.json", "*.tmp"):
+        for path in glob.glob(os.path.join(get_report_dir(), pattern)):
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+def generate_report(start_date, end_date, filter_name, fingerprint):
+    "Background job creating the report workbook, and removing those it supersedes"
+    start_date = parse_iso_date_to_naive(start_date)
+    end_date = parse_iso_date_to_naive(end_date)
+    key = get_report_key(start_date, end_date, filter_name)
+    path = get_report_path(key, fingerprint)
+
+    def progress(fraction, stage):
+        write_status(key, status=RUNNING, progress=fraction, stage=stage, fingerprint=fingerprint)
+
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=get_report_dir())
+    os.close(fd)
+    try:
+        reporter = ActivityReport(start_date, end_date, SUBSCRIPTION_FILTERS[filter_name])
+        reporter.create_report(tmp_path, progress)
+        os.rename(tmp_path, path)
+    except Exception, e:
+        os.remove(tmp_path)
+        write_status(key, status=FAILED, progress=0.0, stage=str(e), fingerprint=fingerprint)
+        raise
+    for old_path in glob.glob(os.path.join(get_report_dir(), key + "_*.xlsx")):
+        if old_path != path:
+            os.remove(old_path)
+    write_status(key, status=DONE, progress=1.0, stage="done", fingerprint=fingerprint)
+    LOGGER.info("created activity report %s", path)
+    prune_reports()
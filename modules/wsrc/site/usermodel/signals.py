@@ -0,0 +1,84 @@
+# This file is part of WSRC.
+#
+# WSRC is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WSRC is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WSRC.  If not, see <http://www.gnu.org/licenses/>.
+
+"Keep the daily activity rollup in step with the data it counts"
+
+import datetime
+
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from wsrc.site.competitions.models import Match
+from wsrc.site.courts.models import BookingOffence, BookingSystemEvent
+from .activity_rollup import invalidate_dates, local_date
+from .models import DoorCardLease
+
+def invalidate_if_moved(previous, instance):
+    # a booking moved to another day is no longer counted on the day it was saved for
+    if previous is not None and local_date(previous) != local_date(instance.start_time):
+        invalidate_dates(local_date(previous))
+
+@receiver(pre_save, sender=BookingSystemEvent, dispatch_uid="0d6f3b7e9a2c11f1a1c40242ac12000d")
+def invalidate_previous_booking_date(sender, instance, raw=False, *args, **kwargs):
+    if raw:
+        return
+    saved_state = instance.get_saved_state()
+    invalidate_if_moved(saved_state and saved_state[1], instance)
+
+@receiver(pre_save, sender=BookingOffence, dispatch_uid="0d6f3b7e9a2c11f1a1c40242ac12000e")
+def invalidate_previous_offence_date(sender, instance, raw=False, *args, **kwargs):
+    if raw or instance.pk is None:
+        return
+    invalidate_if_moved(sender.objects.filter(pk=instance.pk).values_list("start_time", flat=True).first(), instance)
+
+@receiver(post_save, sender=BookingSystemEvent, dispatch_uid="0d6f3b7e9a2c11f1a1c40242ac120005")
+@receiver(post_delete, sender=BookingSystemEvent, dispatch_uid="0d6f3b7e9a2c11f1a1c40242ac120006")
+def invalidate_booking_date(sender, instance, *args, **kwargs):
+    invalidate_dates(local_date(instance.start_time))
+
+@receiver(pre_save, sender=Match, dispatch_uid="0d6f3b7e9a2c11f1a1c40242ac120007")
+def invalidate_previous_match_date(sender, instance, raw=False, *args, **kwargs):
+    # saving a match moves it to today, so the day it was counted on changes too
+    if raw or instance.pk is None:
+        return
+    previous = Match.objects.filter(pk=instance.pk).values_list("last_updated", flat=True).first()
+    if previous is not None:
+        invalidate_dates(local_date(previous))
+
+@receiver(post_delete, sender=Match, dispatch_uid="0d6f3b7e9a2c11f1a1c40242ac120008")
+def invalidate_match_date(sender, instance, *args, **kwargs):
+    if instance.last_updated is not None:
+        invalidate_dates(local_date(instance.last_updated))
+
+@receiver(post_save, sender=BookingOffence, dispatch_uid="0d6f3b7e9a2c11f1a1c40242ac120009")
+@receiver(post_delete, sender=BookingOffence, dispatch_uid="0d6f3b7e9a2c11f1a1c40242ac12000a")
+def invalidate_offence_date(sender, instance, *args, **kwargs):
+    invalidate_dates(local_date(instance.start_time))
+
+@receiver(pre_save, sender=DoorCardLease, dispatch_uid="0d6f3b7e9a2c11f1a1c40242ac12000f")
+def invalidate_previous_lease_dates(sender, instance, raw=False, *args, **kwargs):
+    # days no longer within the lease were counted for its holder
+    if raw or instance.pk is None:
+        return
+    previous = DoorCardLease.objects.filter(pk=instance.pk).values_list("date_issued", "date_returned").first()
+    if previous is not None and previous != (instance.date_issued, instance.date_returned):
+        date_issued, date_returned = previous
+        invalidate_dates(date_issued, date_returned or datetime.date.today())
+
+@receiver(post_save, sender=DoorCardLease, dispatch_uid="0d6f3b7e9a2c11f1a1c40242ac12000b")
+@receiver(post_delete, sender=DoorCardLease, dispatch_uid="0d6f3b7e9a2c11f1a1c40242ac12000c")
+def invalidate_lease_dates(sender, instance, *args, **kwargs):
+    # visits may have been credited to the card's previous holder
+    invalidate_dates(instance.date_issued, instance.date_returned or datetime.date.today())
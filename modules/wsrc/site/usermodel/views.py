@@ -29,7 +29,7 @@ from django.core.exceptions import PermissionDenied, ValidationError
 from django.urls import reverse, reverse_lazy
 from django.db import transaction
 from django.db.models import Q
-from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseRedirect
+from django.http import FileResponse, HttpResponse, HttpResponseBadRequest, HttpResponseRedirect
 from django import forms
 from django.template.response import TemplateResponse
 from django.shortcuts import render
@@ -54,7 +54,8 @@ from wsrc.utils import xls_utils, sync_utils, email_utils
 from wsrc.utils.timezones import parse_iso_date_to_naive
 from wsrc.utils.form_utils import add_formfield_attrs
 
-from .activity_report import ActivityReport
+from . import report_cache
+from .activity_report import DEFAULT_SUBSCRIPTION_FILTER, SUBSCRIPTION_FILTERS
 from .forms import SettingsUserForm, SettingsPlayerForm, SettingsYoungPlayerForm, SettingsInfoForm, MembershipApplicationForm
 
 JSON_RENDERER = JSONRenderer()
@@ -149,33 +150,73 @@ class DoorCardEventCreateView(rest_generics.CreateAPIView):
     model = DoorCardEvent
     queryset = DoorCardEvent.objects.all()
 
-@login_required
-def member_activity_view(request):
+def get_activity_report_args(request):
+    "Validate the activity report request, returning its dates and filter name"
     if not request.user.is_staff:
         raise PermissionDenied()
     start_date = request.GET.get("start_date")
     end_date = request.GET.get("end_date")
     if start_date is None or end_date is None:
-        return HttpResponseBadRequest("missing start_date or end_date")
+        raise ValidationError("missing start_date or end_date")
     try:
         start_date = parse_iso_date_to_naive(start_date)
         end_date = parse_iso_date_to_naive(end_date)
     except ValueError:
-        return HttpResponseBadRequest("bad date format, should be YYYY-MM-DD")
-    reporter = ActivityReport(start_date, end_date)
+        raise ValidationError("bad date format, should be YYYY-MM-DD")
+    filter_name = request.GET.get("filter", DEFAULT_SUBSCRIPTION_FILTER)
+    if filter_name not in SUBSCRIPTION_FILTERS:
+        raise ValidationError("unknown filter, should be one of " + ", ".join(sorted(SUBSCRIPTION_FILTERS.keys())))
+    return start_date, end_date, filter_name
+
+@login_required
+def member_activity_view(request):
+    """Serve the activity report for the current data, or while it is
+    being created an earlier report marked as out of date, or otherwise
+    a page which refreshes until it is ready"""
+    try:
+        start_date, end_date, filter_name = get_activity_report_args(request)
+    except ValidationError, e:
+        return HttpResponseBadRequest(e.message)
     if "djdt" in request.GET:
         # used for tracing SQL calls in the debug toolbar
-        payload = "<html><body></body></html>"
-        content_type = 'text/html'
-    else:
-        payload = reporter.create_report()
-        content_type = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-    response = HttpResponse(payload, content_type=content_type)
-    if "djdt" not in request.GET:
-        response['Content-Disposition'] = 'attachment; filename="activity_{start_date:%Y-%m-%d}_{end_date:%Y-%m-%d}.xlsx"'\
-                                          .format(**locals())
+        return HttpResponse("<html><body></body></html>", content_type='text/html')
+    report_file, report_status, is_current = report_cache.request_report(start_date, end_date, filter_name)
+    if report_file is None:
+        if report_status["status"] == report_cache.FAILED:
+            return HttpResponse("Unable to create report: " + report_status["stage"],
+                                content_type='text/plain', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        html = '<html><head><meta http-equiv="refresh" content="5"></head><body>' +\
+               'Creating report: {stage} ({progress:.0%})</body></html>'.format(**report_status)
+        return HttpResponse(html, content_type='text/html', status=status.HTTP_202_ACCEPTED)
+    response = FileResponse(report_file,
+                            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    suffix = "" if is_current else "_out_of_date"
+    response['Content-Disposition'] = 'attachment; filename="activity_{start_date:%Y-%m-%d}_{end_date:%Y-%m-%d}{suffix}.xlsx"'\
+                                      .format(**locals())
+    if not is_current:
+        # an earlier report, served while the one for the current data is created
+        response['Warning'] = '110 - "Response is Stale"'
     return response
 
+@login_required
+def member_activity_status_view(request):
+    "Progress of the activity report's creation, which is started if necessary"
+    try:
+        start_date, end_date, filter_name = get_activity_report_args(request)
+    except ValidationError, e:
+        return HttpResponseBadRequest(e.message)
+    report_file, report_status, is_current = report_cache.request_report(start_date, end_date, filter_name)
+    if report_file is not None:
+        report_file.close()
+    result = {
+        "ready": is_current,
+        "status": report_status["status"],
+        "progress": report_status["progress"],
+        "stage": report_status["stage"],
+        "out_of_date_available": report_file is not None and not is_current,
+    }
+    return HttpResponse(json.dumps(result), content_type="application/json")
+
 @login_required
 def settings_view(request):
     "Settings editor"
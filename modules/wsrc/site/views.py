@@ -16,14 +16,16 @@
 
 import sys
 
+from wsrc.site.api_auth import is_device_authenticated
 from wsrc.site.models import PageContent, SquashLevels, LeagueMasterFixtures, MaintenanceIssue,\
     Suggestion, ClubEvent, CommitteeMeetingMinutes, NavigationLink, OAuthAccess, NewsItem
 from wsrc.site.competitions.models import CompetitionGroup
-from wsrc.site.courts.models import BookingSystemEvent
+from wsrc.site.courts.models import BookingSystemEvent, BookingSystemEventAuditEntry
 from wsrc.site.email.models import VirtualAlias, VirtualDomain
 from wsrc.site.usermodel.models import Player, SubscriptionType
 import wsrc.site.settings.settings as settings
 from wsrc.utils import timezones, email_utils, url_utils
+from wsrc.utils.http_utils import make_etag, conditional_response
 
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import PasswordChangeForm
@@ -46,16 +48,18 @@ from django.template.loader import render_to_string
 from django.utils import timezone
 from django.views.decorators.http import require_safe, require_http_methods
 from django.views.generic.edit import CreateView
-from django.db.models import Q
+from django.db.models import Q, Count, Max
 
 import rest_framework.generics as rest_generics
 from rest_framework.renderers import JSONRenderer
 from rest_framework.exceptions import ValidationError as RestValidationError
 from rest_framework import serializers
 from rest_framework.parsers import JSONParser, FormParser
+from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.utils.serializer_helpers import ReturnDict
 
+from backports.functools_lru_cache import lru_cache
 import collections
 import markdown
 import datetime
@@ -172,6 +176,12 @@ def committee_view(request):
 
 
 def generate_tokens(date):
+    return _generate_tokens(date, settings.BOOKING_SYSTEM_HMAC_KEY)
+
+
+@lru_cache(maxsize=16)
+def _generate_tokens(date, hmac_key):
+    "Token table for DATE, cached per date and HMAC key - callers must not modify it"
     start_times = {
         1: datetime.datetime.combine(date, datetime.time(8, 15)),
         2: datetime.datetime.combine(date, datetime.time(8, 30)),
@@ -478,6 +488,37 @@ class DateTimeTzAwareField(serializers.DateTimeField):
         return super(DateTimeTzAwareField, self).to_representation(value)
 
 
+def is_booking_viewer_authenticated(request):
+    "Logged in, or supplied an API token or valid credentials in the X-Username/X-Password headers"
+    authenticated = getattr(request, "_booking_viewer_authenticated", None)
+    if authenticated is None:
+        authenticated = request.user.is_authenticated
+        if not authenticated and hasattr(request, "META"):
+            authenticated = is_device_authenticated(request)
+        authenticated = bool(authenticated)
+        request._booking_viewer_authenticated = authenticated
+    return authenticated
+
+
+class ConditionalGetMixin(object):
+    """Answer GET requests with 304 Not Modified when the ETag built from
+    get_etag_parts() matches, without running the queryset or serializers.
+    get_etag_parts() may return None to skip the check."""
+    def get(self, request, *args, **kwargs):
+        parts = self.get_etag_parts()
+        base_get = super(ConditionalGetMixin, self).get
+        if parts is None:
+            return base_get(request, *args, **kwargs)
+        return conditional_response(request, make_etag(request.get_full_path(), *parts),
+                                    lambda: base_get(request, *args, **kwargs))
+
+def get_booking_tokens(date):
+    "Booking tokens for DATE if it is bookable from today, otherwise None"
+    dt = date - datetime.date.today()
+    if dt.days >=0 and dt.days < 8:
+        return generate_tokens(date)
+    return None
+
 class CustomBookingListSerializer(serializers.ListSerializer):
     """Custom ListSerializer, which is automagically returneded by the
        BookingSerializer constructor when many=True argument is
@@ -503,9 +544,9 @@ class CustomBookingListSerializer(serializers.ListSerializer):
         result["bookings"] =  obj
         if self.date is not None:
             result["date"] = self.date.isoformat()
-            dt = self.date - datetime.date.today()
-            if dt.days >=0 and dt.days < 8:
-                result["tokens"] = generate_tokens(self.date)
+            tokens = get_booking_tokens(self.date)
+            if tokens is not None:
+                result["tokens"] = tokens
         return result
 
     # need to override as ListSerializer tries to return the contents
@@ -524,30 +565,178 @@ class BookingSerializer(serializers.ModelSerializer):
     @classmethod
     def many_init(cls, *args, **kwargs):
         request = kwargs["context"]["request"]
-        authenticated = request.user.is_authenticated
-        if not authenticated and hasattr(request, "META"):
-            authenticated = authenticate(username=request.META.get("HTTP_X_USERNAME"),
-                                         password=request.META.get("HTTP_X_PASSWORD"))
-        kwargs['child'] = cls() if authenticated\
+        kwargs['child'] = cls() if is_booking_viewer_authenticated(request)\
                           else ObfuscatedBookingSerializer()
         return CustomBookingListSerializer(*args, **kwargs)
 
 class ObfuscatedBookingSerializer(BookingSerializer):
     name = serializers.CharField(source="obfuscated_name", read_only="True")
     
-class BookingList(rest_generics.ListAPIView):
+class BookingList(ConditionalGetMixin, rest_generics.ListAPIView):
+    """Bookings for a single day (date, day_offset parameters) serialized
+       one object per booking, or for a range of days (start_date,
+       end_date and optional comma-separated courts parameters) in a
+       compact columnar form - see get_range_data()."""
     serializer_class = BookingSerializer
+    MAX_RANGE_DAYS = 31
+    COLUMNS = ("start_mins", "duration_mins", "court", "name", "event_type")
+
+    def list(self, request, *args, **kwargs):
+        if request.query_params.get('start_date') is None:
+            return super(BookingList, self).list(request, *args, **kwargs)
+        return Response(self.get_range_data())
+
+    def get_range_data(self):
+        """Returns {"start_date", "end_date", "days": [...]} where each day
+           has the date, a list for each of COLUMNS holding the values for
+           that day's bookings in start order, and tokens if bookable"""
+        params = self.request.query_params
+        start_date, end_date = self.get_date_range()
+        try:
+            courts = params.get('courts')
+            if courts is not None:
+                courts = [int(c) for c in courts.split(',')]
+        except ValueError, e:
+            raise RestValidationError(str(e))
+        ndays = (end_date - start_date).days + 1
+
+        obfuscate = not is_booking_viewer_authenticated(self.request)
+        days = []
+        day_map = {}
+        for i in range(ndays):
+            date = start_date + datetime.timedelta(days=i)
+            day = dict([(col, []) for col in self.COLUMNS])
+            day["date"] = date.isoformat()
+            tokens = get_booking_tokens(date)
+            if tokens is not None:
+                day["tokens"] = tokens
+            days.append(day)
+            day_map[date] = day
+        for booking in BookingSystemEvent.get_bookings_for_date_range(start_date, end_date, courts):
+            day = day_map[timezone.localtime(booking.start_time).date()]
+            day["start_mins"].append(booking.start_minutes)
+            day["duration_mins"].append(booking.duration_minutes)
+            day["court"].append(booking.court)
+            day["name"].append(booking.obfuscated_name() if obfuscate else booking.name)
+            day["event_type"].append(booking.event_type)
+        return {
+            "start_date": start_date.isoformat(),
+            "end_date": end_date.isoformat(),
+            "days": days,
+        }
+
+    def get_date_range(self):
+        "First and last dates requested, in either single day or range mode"
+        params = self.request.query_params
+        if params.get('start_date') is None:
+            date = params.get('date', None)
+            if date is None:
+                raise RestValidationError("required date parameter not supplied")
+            date = timezones.parse_iso_date_to_naive(date)
+            delta = params.get('day_offset', None)
+            if delta is not None:
+                date = date + datetime.timedelta(days=int(delta))
+            return date, date
+        try:
+            start_date = timezones.parse_iso_date_to_naive(params['start_date'])
+            end_date = timezones.parse_iso_date_to_naive(params.get('end_date', params['start_date']))
+        except ValueError, e:
+            raise RestValidationError(str(e))
+        ndays = (end_date - start_date).days + 1
+        if ndays < 1 or ndays > self.MAX_RANGE_DAYS:
+            raise RestValidationError("date range must be between 1 and {0} days".format(self.MAX_RANGE_DAYS))
+        return start_date, end_date
+
+    def get_etag_parts(self):
+        try:
+            start_date, end_date = self.get_date_range()
+        except (RestValidationError, ValueError):
+            return None
+        count, last_updated = BookingSystemEvent.get_change_validator(start_date, end_date)
+        return (count, last_updated, datetime.date.today(), is_booking_viewer_authenticated(self.request))
+
     def get_queryset(self):
-        date = self.request.query_params.get('date', None)
-        if date is None:
-            raise RestValidationError("required date parameter not supplied")
-        date = timezones.parse_iso_date_to_naive(date)
+        date, end_date = self.get_date_range()
         date = datetime.datetime.combine(date, datetime.time(0, tzinfo=timezone.get_default_timezone()))
-        delta = self.request.query_params.get('day_offset', None)
-        if delta is not None:
-            date = date + datetime.timedelta(days=int(delta))
         return BookingSystemEvent.get_bookings_for_date(date)
 
+BOOKING_CHANGES_POLL_SECS = 2
+BOOKING_CHANGES_MAX_WAIT_SECS = 25
+
+def get_booking_changes(date, since, obfuscate):
+    """Returns a list of booking changes for DATE recorded in the audit
+       table after audit entry SINCE, in the order they were made. A
+       booking moved to another day is reported on both days, with the
+       date it is now on."""
+    midnight = timezone.make_aware(datetime.datetime.combine(date, datetime.time()))
+    next_midnight = midnight + datetime.timedelta(days=1)
+    on_date = Q(booking__start_time__gte=midnight, booking__start_time__lt=next_midnight) |\
+              Q(previous_start_time__gte=midnight, previous_start_time__lt=next_midnight)
+    entries = BookingSystemEventAuditEntry.objects.select_related("booking")\
+                                                  .filter(on_date, id__gt=since)\
+                                                  .order_by("id")
+    changes = []
+    for entry in entries:
+        booking = entry.booking
+        changes.append({
+            "cursor": entry.id,
+            "id": booking.id,
+            "update_type": entry.update_type,
+            "date": timezone.localtime(booking.start_time).date().isoformat(),
+            "court": booking.court,
+            "start_mins": booking.start_minutes,
+            "duration_mins": booking.duration_minutes,
+            "name": booking.obfuscated_name() if obfuscate else entry.name,
+            "event_type": entry.event_type,
+        })
+    return changes
+
+def get_latest_audit_entry_id():
+    return BookingSystemEventAuditEntry.objects.aggregate(cursor=Max("id"))["cursor"] or 0
+
+@require_safe
+def booking_changes_view(request):
+    """Long-poll channel for changes to the bookings on a date, fed from
+       the booking audit table, whose ids are used as the cursor.
+
+       Without a cursor ("since" parameter) the current cursor is
+       returned at once, for a client to use after loading the
+       day. Otherwise the request is held open, for up to "wait"
+       seconds, until there are changes on the date after the cursor,
+       which are returned with the new cursor. While waiting only the
+       latest audit entry id is read, and the date's changes are looked
+       up again only when it moves, so that a waiting client costs one
+       indexed query every few seconds and needs no message broker."""
+    try:
+        date = timezones.parse_iso_date_to_naive(request.GET["date"])
+        since = request.GET.get("since")
+        since = int(since) if since else None
+        wait = min(int(request.GET.get("wait", BOOKING_CHANGES_MAX_WAIT_SECS)), BOOKING_CHANGES_MAX_WAIT_SECS)
+    except (KeyError, ValueError), e:
+        raise SuspiciousOperation("invalid parameters: " + str(e))
+    obfuscate = not is_booking_viewer_authenticated(request)
+    latest = get_latest_audit_entry_id()
+    if since is None:
+        return HttpResponse(json.dumps({"cursor": latest, "changes": []}), content_type="application/json")
+
+    deadline = time.time() + wait
+    checked = None
+    changes = []
+    while True:
+        if latest != checked:
+            changes = get_booking_changes(date, since, obfuscate)
+            checked = latest
+            if changes:
+                break
+        if time.time() >= deadline:
+            break
+        time.sleep(BOOKING_CHANGES_POLL_SECS)
+        latest = get_latest_audit_entry_id()
+    cursor = changes[-1]["cursor"] if changes else since
+    response = HttpResponse(json.dumps({"cursor": cursor, "changes": changes}), content_type="application/json")
+    response["Cache-Control"] = "no-cache"
+    return response
+
 def auth_view(request):
     if request.method == 'GET':
         data = {
@@ -612,12 +801,16 @@ class ClubEventSerializer(serializers.ModelSerializer):
         model = ClubEvent
         fields = ('title', 'display_date', 'display_time', 'markup', 'picture', 'last_updated')
 
-class ClubEventList(rest_generics.ListAPIView):
+class ClubEventList(ConditionalGetMixin, rest_generics.ListAPIView):
     serializer_class = ClubEventSerializer
     def get_queryset(self):
         queryset = ClubEvent.objects.order_by("last_updated")
         return queryset.filter(Q(display_date__isnull=True) | Q(display_date__gte=datetime.date.today()))
 
+    def get_etag_parts(self):
+        result = self.get_queryset().aggregate(count=Count("id"), last_updated=Max("last_updated"))
+        return (result["count"], result["last_updated"])
+
 class OAuthExchangeTokenView(APIView):
     parser_classes = (JSONParser,)
     def put(self, request, record_id):
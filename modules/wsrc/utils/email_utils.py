@@ -15,7 +15,7 @@ LOGGER.setLevel(logging.INFO)
 
 EMAIL_DELAY_PERIOD = 1
 
-def send_email(subject, text_body, html_body, from_address, to_list, bcc_list=None, reply_to_address=None, cc_list=None, extra_attachments=None):
+def build_message(subject, text_body, html_body, from_address, to_list, bcc_list=None, reply_to_address=None, cc_list=None, extra_attachments=None):
   headers = {}
   if reply_to_address is not None:
     headers['Reply-To'] = reply_to_address
@@ -32,9 +32,21 @@ def send_email(subject, text_body, html_body, from_address, to_list, bcc_list=No
     if extra_attachments is not None:
       for data in extra_attachments:
         msg.attach(data)        
-  LOGGER.info("sending mail, subject=\"{subject}\", from={from_address}, to_list={to_list}, cc_list={cc_list}, bcc_list={bcc_list}, headers={headers}".format(**locals()))
+  return msg
+
+def send_email(subject, text_body, html_body, from_address, to_list, bcc_list=None, reply_to_address=None, cc_list=None, extra_attachments=None):
+  msg = build_message(subject, text_body, html_body, from_address, to_list, bcc_list, reply_to_address, cc_list, extra_attachments)
+  LOGGER.info(u"sending mail, subject=\"{subject}\", from={from_address}, to_list={to_list}, cc_list={cc_list}, bcc_list={bcc_list}, headers={headers}".format(headers=msg.extra_headers, **locals()))
   msg.send(fail_silently=False)
 
+def queue_email(subject, text_body, html_body, from_address, to_list, bcc_list=None, reply_to_address=None, cc_list=None, extra_attachments=None):
+  """As send_email(), but stored in the outbox in the caller's
+     transaction and delivered later by the background job worker"""
+  from wsrc.site import outbox
+  msg = build_message(subject, text_body, html_body, from_address, to_list, bcc_list, reply_to_address, cc_list, extra_attachments)
+  LOGGER.info(u"queueing mail, subject=\"{subject}\", from={from_address}, to_list={to_list}, cc_list={cc_list}, bcc_list={bcc_list}".format(**locals()))
+  outbox.queue_message(msg)
+
 def send_markdown_email(subject, markdown_body, from_address, to_list, bcc_list=None, reply_to_address=None):
   html_content = markdown.markdown(markdown_body)
   send_email(subject, markdown_body, html_content, from_address, to_list, bcc_list, reply_to_address)
@@ -0,0 +1,37 @@
+# This file is part of WSRC.
+#
+# WSRC is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WSRC is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WSRC.  If not, see <http://www.gnu.org/licenses/>.
+
+"Helpers for conditional GET handling"
+
+import hashlib
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+
+
+def make_etag(*parts):
+    "Quoted entity tag summarising the string representation of PARTS"
+    digest = hashlib.md5("/".join([unicode(p).encode("utf-8") for p in parts])).hexdigest()
+    return quote_etag(digest)
+
+
+def conditional_response(request, etag, factory):
+    """Return a 304 response if the request's If-None-Match header matches
+    ETAG, otherwise the response returned by FACTORY(), tagged with ETAG"""
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = factory()
+        response["ETag"] = etag
+    return response
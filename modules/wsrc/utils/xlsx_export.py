@@ -0,0 +1,86 @@
+# This file is part of WSRC.
+#
+# WSRC is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WSRC is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WSRC.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Helpers for exporting data to XLSX workbooks.
+
+Workbooks are created in xlsxwriter's constant_memory mode, which
+streams each worksheet to a temporary file a row at a time, so memory
+use does not grow with the size of the export. The cost is that the
+cells of each worksheet must be written in row order: a row cannot
+be revisited once a later row has been written.
+"""
+
+import operator
+import os
+import tempfile
+
+import xlsxwriter
+
+
+def create_workbook(filename, options=None):
+    "Return a constant-memory workbook which will be written to FILENAME when closed"
+    opts = {"constant_memory": True}
+    if options is not None:
+        opts.update(options)
+    return xlsxwriter.Workbook(filename, opts)
+
+
+def write_temporary_workbook(writer, options=None):
+    """Call WRITER with a new workbook backed by a temporary file, and
+    return the finished file opened for reading. The file has already
+    been unlinked, so it disappears when closed."""
+    fd, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    try:
+        workbook = create_workbook(path, options)
+        writer(workbook)
+        workbook.close()
+        return open(path, "rb")
+    finally:
+        os.remove(path)
+
+
+class FormatCache(object):
+    """Workbook formats, created once for each distinct set of properties.
+    Every add_format() call adds a style record to the workbook, however
+    many cells share it."""
+
+    def __init__(self, workbook):
+        self.workbook = workbook
+        self.formats = dict()
+
+    def get(self, properties):
+        if properties is None:
+            return None
+        key = frozenset(properties.iteritems())
+        fmt = self.formats.get(key)
+        if fmt is None:
+            fmt = self.formats[key] = self.workbook.add_format(properties)
+        return fmt
+
+
+def compile_accessor(path):
+    """Return a function getting the value at the dotted PATH from a
+    record, calling any methods along the way, with the path split and
+    the attribute getters built once rather than for every cell"""
+    getters = [operator.attrgetter(name) for name in path.split(".")]
+
+    def accessor(record):
+        for getter in getters:
+            record = getter(record)
+            if callable(record):
+                record = record()
+        return record
+    return accessor